@@ -0,0 +1,30 @@
+# vim: fileencoding=utf-8
+"""Helpers shared by make_provisioner and fedora2ova."""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import hashlib
+import os
+
+def cpu_count ():
+    try:
+        return os.cpu_count() or 1
+    except AttributeError:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+def mtime_key (st):
+    # the exact mtime of a stat result, where Python has it
+    try:
+        return st.st_mtime_ns
+    except AttributeError:
+        return repr(st.st_mtime)
+
+def file_digest (path, algo='sha256', bufsize=1024*1024):
+    h = hashlib.new(algo)
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(bufsize)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
@@ -3,39 +3,36 @@ from __future__ import print_function, absolute_import, unicode_literals
 
 # current status: direct port from perl
 # which was a port of a shell script, I think
-import argparse
+#
+# Modules that only some runs need are imported where they're used, so that
+# --version and usage errors don't wait for them.
 from codecs import open
-import hashlib
+import errno
 import os
 import os.path
-import pkgutil
-import random
 import re
-from subprocess import call, check_call
 import string
 import sys
-import tempfile
-import time
-import traceback
 
 from . import VERSION, ENV_SCOPE
 
 PROG = 'fedora2ova'
 VBOX_OS_TYPE = 'Fedora'
-VBOX_CMD = 'VBoxManage'
 
 unarchivers = ['xz', 'pxz', 'pixz']
 line_pattern = re.compile(r"[\r\n]+")
 
-try:
-    TemporaryDirectory = tempfile.TemporaryDirectory
-except AttributeError:
-    from . import tempdir
-    TemporaryDirectory = tempdir.TemporaryDirectory
-
+def TemporaryDirectory (basename):
+    import tempfile
+    try:
+        return tempfile.TemporaryDirectory(basename)
+    except AttributeError:
+        from . import tempdir
+        return tempdir.TemporaryDirectory(basename)
 
 
 def get_data (filename, encoding='utf-8'):
+    import pkgutil
     bits = pkgutil.get_data(__name__, filename)
     if encoding is not None:
         return bits.decode(encoding)
@@ -88,9 +85,10 @@ def splitlines (text):
     return line_pattern.split(text)
 
 
-def build_config_iso (tmpdir, host, keydata):
+def render_config (host, keydata):
+    """Return the cidata files for the host, as a list of (name, bytes)."""
+    from .boot import DONE_MARKER
     host8 = host[0:8] if len(host) > 8 else host
-    iso_name = os.path.join(tmpdir, host + "-config.iso")
 
     # Process a raw authorized_keys style file to YAML array.
     keylines = splitlines(keydata.strip())
@@ -98,79 +96,237 @@ def build_config_iso (tmpdir, host, keydata):
                           for x in keylines)
 
     # Build user-data files (to add SSH keys) and meta-data (hostname) files
-    output = get_data('resources/user-data.yaml')
-    write_file(os.path.join(tmpdir, 'user-data'),
-               string.Template(output).substitute(dict(yaml_keys=yaml_keys)))
-
-    output = get_data('resources/meta-data.yaml')
+    user_data = string.Template(get_data('resources/user-data.yaml')).substitute(
+        dict(yaml_keys=yaml_keys, done_marker=DONE_MARKER))
     tpl_vars = dict(host=host, host8=host8)
-    write_file(os.path.join(tmpdir, 'meta-data'),
-               string.Template(output).substitute(tpl_vars))
+    meta_data = string.Template(get_data('resources/meta-data.yaml')).substitute(tpl_vars)
+    return [('user-data', user_data.encode('utf-8')),
+            ('meta-data', meta_data.encode('utf-8'))]
+
+def build_config_iso (tmpdir, host, keydata, cache=None, use_xorriso=False):
+    iso_name = os.path.join(tmpdir, host + "-config.iso")
+    files = render_config(host, keydata)
+    key = cache.config_key(files) if cache is not None else None
+    data = cache.fetch_iso(key) if cache is not None else None
+    if data is None:
+        if use_xorriso:
+            data = xorriso_iso(tmpdir, files)
+        else:
+            from .iso9660 import build_iso
+            # cloud-config might require this *specific* volume name (they
+            # include it without comment in examples)
+            data = build_iso(files, 'cidata')
+        if cache is not None:
+            cache.store_iso(key, data)
+
+    with open(iso_name, 'wb', encoding=None) as f:
+        f.write(data)
+    return iso_name
+
+def xorriso_iso (tmpdir, files):
+    from subprocess import check_call
+    for name, data in files:
+        with open(os.path.join(tmpdir, name), 'wb', encoding=None) as f:
+            f.write(data)
 
     # Create the ISO; xorriso needs to run within the ISO root dir!
     # [thus, cwd=tmpdir in Python]
-    # xorriso will warn about volid's format, but cloud-config might require
-    # this *specific* name (they include it without comment in examples)
+    # xorriso will warn about volid's format
+    iso_name = os.path.join(tmpdir, 'xorriso.iso')
     check_call(['xorriso', '-dev', iso_name,
                 '-joliet', 'on', '-rockridge', 'on', '-volid', 'cidata',
-                '-add', 'user-data', 'meta-data'],
+                '-add'] + [name for name, _ in files],
                cwd=tmpdir)
-    return iso_name
-
-
-def unxz_image (filename):
-    base = re.sub(r"\.xz$", '', filename, 1, re.I)
+    with open(iso_name, 'rb', encoding=None) as f:
+        data = f.read()
+    os.unlink(iso_name)
+    return data
+
+
+def unxz_image (filename, outdir):
+    """Decompress the .xz image into outdir, keeping the .xz file; return
+    the path of the raw image.  One that an earlier run finished is reused."""
+    from subprocess import call
+    from . import xz
+    base = os.path.join(outdir, os.path.basename(re.sub(r"\.xz$", '', filename, 1, re.I)))
     if os.path.exists(base):
-        err = "Can't unarchive {}: expected output {} exists"
-        raise ValueError(err.format(filename, base))
+        print("Using decompressed image {}".format(base))
+        return base
+    # renamed into place once it's complete, so that a run killed part way
+    # through doesn't leave a truncated image to be reused
+    partial = base + '.part'
+    if os.path.exists(partial):
+        os.unlink(partial)
+
+    # in-process, in parallel, leaving holes for the zeros
+    if xz.lzma is not None:
+        xz.decompress(filename, partial)
+        os.rename(partial, base)
+        return base
 
     for cmd in unarchivers:
-        rc = call([cmd, '-d', filename])
+        with open(partial, 'wb', encoding=None) as out:
+            rc = call([cmd, '-dc', filename], stdout=out)
         if rc != 0:
+            os.unlink(partial)
             continue
-
-        # make sure file exists after successful decompression
-        if not os.path.exists(base):
-            err = "Unarchiver didn't produce expected name: {}"
-            raise RuntimeError(err.format(base))
-
-        # return new filename
+        os.rename(partial, base)
         return base
 
     err = "No working unarchiver found (any of: {})"
     raise RuntimeError(err.format(unarchivers))
 
-def build_vm (config_iso, options):
-    cloud_img = options.image
-    vm_name = options.name
-    tmpdir = options.tmpdir
-    # check for "stdin" all-lowercase with optional any-case ".xz" suffix...
-    if re.match(r"^stdin(?:(?i)\.xz)?$", cloud_img):
-        raise ValueError("Disk image named 'stdin' will confuse VirtualBox")
-
-    # decompress the image if it appears to be compressed
-    if re.search(r"\.xz$", cloud_img, re.I):
-        print("Decompressing cloud image...")
-        cloud_img = unxz_image(cloud_img)
+def stream_image_to_vdi (filename, vdi, convert):
+    """Convert the .xz image to a VDI, piping the decompressed image straight
+    into the converter, so that the raw image never touches the disk."""
+    from subprocess import PIPE, Popen, CalledProcessError
+    from . import xz
+    # a stream's size can't be learned from it; the xz index knows it
+    size = xz.uncompressed_size(filename)
+    if xz.lzma is None:
+        unxz = Popen(['xz', '-dc', filename], stdout=PIPE)
+        try:
+            convert(vdi, size=size, data=unxz.stdout)
+        finally:
+            unxz.stdout.close()
+        if unxz.wait() != 0:
+            raise CalledProcessError(unxz.returncode, ['xz', '-dc', filename])
+    else:
+        convert(vdi, size=size, data=xz.iter_decompressed(filename))
 
-    cloud_img = os.path.abspath(cloud_img)
+def convert_image (cloud_img, tmpdir, convert, stream=True):
+    """Convert the (possibly .xz) raw image to a VDI in tmpdir, with
+    convert (like Backend.convert_from_raw); return its path."""
+    from subprocess import CalledProcessError
+    compressed = re.search(r"\.xz$", cloud_img, re.I)
+    raw = re.sub(r"\.xz$", '', cloud_img, 1, re.I) if compressed else cloud_img
 
-    # (re)convert the raw image to VDI
-    vdi = os.path.basename(cloud_img)
+    vdi = os.path.basename(raw)
     vdi, changes = re.subn(r"\.raw\b", ".vdi", vdi)
     if not changes:
         vdi += '.vdi'
-
     vdi = os.path.join(tmpdir, vdi)
-    check_call([VBOX_CMD, 'convertfromraw', str(cloud_img), vdi,
-                '--format', 'VDI'])
 
+    if compressed and stream:
+        print("Decompressing cloud image into VDI...")
+        try:
+            stream_image_to_vdi(cloud_img, vdi, convert)
+            return vdi
+        except (CalledProcessError, ValueError, OSError) as e:
+            print("Streaming conversion failed ({}); decompressing to a file instead".format(e),
+                  file=sys.stderr)
+            if os.path.exists(vdi):
+                os.unlink(vdi)
+
+    # decompress the image if it appears to be compressed
+    if compressed:
+        print("Decompressing cloud image...")
+        raw = unxz_image(cloud_img, tmpdir)
+        try:
+            convert(vdi, str(os.path.abspath(raw)))
+        finally:
+            os.unlink(raw)
+        return vdi
+
+    # (re)convert the raw image to VDI
+    convert(vdi, str(os.path.abspath(cloud_img)))
+    return vdi
+
+def build_base_disk (cloud_img, tmpdir, options):
+    """Convert the image to a VDI in tmpdir, resized per options; return its path."""
+    if not options.vbox_convert:
+        # written here, in one pass, at its final size
+        from functools import partial
+        from .vdi import convert_from_raw
+        disk_size = resize_mb(options) * 1024 * 1024 if resize_mb(options) else None
+        return convert_image(cloud_img, tmpdir, partial(convert_from_raw, disk_size=disk_size),
+                             options.stream)
+
+    backend = options.backend
+    vdi = convert_image(cloud_img, tmpdir, backend.convert_from_raw, options.stream)
     try:
-        # 1000 = basic sanity check that we have MB not GB.
-        if options.imagesize and options.imagesize > 1000:
-            check_call([VBOX_CMD, 'modifyhd', vdi,
-                        '--resize', str(options.imagesize)])
+        if resize_mb(options):
+            backend.resize_disk(vdi, resize_mb(options))
+    except BaseException:
+        backend.close_medium(vdi) # clean up zombie VDI
+        raise
+    return vdi
+
+def resize_mb (options):
+    # 1000 = basic sanity check that we have MB not GB.
+    if options.imagesize and options.imagesize > 1000:
+        return options.imagesize
+    return None
+
+def get_image_cache (options):
+    if not options.cache:
+        return None
+    from .imagecache import ImageCache, default_cache_dir
+    max_size = None
+    if options.cache_max_size is not None:
+        max_size = options.cache_max_size * 1024 * 1024
+    return ImageCache(options.cache_dir or default_cache_dir(), max_size, options.backend)
+
+def cached_base_disk (cache, cloud_img, options, source=None):
+    """Return the cached base VDI for the image and size, building it first
+    (from source, if the image has already been decompressed there) if it
+    isn't there yet."""
+    key = cache.key(cloud_img, resize_mb(options))
+    def builder (workdir):
+        vdi = build_base_disk(source or cloud_img, workdir, options)
+        if options.vbox_convert:
+            # resizing registers the disk; it is renamed into the cache next
+            options.backend.close_medium(vdi)
+        return vdi
+
+    # a batch's builds share their image; only the first converts it
+    with cache.lock:
+        base = cache.fetch(key)
+        if base is not None:
+            print("Using cached base disk {}".format(base))
+            return base
+        return cache.store(key, builder)
+
+def prepare_raw (cloud_img, options):
+    """Return the raw image to convert: the image itself, or the image
+    decompressed, or None if it will be decompressed as it's converted (or
+    the cache already has it converted)."""
+    if not re.search(r"\.xz$", cloud_img, re.I):
+        return cloud_img
+    if options.stream:
+        return None
+    cache = get_image_cache(options)
+    if cache is not None and cache.fetch(cache.key(cloud_img, resize_mb(options))):
+        return None
+    print("Decompressing cloud image...")
+    return unxz_image(cloud_img, options.tmpdir)
+
+def prepare_disk (cloud_img, options, source=None):
+    """Return the VDIs for the new VM: a differencing disk and the cached base
+    image under it, or else just a freshly converted one.  source is the
+    image already decompressed, if it has been."""
+    cache = get_image_cache(options)
+    if cache is None:
+        return [build_base_disk(source or cloud_img, options.tmpdir, options)]
+
+    base = cached_base_disk(cache, cloud_img, options, source)
+    # the VM only ever writes to this; exporting merges it with the base
+    vdi = os.path.join(options.tmpdir, options.name + '-disk.vdi')
+    options.backend.create_diff_disk(vdi, base)
+    return [vdi, base]
+
+def create_vm (config_iso, disks, options):
+    """Create and register the VM, with disks attached; return its
+    VmSettings and the path of its serial log."""
+    import hashlib
+    import random
+    import time
+    from .ova import VmSettings
+    backend = options.backend
+    vm_name = options.name
+    vdi = disks[0]
 
+    try:
         # create VM description and register it with VBox
         sha1 = hashlib.new('sha1')
         sha1.update("{}{}{}".format(os.getpid(),
@@ -181,70 +337,74 @@ def build_vm (config_iso, options):
         os_type = VBOX_OS_TYPE
         if not getattr(options, '32bit'):
             os_type += '_64'
-        check_call([VBOX_CMD, 'createvm', '--register',
-                    '--name', vm_name,
-                    '--ostype', os_type])
-
-        # Settings:
-        # * Enough RAM to avoid OOM issue seen at 512 MB (no swap on the image)
-        # * Hardware clock in UTC (inexplicably NOT set correctly by --ostype)
-        # * Disable unnecessary USB / Audio busses
-        check_call([VBOX_CMD, 'modifyvm', vm_name,
-                    '--memory', '768', '--vram', '32', '--rtcuseutc', 'on',
-                    '--mouse', 'ps2', '--keyboard', 'ps2',
-                    '--usb', 'off', '--audio', 'none'])
-        # allow access to the guest SSH
-        port_fwd = "ssh,tcp,127.0.0.1,{},,22".format(options.sshport)
-        check_call([VBOX_CMD, 'modifyvm', vm_name,
-                    '--nic1', 'nat', '--natpf1', port_fwd])
-
-        # build a controller and connect our storage to it (all SATA/AHCI)
-        check_call([VBOX_CMD, 'storagectl', vm_name, '--name', 'SATA',
-                    '--add', 'sata', '--controller', 'IntelAhci',
-                    '--portcount', '4', '--hostiocache', 'off',
-                    '--bootable', 'on'])
-        check_call([VBOX_CMD, 'storageattach', vm_name, '--storagectl', 'SATA',
-                    '--port', '0', '--type', 'hdd', '--medium', vdi])
+        vm = VmSettings(options.name, vm_name, os_type, options.memory, 32,
+                        options.sshport, disks)
+        backend.create_vm(vm_name, os_type)
+
+        with backend.edit_vm(vm_name) as edit:
+            # Settings:
+            # * Enough RAM (768 MB by default) to avoid OOM issue seen at 512 MB
+            #   (no swap on the image)
+            # * Hardware clock in UTC (inexplicably NOT set correctly by --ostype)
+            # * Disable unnecessary USB / Audio busses
+            edit.modify(memory=vm.memory, vram=vm.vram, rtc_utc=True,
+                        mouse='ps2', keyboard='ps2', usb=False, audio=None)
+            # allow access to the guest SSH
+            edit.modify(nat=True, nat_forwards=[
+                ('ssh', 'tcp', '127.0.0.1', options.sshport, '', 22)])
+            # the guest reports that cloud-init finished on its serial port
+            serial_log = os.path.join(options.tmpdir, options.name + '-serial.log')
+            edit.modify(serial_log=serial_log)
+
+            # build a controller and connect our storage to it (all SATA/AHCI)
+            edit.storage_controller('SATA', 'sata', 'IntelAhci', ports=4,
+                                    host_io_cache=False, bootable=True)
+            edit.attach('SATA', 0, 'hdd', vdi)
+            edit.attach('SATA', 3, 'dvddrive', config_iso)
     except BaseException:
-        call([VBOX_CMD, 'closemedium', vdi ]) # clean up zombie VDI
+        backend.close_medium(vdi) # clean up zombie VDI
         raise
+    return vm, serial_log
 
-    check_call([VBOX_CMD, 'storageattach', vm_name, '--storagectl', 'SATA',
-                '--port', '3', '--type', 'dvddrive', '--medium', config_iso ])
-
+def boot_vm (vm_name, serial_log, options):
+    """Boot the VM until cloud-init has configured it; return whether the
+    guest said it finished."""
+    import time
+    from .boot import run_vm
     # It turns out VBox can fail and return exit code zero.
     # We'd better make sure it's plausible that the VM booted.
     bootstart = time.time()
-    check_call(['VBoxHeadless', '-s', vm_name ])
+    finished = run_vm(options.backend, vm_name, serial_log, options.boot_timeout)
     bootdelta = time.time() - bootstart
 
     # Approximately "the amount of time vbox spends on the pre-boot screen",
     # so that even if the cloud image gets near-instant, this stays accurate.
-    if bootdelta < 2.0:
-        err = 'Improbably fast boot cycle: {.2f} sec.'
+    if not finished and bootdelta < 2.0:
+        err = 'Improbably fast boot cycle: {:.2f} sec.'
         raise RuntimeError(err.format(bootdelta))
-
-    return vm_name
+    return finished
 
 
-def export_vm (objdir, hostname, vm_name):
+def export_vm (objdir, hostname, vm, backend, use_vbox=False):
     filename = os.path.join(objdir, hostname + ".ova")
-    check_call([VBOX_CMD, 'export', vm_name, '--output', filename])
+    if use_vbox:
+        backend.export(vm.vm_name, filename)
+    else:
+        from .ova import write_ova
+        write_ova(filename, vm, get_data('resources/vm.ovf'))
     return filename
 
 
-def cleanup_vm (vm_name):
-    check_call([VBOX_CMD, 'unregistervm', '--delete', vm_name])
+def cleanup_vm (vm_name, backend):
+    backend.unregister(vm_name, delete=True)
 
 
 def build_arg_parser (prog=PROG):
+    import argparse
+    from .backend import BACKENDS
     default_pk = os.path.expanduser('~/.ssh/id_rsa.pub')
-    epi = string.Template(get_data("resources/epilog.txt")).substitute({
-        'basename': prog,
-        'var': ENV_SCOPE,
-    })
     # some contortions to fit 80 columns of width
-    new = dict(prog=prog, epilog=epi,
+    new = dict(prog=prog,
                formatter_class=argparse.RawDescriptionHelpFormatter,
                description="Convert a Fedora Cloud ISO to a VirtualBox OVA"
               )
@@ -257,6 +417,28 @@ def build_arg_parser (prog=PROG):
         'port': 'Host port to be forwarded to the guest\'s SSH port.',
         'tmp': 'Where to create tempfiles and config ISO.',
         'image': 'Path to the (possibly xz-compressed) Fedora Cloud image.',
+        'stream': 'Decompress an xz image to a file, then convert it, instead of converting it as it\'s decompressed.',
+        'convert': 'Convert the image to a VDI, and resize it, with VirtualBox instead of writing it directly.',
+        'cache': 'Convert the image for this build only, without the base disk cache.',
+        'cache_dir': 'Where to keep converted base disks (default: ~/.cache/cloud-maker/fedora2ova).',
+        'cache_max': 'Evict the least recently used base disks beyond this many megabytes.',
+        'cache_list': 'List the cached base disks, and exit.',
+        'cache_prune': 'Evict base disks down to --cache-max-size, and exit.',
+        'memory': 'Guest memory in megabytes.',
+        'xorriso': 'Master the cidata ISO with xorriso instead of the built-in writer.',
+        'export': 'Export the OVA with VirtualBox instead of writing it directly.',
+        'backend': 'How to drive VirtualBox: its Python API, VBoxManage, or'
+                   ' "fake", which runs nothing (for testing.)  The default,'
+                   ' auto, uses the API where the SDK is installed.',
+        'timeout': 'Give up on a guest that hasn\'t finished cloud-init after'
+                   ' this many seconds (0 to wait forever.)',
+        'batch': 'Build a host for each line of FILE ("-" for stdin): a hostname,'
+                 ' then optionally the path of its SSH public key.  Ports are'
+                 ' forwarded from --sshport up, skipping ports in use.',
+        'resume': 'Carry on with the build in --tmpdir from where it stopped,'
+                  ' if it was of the same image and options.',
+        'jobs': 'How many hosts to build at once in --batch mode'
+                ' (default: as many as CPUs and free memory allow.)',
     }
     p = argparse.ArgumentParser(**new)
     p.add_argument('--version', action='version',
@@ -279,8 +461,62 @@ def build_arg_parser (prog=PROG):
     p.add_argument('--tmpdir', '--tmp-dir', '-t',
                    help=htxt['tmp'],
                    default=get_env_default('TMPDIR'))
-    p.add_argument('image',
+    p.add_argument('--memory', '-m', type=int,
+                   help=htxt['memory'],
+                   default=get_env_default('MEMORY', 768))
+    p.add_argument('--boot-timeout', metavar='SECONDS', type=int,
+                   help=htxt['timeout'],
+                   default=get_env_default('BOOT_TIMEOUT', 1200))
+    p.add_argument('--batch', '-b', metavar='FILE',
+                   help=htxt['batch'],
+                   default=get_env_default('BATCH'))
+    p.add_argument('--jobs', '-j', type=int,
+                   help=htxt['jobs'],
+                   default=get_env_default('JOBS'))
+    p.add_argument('--resume', action='store_true',
+                   help=htxt['resume'],
+                   default=get_env_default('RESUME'))
+    p.add_argument('--xorriso', action='store_true',
+                   help=htxt['xorriso'],
+                   default=get_env_default('XORRISO'))
+    p.add_argument('--vbox-export', action='store_true',
+                   help=htxt['export'],
+                   default=get_env_default('VBOX_EXPORT'))
+    p.add_argument('--backend', choices=BACKENDS,
+                   help=htxt['backend'],
+                   default=get_env_default('BACKEND', 'auto'))
+    p.add_argument('--vbox-convert', action='store_true',
+                   help=htxt['convert'],
+                   default=get_env_default('VBOX_CONVERT'))
+    p.add_argument('--no-stream', dest='stream', action='store_false',
+                   default=not get_env_default('NO_STREAM'),
+                   help=htxt['stream'])
+    p.add_argument('--no-cache', dest='cache', action='store_false',
+                   default=not get_env_default('NO_CACHE'),
+                   help=htxt['cache'])
+    p.add_argument('--cache-dir', metavar='DIR',
+                   help=htxt['cache_dir'],
+                   default=get_env_default('CACHE_DIR'))
+    p.add_argument('--cache-max-size', metavar='MB', type=int,
+                   help=htxt['cache_max'],
+                   default=get_env_default('CACHE_MAX_SIZE', 20480))
+    p.add_argument('--cache-list', action='store_true',
+                   help=htxt['cache_list'])
+    p.add_argument('--cache-prune', action='store_true',
+                   help=htxt['cache_prune'])
+    p.add_argument('image', nargs='?',
                    help=htxt['image'])
+
+    # only --help shows the epilog, so only --help reads it
+    format_help = p.format_help
+    def format_help_with_epilog ():
+        if p.epilog is None:
+            p.epilog = string.Template(get_data("resources/epilog.txt")).substitute({
+                'basename': prog,
+                'var': ENV_SCOPE,
+            })
+        return format_help()
+    p.format_help = format_help_with_epilog
     return p
 
 def str_path (path):
@@ -296,8 +532,15 @@ def check_options (options):
         usage(2, 'SSH public key file not found')
     elif len(options.name) < 1:
         usage(3, 'Guest VM basename must not be empty')
+    elif options.memory < 256:
+        usage(2, 'Guest memory must be at least 256 MB')
+
+    if options.resume and options.tmpdir is None:
+        usage(2, '--resume needs the --tmpdir of the build to resume')
 
-    if not os.path.exists(options.image):
+    if options.image is None:
+        usage(4, "A Fedora Cloud image is required")
+    elif not os.path.exists(options.image):
         usage(4, "Fedora Cloud image does not exist: {}".format(options.image))
 
     try:
@@ -325,27 +568,140 @@ def check_options (options):
         raise ValueError(err.format(options.sshport))
 
 
-def main_build (options):
-    # build pipeline
-    config_iso = build_config_iso(options.tmpdir,
-                                  options.name,
-                                  options.pubkey_data)
-    vm_id = build_vm(config_iso, options)
-    ova_file = export_vm(options.objdir, options.name, vm_id)
-    return vm_id, ova_file
-
-def post_build (vm_id, ova_file):
-    # post-build checks; refactored because VBox unregistervm fails when the
-    # temporary directory housing the config ISO has been deleted.
-    if os.path.exists(ova_file):
+def build_inputs (options):
+    # everything that the built OVA depends on; a build only resumes from a
+    # state file with the same inputs
+    st = os.stat(options.image)
+    return dict(image=os.path.realpath(options.image), image_size=st.st_size,
+                image_mtime=st.st_mtime, name=options.name, imagesize=options.imagesize,
+                bits32=bool(getattr(options, '32bit')), memory=options.memory,
+                sshport=options.sshport, pubkey=options.pubkey_data, objdir=options.objdir,
+                cache=bool(options.cache), cache_dir=options.cache_dir, stream=options.stream,
+                xorriso=bool(options.xorriso), vbox_export=bool(options.vbox_export),
+                vbox_convert=bool(options.vbox_convert),
+                backend=options.backend.name)
+
+def build_stages (options):
+    from .ova import VmSettings
+    from .pipeline import Stage
+    from . import vdi as vdi_format
+    backend = options.backend
+
+    def config_iso (results):
+        return build_config_iso(options.tmpdir, options.name, options.pubkey_data,
+                                get_image_cache(options), options.xorriso)
+
+    def raw (results):
+        path = prepare_raw(options.image, options)
+        if path is None:
+            return None
+        return dict(path=os.path.abspath(path), size=os.path.getsize(path))
+
+    def file_ok (result, results):
+        return result is None or (os.path.exists(result['path'])
+                                  and os.path.getsize(result['path']) == result['size'])
+
+    def remove_raw (result):
+        # only what prepare_raw decompressed; never the image itself
+        if result and result['path'] != os.path.abspath(options.image) \
+                and os.path.exists(result['path']):
+            os.unlink(result['path'])
+
+    def disks (results):
+        source = results['raw']['path'] if results['raw'] else None
+        return prepare_disk(options.image, options, source)
+
+    def disks_ok (result, results):
+        try:
+            vdi_format.open_chain(result)
+            return True
+        except (IOError, OSError, ValueError):
+            return False
+
+    def discard_disks (result):
+        # the VM's own disk; a cached base stays in the cache
+        backend.close_medium(result[0])
+        if os.path.exists(result[0]):
+            os.unlink(result[0])
+
+    def vm (results):
+        vm, serial_log = create_vm(results['config_iso'], results['vdi'], options)
+        return dict(vm_name=vm.vm_name, os_type=vm.os_type, memory=vm.memory,
+                    vram=vm.vram, sshport=vm.sshport, serial_log=serial_log)
+
+    def vm_ok (result, results):
+        return backend.vm_exists(result['vm_name'])
+
+    def discard_vm (result):
+        # its disk is discarded with the vdi stage
+        if backend.vm_exists(result['vm_name']):
+            backend.unregister(result['vm_name'], delete=False)
+
+    def settings (results):
+        r = results['vm']
+        return VmSettings(options.name, r['vm_name'], r['os_type'], r['memory'],
+                          r['vram'], r['sshport'], results['vdi'])
+
+    def booted (results):
+        vm_name = results['vm']['vm_name']
+        finished = boot_vm(vm_name, results['vm']['serial_log'], options)
+        # the log is in tmpdir; an exported VM mustn't point at it
+        with backend.edit_vm(vm_name) as edit:
+            edit.modify(serial_log=None)
+        return dict(finished=finished)
+
+    def exported (results):
+        ova_file = export_vm(options.objdir, options.name, settings(results), backend,
+                             options.vbox_export)
+        if not os.path.exists(ova_file):
+            raise RuntimeError("Seemed OK, but failed to create: " + ova_file)
+        return dict(path=ova_file, size=os.path.getsize(ova_file))
+
+    def discard_ova (result):
+        if os.path.exists(result['path']):
+            os.unlink(result['path'])
+
+    def cleaned (results):
+        # refactored because VBox unregistervm fails when the temporary
+        # directory housing the config ISO has been deleted.
+        ova_file = results['exported']['path']
         print("Completed: " + ova_file)
-        cleanup_vm(vm_id)
-    else:
-        print("Seemed OK, but failed to create: " + ova_file, file=sys.stderr)
-
-def main_with_options (options):
-    check_options(options)
+        cleanup_vm(results['vm']['vm_name'], backend)
+        remove_raw(results['raw'])
+        return ova_file
+
+    return [
+        Stage('config_iso', config_iso, lambda result, results: os.path.exists(result)),
+        Stage('raw', raw, file_ok, remove_raw),
+        Stage('vdi', disks, disks_ok, discard_disks),
+        Stage('vm', vm, vm_ok, discard_vm),
+        # booting writes to the VM's disk, so a VM that didn't finish
+        # booting is rebuilt from a fresh disk
+        Stage('booted', booted, restart='vdi'),
+        Stage('exported', exported, file_ok, discard_ova),
+        Stage('cleaned', cleaned, lambda result, results: os.path.exists(result)),
+    ]
 
+def main_build (options):
+    """Run the build pipeline; return the OVA's path."""
+    from .pipeline import BuildState, run_stages
+    # check for "stdin" all-lowercase with optional any-case ".xz" suffix...
+    if re.match(r"^stdin(?:\.[xX][zZ])?$", options.image):
+        raise ValueError("Disk image named 'stdin' will confuse VirtualBox")
+    state = BuildState(options.tmpdir, build_inputs(options))
+    results = run_stages(build_stages(options), state, options.resume)
+    return results['cleaned']
+
+def main_cache (options):
+    options.cache = True
+    cache = get_image_cache(options)
+    if options.cache_prune:
+        for entry in cache.evict() + cache.evict_isos():
+            print("Removed " + entry)
+    cache.report()
+
+def run_build (options):
+    """Build the OVA for checked options; return its path, or None."""
     dir_create(options.objdir)
     if options.tmpdir is None:
         realprog = PROG
@@ -353,21 +709,38 @@ def main_with_options (options):
             realprog = '_' + realprog
         with TemporaryDirectory(realprog) as d:
             options.tmpdir = d
-            vm_id, ova_file = main_build(options)
-            post_build(vm_id, ova_file)
+            return main_build(options)
     else:
         dir_create(options.tmpdir)
-        vm_id, ova_file = main_build(options)
-        post_build(vm_id, ova_file)
+        return main_build(options)
+
+def main_with_options (options):
+    from .backend import get_backend
+    # one backend for every build, so that batches share its connection
+    options.backend = get_backend(options.backend)
+    try:
+        return dispatch(options)
+    finally:
+        if options.backend.name == 'fake':
+            options.backend.report()
+
+def dispatch (options):
+    if options.cache_list or options.cache_prune:
+        return main_cache(options)
+    if options.batch:
+        from .batch import main_batch
+        return main_batch(options)
+    check_options(options)
+    return 0 if run_build(options) else 1
 
 def main ():
     try:
-        main_with_options(build_arg_parser().parse_args())
-        return 0
+        return main_with_options(build_arg_parser().parse_args()) or 0
     except KeyboardInterrupt:
         return 1
     except SystemExit as e:
         return e.code
     except:
+        import traceback
         traceback.print_exc()
         return 2
@@ -0,0 +1,663 @@
+# vim: fileencoding=utf-8
+"""The VirtualBox operations that fedora2ova uses, behind one interface.
+
+VBoxManageBackend runs the command-line tools, as few times as it can: all
+of a VM's settings are collected by edit_vm and applied with one modifyvm.
+Each storage controller and attachment still takes a storagectl or
+storageattach of its own, as VBoxManage can't do more than one per run.
+ApiBackend uses the VirtualBox Python API (vboxapi) in-process, and applies
+each edit in one session.  FakeBackend runs nothing at all; it records the
+calls, so that the pipeline can be tested and timed without VirtualBox.
+
+Every backend records each operation and how long it took in its calls.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import collections
+import errno
+import os
+import re
+import sys
+import threading
+import time
+
+# the settings that edit_vm().modify() understands, in the order applied
+SETTINGS = ('memory', 'vram', 'rtc_utc', 'mouse', 'keyboard', 'usb', 'audio',
+            'nat', 'nat_forwards', 'serial_log')
+
+class VmEdit (object):
+    """Changes to a VM, applied together when the with block ends."""
+    def __init__ (self, backend, name):
+        self.backend = backend
+        self.name = name
+        self.settings = {}
+        self.controllers = []
+        self.attachments = []
+
+    def modify (self, **settings):
+        for key in settings:
+            if key not in SETTINGS:
+                raise ValueError("Unknown VM setting: {}".format(key))
+        self.settings.update(settings)
+
+    def storage_controller (self, name, bus='sata', controller='IntelAhci', ports=4,
+                            host_io_cache=False, bootable=True):
+        self.controllers.append(dict(name=name, bus=bus, controller=controller, ports=ports,
+                                     host_io_cache=host_io_cache, bootable=bootable))
+
+    def attach (self, controller, port, kind, medium):
+        # kind: 'hdd' or 'dvddrive'
+        self.attachments.append(dict(controller=controller, port=port, kind=kind,
+                                     medium=medium))
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, exc, tb):
+        if exc_type is None:
+            with self.backend.timed('edit_vm', self.name):
+                self.backend.apply(self)
+        return False
+
+
+class Backend (object):
+    """What the backends share: call timing, edit_vm(), and report().
+
+    Each backend also implements these operations:
+
+    create_vm(name, os_type), vm_exists(name), and unregister(name,
+    delete=True) create, look up, and remove (with its disks) a VM.
+    apply(edit) makes the changes collected in a VmEdit.
+
+    start(name) boots the VM headless, returning an object with poll() and
+    wait(), like a Popen, that finishes when the VM powers off.
+    power_button(name) asks the guest to shut down; power_off(name) pulls
+    the plug.  export(name, filename) writes the VM as an OVA.
+
+    convert_from_raw(vdi, raw_path=None, size=None, data=None) converts a
+    raw image to the VDI at vdi: the file at raw_path, or size bytes from
+    data (a file, or an iterable of bytes).  resize_disk(vdi, megabytes)
+    grows it, and create_diff_disk(path, parent) makes a differencing disk
+    over parent.  close_medium(path) forgets the disk at path, returning
+    False if it's still in use, and disk_locations() returns the paths of
+    every disk VirtualBox knows about.
+    """
+    name = None
+
+    def __init__ (self):
+        self.calls = []
+        self._calls_lock = threading.Lock()
+
+    def timed (self, op, *args):
+        return _Timer(self, op, args)
+
+    def edit_vm (self, name):
+        return VmEdit(self, name)
+
+    def report (self, out=sys.stderr):
+        totals = collections.OrderedDict()
+        for op, args, seconds in self.calls:
+            n, total = totals.get(op, (0, 0.0))
+            totals[op] = (n + 1, total + seconds)
+        print("{} backend: {} calls, {:.2f}s".format(
+            self.name, len(self.calls), sum(c[2] for c in self.calls)), file=out)
+        for op, (n, total) in totals.items():
+            print("  {:<18} {:>4} {:>9.3f}s".format(op, n, total), file=out)
+
+class _Timer (object):
+    def __init__ (self, backend, op, args):
+        self.backend = backend
+        self.op = op
+        self.args = args
+
+    def __enter__ (self):
+        self.start = time.time()
+        return self
+
+    def __exit__ (self, exc_type, exc, tb):
+        with self.backend._calls_lock:
+            self.backend.calls.append((self.op, self.args, time.time() - self.start))
+        return False
+
+
+class VBoxManageBackend (Backend):
+    name = 'vboxmanage'
+
+    def __init__ (self, cmd='VBoxManage', headless='VBoxHeadless'):
+        Backend.__init__(self)
+        self.cmd = cmd
+        self.headless = headless
+
+    def run (self, args):
+        from subprocess import check_call
+        check_call([self.cmd] + args)
+
+    def create_vm (self, name, os_type):
+        with self.timed('create_vm', name):
+            self.run(['createvm', '--register', '--name', name, '--ostype', os_type])
+
+    def apply (self, edit):
+        # one modifyvm for every setting; storagectl and storageattach only
+        # take one controller or disk each, so those stay a run apiece
+        s = edit.settings
+        flags = []
+        if 'memory' in s:
+            flags += ['--memory', str(s['memory'])]
+        if 'vram' in s:
+            flags += ['--vram', str(s['vram'])]
+        if 'rtc_utc' in s:
+            flags += ['--rtcuseutc', _on_off(s['rtc_utc'])]
+        if 'mouse' in s:
+            flags += ['--mouse', s['mouse']]
+        if 'keyboard' in s:
+            flags += ['--keyboard', s['keyboard']]
+        if 'usb' in s:
+            flags += ['--usb', _on_off(s['usb'])]
+        if 'audio' in s:
+            flags += ['--audio', s['audio'] or 'none']
+        if s.get('nat'):
+            flags += ['--nic1', 'nat']
+        for rule in s.get('nat_forwards', []):
+            flags += ['--natpf1', ','.join(str(f) for f in rule)]
+        if s.get('serial_log'):
+            flags += ['--uart1', '0x3F8', '4', '--uartmode1', 'file', s['serial_log']]
+        elif 'serial_log' in s:
+            flags += ['--uart1', 'off']
+        if flags:
+            self.run(['modifyvm', edit.name] + flags)
+
+        for c in edit.controllers:
+            self.run(['storagectl', edit.name, '--name', c['name'],
+                      '--add', c['bus'], '--controller', c['controller'],
+                      '--portcount', str(c['ports']), '--hostiocache', _on_off(c['host_io_cache']),
+                      '--bootable', _on_off(c['bootable'])])
+        for a in edit.attachments:
+            self.run(['storageattach', edit.name, '--storagectl', a['controller'],
+                      '--port', str(a['port']), '--type', a['kind'], '--medium', a['medium']])
+
+    def vm_exists (self, name):
+        from subprocess import call
+        with self.timed('vm_exists', name):
+            with open(os.devnull, 'wb') as devnull:
+                return call([self.cmd, 'showvminfo', name, '--machinereadable'],
+                            stdout=devnull, stderr=devnull) == 0
+
+    def start (self, name):
+        from subprocess import Popen
+        with self.timed('start', name):
+            return Popen([self.headless, '-s', name])
+
+    def power_button (self, name):
+        from subprocess import call
+        with self.timed('power_button', name):
+            call([self.cmd, 'controlvm', name, 'acpipowerbutton'])
+
+    def power_off (self, name):
+        from subprocess import call
+        with self.timed('power_off', name):
+            call([self.cmd, 'controlvm', name, 'poweroff'])
+
+    def export (self, name, filename):
+        with self.timed('export', name):
+            self.run(['export', name, '--output', filename])
+
+    def unregister (self, name, delete=True):
+        with self.timed('unregister', name):
+            self.run(['unregistervm', name] + (['--delete'] if delete else []))
+
+    def convert_from_raw (self, vdi, raw_path=None, size=None, data=None):
+        from subprocess import CalledProcessError, PIPE, Popen
+        with self.timed('convert_from_raw', vdi):
+            if raw_path is not None:
+                self.run(['convertfromraw', raw_path, vdi, '--format', 'VDI'])
+                return
+            # convertfromraw can't learn the size of stdin
+            cmd = [self.cmd, 'convertfromraw', 'stdin', vdi, str(size), '--format', 'VDI']
+            if hasattr(data, 'fileno'):
+                proc = Popen(cmd, stdin=data)
+                data.close() # the child has its own copy
+                rc = proc.wait()
+            else:
+                proc = Popen(cmd, stdin=PIPE)
+                try:
+                    for chunk in data:
+                        proc.stdin.write(chunk)
+                except IOError as e:
+                    if e.errno != errno.EPIPE:
+                        raise
+                    # VBoxManage quit early; its exit status says why
+                finally:
+                    try:
+                        proc.stdin.close()
+                    except IOError:
+                        pass
+                    rc = proc.wait()
+            if rc != 0:
+                raise CalledProcessError(rc, cmd)
+
+    def resize_disk (self, vdi, megabytes):
+        with self.timed('resize_disk', vdi):
+            self.run(['modifyhd', vdi, '--resize', str(megabytes)])
+
+    def create_diff_disk (self, path, parent):
+        with self.timed('create_diff_disk', path):
+            self.run(['createmedium', 'disk', '--filename', path,
+                      '--diffparent', parent, '--format', 'VDI'])
+
+    def close_medium (self, path):
+        from subprocess import call
+        with self.timed('close_medium', path):
+            return call([self.cmd, 'closemedium', 'disk', path]) == 0
+
+    def disk_locations (self):
+        from subprocess import check_output
+        with self.timed('disk_locations'):
+            listing = check_output([self.cmd, 'list', 'hdds']).decode('utf-8', 'replace')
+        return [line.split(':', 1)[1].strip() for line in listing.splitlines()
+                if line.startswith('Location:')]
+
+def _on_off (flag):
+    return 'on' if flag else 'off'
+
+def _api_version (version):
+    # '7.0.14_Ubuntu r161095' -> (7, 0)
+    match = re.match(r"(\d+)\.(\d+)", version)
+    if match is None:
+        raise RuntimeError("Unknown VirtualBox version: {}".format(version))
+    return int(match.group(1)), int(match.group(2))
+
+
+class ApiBackend (Backend):
+    """Uses the VirtualBox Python API, from the SDK's vboxapi package.
+
+    The API changes between VirtualBox releases, so what it's called with
+    depends on the version; releases newer than API_VERSIONS aren't used
+    at all, and a setting the API turns out not to have is applied with
+    VBoxManage instead.
+    """
+    name = 'api'
+    # the oldest release supported, and the first that isn't
+    API_VERSIONS = ((5, 0), (7, 2))
+    _manager = None
+    _owner = None
+    _manager_lock = threading.Lock()
+
+    def __init__ (self):
+        Backend.__init__(self)
+        with self._manager_lock:
+            if ApiBackend._manager is None:
+                from vboxapi import VirtualBoxManager
+                ApiBackend._manager = VirtualBoxManager(None, None)
+                ApiBackend._owner = threading.current_thread().ident
+        self.mgr = ApiBackend._manager
+        self.c = self.mgr.constants
+        self.threads = threading.local()
+        self.owner = ApiBackend._owner
+        self.version = _api_version(self.vbox.version)
+        oldest, newest = self.API_VERSIONS
+        if not oldest <= self.version < newest:
+            err = "VirtualBox {} isn't supported by the API backend; use --backend vboxmanage"
+            raise RuntimeError(err.format(self.vbox.version))
+
+    @property
+    def vbox (self):
+        # every thread but the one that made the manager attaches itself
+        if not getattr(self.threads, 'ready', False):
+            if threading.current_thread().ident != self.owner:
+                self.mgr.initPerThread()
+            self.threads.ready = True
+        return self.mgr.getVirtualBox()
+
+    def _wait (self, progress):
+        progress.waitForCompletion(-1)
+        if progress.resultCode != 0:
+            raise RuntimeError(progress.errorInfo.text if progress.errorInfo else
+                               "VirtualBox operation failed: {:#x}".format(progress.resultCode))
+
+    def _open_disk (self, path, kind='hdd'):
+        c = self.c
+        device = c.DeviceType_HardDisk if kind == 'hdd' else c.DeviceType_DVD
+        access = c.AccessMode_ReadWrite if kind == 'hdd' else c.AccessMode_ReadOnly
+        return self.vbox.openMedium(path, device, access, False)
+
+    def create_vm (self, name, os_type):
+        with self.timed('create_vm', name):
+            if self.version >= (7, 1):
+                # the platform came first; and the encryption arguments
+                machine = self.vbox.createMachine('', name, self.c.PlatformArchitecture_x86,
+                                                  [], os_type, '', '', '', '')
+            elif self.version >= (7, 0):
+                machine = self.vbox.createMachine('', name, [], os_type, '', '', '', '')
+            else:
+                machine = self.vbox.createMachine('', name, [], os_type, '')
+            machine.saveSettings()
+            self.vbox.registerMachine(machine)
+
+    def apply (self, edit):
+        c = self.c
+        session = self.mgr.getSessionObject()
+        self.vbox.findMachine(edit.name).lockMachine(session, c.LockType_Write)
+        fallback = False
+        try:
+            self._apply(session.machine, edit)
+        except AttributeError:
+            # not in this version's API, after all; nothing was saved
+            session.machine.discardSettings()
+            fallback = True
+        finally:
+            session.unlockMachine()
+        if fallback:
+            self._cli().apply(edit)
+
+    def _apply (self, m, edit):
+        c = self.c
+        v = self.version
+        s = edit.settings
+        if 'memory' in s:
+            m.memorySize = s['memory']
+        if 'vram' in s:
+            (m.graphicsAdapter if v >= (6, 1) else m).VRAMSize = s['vram']
+        if 'rtc_utc' in s:
+            (m.platform if v >= (7, 1) else m).RTCUseUTC = bool(s['rtc_utc'])
+        if s.get('mouse') == 'ps2':
+            m.pointingHIDType = c.PointingHIDType_PS2Mouse
+        if s.get('keyboard') == 'ps2':
+            m.keyboardHIDType = c.KeyboardHIDType_PS2Keyboard
+        if 'usb' in s:
+            controllers = list(m.USBControllers)
+            if not s['usb']:
+                for ctl in controllers:
+                    m.removeUSBController(ctl.name)
+            elif not controllers:
+                m.addUSBController('OHCI', c.USBControllerType_OHCI)
+        if 'audio' in s:
+            (m.audioSettings.adapter if v >= (7, 0) else m.audioAdapter).enabled = bool(s['audio'])
+        if s.get('nat'):
+            nic = m.getNetworkAdapter(0)
+            nic.enabled = True
+            nic.attachmentType = c.NetworkAttachmentType_NAT
+            for name, proto, host_ip, host_port, guest_ip, guest_port in s.get('nat_forwards', []):
+                proto = c.NATProtocol_TCP if proto == 'tcp' else c.NATProtocol_UDP
+                nic.NATEngine.addRedirect(name, proto, host_ip, int(host_port),
+                                          guest_ip, int(guest_port))
+        if s.get('serial_log'):
+            port = m.getSerialPort(0)
+            port.enabled = True
+            port.IOBase = 0x3F8
+            port.IRQ = 4
+            port.path = s['serial_log']
+            port.hostMode = c.PortMode_RawFile
+        elif 'serial_log' in s:
+            m.getSerialPort(0).enabled = False
+
+        for ctl in edit.controllers:
+            bus = getattr(c, 'StorageBus_' + ctl['bus'].upper())
+            sc = m.addStorageController(ctl['name'], bus)
+            if ctl['controller'] == 'IntelAhci':
+                sc.controllerType = c.StorageControllerType_IntelAhci
+            sc.portCount = ctl['ports']
+            sc.useHostIOCache = bool(ctl['host_io_cache'])
+            sc.bootable = bool(ctl['bootable'])
+        for a in edit.attachments:
+            device = c.DeviceType_HardDisk if a['kind'] == 'hdd' else c.DeviceType_DVD
+            m.attachDevice(a['controller'], a['port'], 0, device,
+                           self._open_disk(a['medium'], a['kind']))
+        m.saveSettings()
+
+    def vm_exists (self, name):
+        with self.timed('vm_exists', name):
+            try:
+                self.vbox.findMachine(name)
+                return True
+            except Exception:
+                return False
+
+    def start (self, name):
+        with self.timed('start', name):
+            session = self.mgr.getSessionObject()
+            machine = self.vbox.findMachine(name)
+            self._wait(machine.launchVMProcess(session, 'headless', ''))
+            return _ApiVm(self, machine, session)
+
+    def _console (self, name):
+        session = self.mgr.getSessionObject()
+        self.vbox.findMachine(name).lockMachine(session, self.c.LockType_Shared)
+        return session
+
+    def power_button (self, name):
+        with self.timed('power_button', name):
+            session = self._console(name)
+            try:
+                session.console.powerButton()
+            finally:
+                session.unlockMachine()
+
+    def power_off (self, name):
+        with self.timed('power_off', name):
+            session = self._console(name)
+            try:
+                self._wait(session.console.powerDown())
+            finally:
+                session.unlockMachine()
+
+    def export (self, name, filename):
+        with self.timed('export', name):
+            appliance = self.vbox.createAppliance()
+            self.vbox.findMachine(name).exportTo(appliance, filename)
+            self._wait(appliance.write('ovf-1.0', [], filename))
+
+    def unregister (self, name, delete=True):
+        with self.timed('unregister', name):
+            machine = self.vbox.findMachine(name)
+            media = machine.unregister(self.c.CleanupMode_DetachAllReturnHardDisksOnly)
+            if delete:
+                self._wait(machine.deleteConfig(media))
+
+    def convert_from_raw (self, vdi, raw_path=None, size=None, data=None):
+        # the API can't read a raw image; the command line does it
+        self._cli().convert_from_raw(vdi, raw_path, size, data)
+
+    def _cli (self):
+        cli = VBoxManageBackend()
+        cli.calls = self.calls
+        cli._calls_lock = self._calls_lock
+        return cli
+
+    def resize_disk (self, vdi, megabytes):
+        with self.timed('resize_disk', vdi):
+            medium = self._open_disk(vdi)
+            self._wait(medium.resize(megabytes * 1024 * 1024))
+
+    def create_diff_disk (self, path, parent):
+        c = self.c
+        with self.timed('create_diff_disk', path):
+            base = self._open_disk(parent)
+            child = self.vbox.createMedium('VDI', path, c.AccessMode_ReadWrite, c.DeviceType_HardDisk)
+            self._wait(base.createDiffStorage(child, [c.MediumVariant_Standard]))
+
+    def close_medium (self, path):
+        with self.timed('close_medium', path):
+            try:
+                self._open_disk(path).close()
+                return True
+            except Exception:
+                return False # still attached, or a parent
+
+    def disk_locations (self):
+        with self.timed('disk_locations'):
+            found = []
+            todo = list(self.vbox.hardDisks)
+            while todo:
+                medium = todo.pop()
+                found.append(medium.location)
+                todo.extend(medium.children)
+            return found
+
+class _ApiVm (object):
+    # a running VM, looking enough like a Popen for boot.run_vm
+    def __init__ (self, backend, machine, session):
+        self.backend = backend
+        self.machine = machine
+        self.session = session
+        self.returncode = None
+
+    def poll (self):
+        if self.returncode is None:
+            c = self.backend.c
+            if self.machine.state in (c.MachineState_PoweredOff, c.MachineState_Aborted):
+                self.returncode = 0 if self.machine.state == c.MachineState_PoweredOff else 1
+                try:
+                    self.session.unlockMachine()
+                except Exception:
+                    pass
+        return self.returncode
+
+    def wait (self):
+        while self.poll() is None:
+            time.sleep(0.5)
+        return self.returncode
+
+
+class FakeBackend (Backend):
+    """Does each operation's bookkeeping without VirtualBox.
+
+    Guests "boot" for boot_seconds, then report that cloud-init finished on
+    their serial log, and power off when the power button is pressed.  Disk
+    images are real VDI files, but with no blocks allocated, so that the
+    rest of the pipeline can read them.
+    """
+    name = 'fake'
+
+    def __init__ (self, boot_seconds=0.5):
+        Backend.__init__(self)
+        self.boot_seconds = boot_seconds
+        self.vms = {}
+        self.lock = threading.Lock()
+
+    def create_vm (self, name, os_type):
+        with self.timed('create_vm', name):
+            with self.lock:
+                if name in self.vms:
+                    raise RuntimeError("VM {} already exists".format(name))
+                self.vms[name] = dict(os_type=os_type, settings={}, attachments=[])
+
+    def apply (self, edit):
+        with self.lock:
+            self.vms[edit.name]['settings'].update(edit.settings)
+        # recorded one by one, as VBoxManage would run them
+        for a in edit.attachments:
+            with self.timed('storage_attach', edit.name, a['medium']):
+                with self.lock:
+                    self.vms[edit.name]['attachments'].append(a)
+
+    def vm_exists (self, name):
+        with self.timed('vm_exists', name):
+            return name in self.vms
+
+    def start (self, name):
+        with self.timed('start', name):
+            return _FakeVm(self.vms[name], self.boot_seconds)
+
+    def power_button (self, name):
+        with self.timed('power_button', name):
+            self.vms[name]['off'] = True
+
+    def power_off (self, name):
+        with self.timed('power_off', name):
+            self.vms[name]['off'] = True
+
+    def export (self, name, filename):
+        with self.timed('export', name):
+            with open(filename, 'wb') as f:
+                f.write(b'fake OVA of ' + name.encode('utf-8') + b'\n')
+
+    def unregister (self, name, delete=True):
+        with self.timed('unregister', name):
+            with self.lock:
+                vm = self.vms.pop(name)
+            if delete:
+                for a in vm['attachments']:
+                    if a['kind'] == 'hdd' and os.path.exists(a['medium']):
+                        os.unlink(a['medium'])
+
+    def convert_from_raw (self, vdi, raw_path=None, size=None, data=None):
+        from . import vdi as vdi_format
+        with self.timed('convert_from_raw', vdi):
+            if raw_path is not None:
+                size = os.path.getsize(raw_path)
+            elif hasattr(data, 'read'):
+                while data.read(1024 * 1024):
+                    pass
+            else:
+                for _ in data:
+                    pass
+            vdi_format.write_empty(vdi, vdi_format.VdiHeader(vdi_format.TYPE_DYNAMIC, size))
+
+    def resize_disk (self, vdi, megabytes):
+        from . import vdi as vdi_format
+        with self.timed('resize_disk', vdi):
+            with open(vdi, 'rb') as f:
+                header = vdi_format.VdiHeader.read(f, vdi)
+            vdi_format.write_empty(vdi, vdi_format.VdiHeader(
+                header.image_type, megabytes * 1024 * 1024, header.block_size,
+                uuid_create=header.uuid_create))
+
+    def create_diff_disk (self, path, parent):
+        from . import vdi as vdi_format
+        with self.timed('create_diff_disk', path):
+            vdi_format.create_diff(path, parent)
+
+    def close_medium (self, path):
+        with self.timed('close_medium', path):
+            with self.lock:
+                return not any(a['medium'] == path for vm in self.vms.values()
+                               for a in vm['attachments'])
+
+    def disk_locations (self):
+        with self.timed('disk_locations'):
+            with self.lock:
+                return [a['medium'] for vm in self.vms.values() for a in vm['attachments']]
+
+class _FakeVm (object):
+    def __init__ (self, vm, boot_seconds):
+        from .boot import DONE_MARKER
+        self.marker = DONE_MARKER
+        self.vm = vm
+        self.started = time.time()
+        self.boot_seconds = boot_seconds
+        self.serial_log = vm['settings'].get('serial_log')
+        self.booted = False
+        self.returncode = None
+        vm['off'] = False
+
+    def poll (self):
+        if not self.booted and time.time() - self.started >= self.boot_seconds:
+            self.booted = True
+            if self.serial_log:
+                with open(self.serial_log, 'a') as f:
+                    f.write(self.marker + '\n')
+        if self.booted and self.returncode is None and self.vm['off']:
+            self.returncode = 0
+        return self.returncode
+
+    def wait (self):
+        while self.poll() is None:
+            time.sleep(0.05)
+        return self.returncode
+
+
+BACKENDS = ('auto', 'vboxmanage', 'api', 'fake')
+
+def get_backend (name='auto'):
+    if name == 'fake':
+        return FakeBackend()
+    if name == 'vboxmanage':
+        return VBoxManageBackend()
+    try:
+        return ApiBackend()
+    except Exception:
+        # ImportError without the SDK, or whatever else vboxapi raises
+        # when VirtualBox itself isn't usable
+        if name == 'api':
+            raise
+        return VBoxManageBackend()
@@ -0,0 +1,194 @@
+# vim: fileencoding=utf-8
+"""Build OVAs for many hosts at once.
+
+Each host gets its own copy of the options: its name, public key, a free
+forwarded SSH port, and a tempdir.  Builds mostly wait on VirtualBox, so they
+run on threads, as many at a time as the host's memory and CPUs allow.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import copy
+import errno
+import os
+import os.path
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from . import app
+
+# what VirtualBox itself needs per VM, beyond the guest's memory
+VM_OVERHEAD_MB = 128
+# left over for the host while the builds run
+HOST_RESERVE_MB = 512
+
+def read_batch (path):
+    """Read (hostname, pubkey_path or None) pairs from the file at path (or
+    stdin for '-'): one host per line, then optionally its key's path."""
+    if path == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        lines = app.read_file(path).splitlines()
+    hosts = []
+    seen = set()
+    for number, line in enumerate(lines, 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        fields = line.split(None, 1)
+        host = fields[0]
+        if host in seen:
+            raise ValueError("{}:{}: host {} is listed twice".format(path, number, host))
+        seen.add(host)
+        hosts.append((host, fields[1].strip() if len(fields) > 1 else None))
+    if not hosts:
+        raise ValueError("No hosts listed in {}".format(path))
+    return hosts
+
+def host_memory_mb ():
+    # memory available for new VMs, or None if this OS won't say
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // (1024*1024)
+    except (AttributeError, ValueError, OSError):
+        pass
+    if sys.platform == 'darwin':
+        from subprocess import check_output, CalledProcessError
+        try:
+            return int(check_output(['sysctl', '-n', 'hw.memsize'])) // (1024*1024)
+        except (CalledProcessError, OSError, ValueError):
+            pass
+    return None
+
+def default_jobs (memory_mb, hosts):
+    """How many VMs to run at once: one per CPU, as far as memory allows."""
+    from .pool import cpu_count
+    jobs = cpu_count()
+    available = host_memory_mb()
+    if available is not None:
+        jobs = min(jobs, (available - HOST_RESERVE_MB) // (memory_mb + VM_OVERHEAD_MB))
+    return max(1, min(jobs, hosts))
+
+
+class PortAllocator (object):
+    """Hands out forwarded ports, from first up, that no other build of
+    this batch holds and that nothing on the host is listening on."""
+    def __init__ (self, first, last=65535):
+        self.first = first
+        self.last = last
+        self.held = set()
+        self.lock = threading.Lock()
+
+    def acquire (self):
+        with self.lock:
+            for port in range(self.first, self.last + 1):
+                if port not in self.held and port_is_free(port):
+                    self.held.add(port)
+                    return port
+        raise RuntimeError("No free port from {} to {}".format(self.first, self.last))
+
+    def release (self, port):
+        with self.lock:
+            self.held.discard(port)
+
+def port_is_free (port, host='127.0.0.1'):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind((host, port))
+        return True
+    except socket.error as e:
+        if e.errno in (errno.EADDRINUSE, errno.EACCES):
+            return False
+        raise
+    finally:
+        s.close()
+
+
+class HostResult (object):
+    __slots__ = ('host', 'port', 'ova', 'seconds', 'error')
+
+    def __init__ (self, host):
+        self.host = host
+        self.port = None
+        self.ova = None
+        self.seconds = 0.0
+        self.error = None
+
+
+def host_options (options, host, pubkey):
+    """A copy of the options for building one host, checked like a single
+    build's options."""
+    o = copy.copy(options)
+    o.batch = None
+    o.name = host
+    if pubkey is not None:
+        o.pubkey = pubkey
+    if options.tmpdir is not None:
+        o.tmpdir = os.path.join(options.tmpdir, host)
+    app.check_options(o)
+    return o
+
+def build_host (options, ports, result):
+    start = time.time()
+    try:
+        options.sshport = result.port = ports.acquire()
+        try:
+            result.ova = app.run_build(options)
+        finally:
+            ports.release(options.sshport)
+    except Exception as e:
+        result.error = "{}: {}".format(type(e).__name__, e)
+        traceback.print_exc()
+    result.seconds = time.time() - start
+
+def run_batch (host_opts, jobs, first_port):
+    """Build every host's OVA, jobs at a time; return their HostResults."""
+    ports = PortAllocator(first_port)
+    results = [HostResult(o.name) for o in host_opts]
+    todo = list(zip(host_opts, results))
+    todo_lock = threading.Lock()
+
+    def worker ():
+        while True:
+            with todo_lock:
+                if not todo:
+                    return
+                o, result = todo.pop(0)
+            build_host(o, ports, result)
+
+    threads = [threading.Thread(target=worker, name="fedora2ova-{}".format(i))
+               for i in range(jobs)]
+    for t in threads:
+        t.daemon = True # so ^C doesn't wait for VirtualBox
+        t.start()
+    for t in threads:
+        # join with a timeout, which KeyboardInterrupt can interrupt
+        while t.is_alive():
+            t.join(1.0)
+    return results
+
+def report (results, seconds, out=sys.stdout):
+    print("\n{:<24} {:>6} {:>9}  {}".format('host', 'port', 'seconds', 'result'), file=out)
+    for r in results:
+        print("{:<24} {:>6} {:>9.1f}  {}".format(
+            r.host, r.port or '-', r.seconds, r.error or r.ova or 'no OVA created'), file=out)
+    failed = sum(1 for r in results if r.error or not r.ova)
+    print("{} hosts built, {} failed, in {:.1f}s".format(len(results) - failed, failed, seconds), file=out)
+    return failed
+
+def main_batch (options):
+    host_opts = [host_options(options, host, pubkey)
+                 for host, pubkey in read_batch(options.batch)]
+    jobs = options.jobs or default_jobs(options.memory, len(host_opts))
+    print("Building {} hosts, {} at a time".format(len(host_opts), jobs))
+    start = time.time()
+    results = run_batch(host_opts, jobs, options.sshport)
+    return 1 if report(results, time.time() - start) else 0
@@ -0,0 +1,79 @@
+# vim: fileencoding=utf-8
+"""Run the VM until cloud-init has configured it.
+
+The guest writes DONE_MARKER to its first serial port once cloud-init has
+finished, and VirtualBox logs that port to a file; as soon as the marker
+shows up there, the guest is asked to power off.  The guest's own scheduled
+shutdown stays as a fallback for images that never write the marker.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import time
+
+DONE_MARKER = 'FEDORA2OVA_CLOUD_INIT_DONE'
+
+class SerialLog (object):
+    """Reads what the guest writes to the serial log, as it grows."""
+    def __init__ (self, path, marker=DONE_MARKER):
+        self.path = path
+        self.marker = marker.encode('ascii')
+        self.offset = 0
+        self.tail = b''
+
+    def seen (self):
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset, os.SEEK_SET)
+                data = f.read()
+        except (IOError, OSError):
+            return False # VirtualBox hasn't created it yet
+        self.offset += len(data)
+        # the marker may be split across two reads
+        data = self.tail + data
+        self.tail = data[-len(self.marker):]
+        return self.marker in data
+
+def run_vm (backend, vm_name, serial_log, timeout=None, grace=60.0, poll=0.5):
+    """Boot the VM and wait for it to power off.  Return True if the guest
+    reported that cloud-init finished, or False if it shut down on its own.
+
+    Raises RuntimeError if the guest is still running after timeout seconds,
+    after powering it off.
+    """
+    # an earlier boot's marker doesn't count
+    try:
+        os.unlink(serial_log)
+    except OSError:
+        pass
+    log = SerialLog(serial_log)
+    start = time.time()
+    finished_at = None
+    forced = False
+    proc = backend.start(vm_name)
+    try:
+        while proc.poll() is None:
+            now = time.time()
+            if finished_at is None and log.seen():
+                finished_at = now
+                print("cloud-init finished after {:.1f}s; shutting down".format(now - start))
+                backend.power_button(vm_name)
+            elif finished_at is not None and not forced and now - finished_at > grace:
+                # the guest ignored the power button
+                forced = True
+                backend.power_off(vm_name)
+            elif finished_at is None and timeout and now - start > timeout:
+                err = "Guest {} didn't finish cloud-init within {}s"
+                raise RuntimeError(err.format(vm_name, timeout))
+            time.sleep(poll)
+    except BaseException:
+        if proc.poll() is None:
+            backend.power_off(vm_name)
+            proc.wait()
+        raise
+
+    if proc.returncode != 0 and not forced:
+        err = "VM {} stopped with status {}"
+        raise RuntimeError(err.format(vm_name, proc.returncode))
+    # the guest may have finished right before its fallback shutdown
+    return finished_at is not None or log.seen()
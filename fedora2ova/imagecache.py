@@ -0,0 +1,227 @@
+# vim: fileencoding=utf-8
+"""Converted, resized base disks, reused between builds.
+
+Each entry is a VDI named by the hash of its source image and the target
+disk size.  Builds attach a differencing disk on top of the base, so the
+base itself is never written after it is made.
+
+The cidata ISOs of recent builds are kept here too, named by the hash of
+their files, so that rebuilding a host reuses its ISO.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import hashlib
+import json
+import os
+import os.path
+import sys
+import tempfile
+import threading
+import time
+
+from cloud_maker.util import file_digest, mtime_key
+
+ENTRY_SUFFIX = '.vdi'
+ISO_SUFFIX = '.iso'
+# ISOs are tiny, so they're kept by age rather than size
+ISO_MAX_AGE = 30 * 86400
+HASHES_FILE = 'hashes.json'
+# bump this to stop using every existing entry after a format change
+CACHE_FORMAT = 1
+
+_replace = getattr(os, 'replace', os.rename)
+
+def default_cache_dir ():
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'cloud-maker', 'fedora2ova')
+
+class ImageCache (object):
+    """A directory of base VDIs, evicted least recently used first.
+
+    max_size is in bytes (of disk actually used), or None for no limit.
+    backend (see backend.py) is asked to let go of evicted disks.
+    """
+    path = None
+    max_size = None
+    # held while fetching or storing an entry, by builds in one process
+    lock = threading.Lock()
+    # held while hashing an image, so that a batch's builds hash it once
+    digest_lock = threading.Lock()
+
+    def __init__ (self, path, max_size=None, backend=None):
+        self.path = path
+        self.max_size = max_size
+        self.backend = backend
+
+    def image_digest (self, image):
+        # hashing a multi-GB image takes a while, so remember the hashes of
+        # unchanged files, like make_provisioner's digest cache
+        with self.digest_lock:
+            st = os.stat(image)
+            memo_key = "{}:{}:{}".format(os.path.realpath(image), st.st_size, mtime_key(st))
+            memo_path = os.path.join(self.path, HASHES_FILE)
+            try:
+                with open(memo_path, 'r') as f:
+                    memo = json.load(f)
+            except (IOError, OSError, ValueError):
+                memo = {}
+            digest = memo.get(memo_key)
+            if digest is None:
+                digest = file_digest(image)
+                memo[memo_key] = digest
+                self._ensure_dir()
+                fd, tmp_name = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(memo, f)
+                _replace(tmp_name, memo_path)
+            return digest
+
+    def key (self, image, imagesize=None):
+        h = hashlib.sha256()
+        h.update("fedora2ova base {}\n{}\n{}\n".format(
+            CACHE_FORMAT, self.image_digest(image), imagesize or '-').encode('utf-8'))
+        return h.hexdigest()
+
+    def config_key (self, files):
+        # files: the ISO's (name, bytes), which depend on the host, its keys,
+        # and the templates
+        h = hashlib.sha256()
+        h.update("fedora2ova cidata {}\n".format(CACHE_FORMAT).encode('utf-8'))
+        for name, data in files:
+            h.update("{}\n{}\n".format(name, len(data)).encode('utf-8'))
+            h.update(data)
+        return h.hexdigest()
+
+    def fetch_iso (self, key):
+        """Return the cached ISO's bytes for key, or None."""
+        path = os.path.join(self.path, key + ISO_SUFFIX)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        os.utime(path, None)
+        return data
+
+    def store_iso (self, key, data):
+        self._ensure_dir()
+        fd, tmp_name = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        _replace(tmp_name, os.path.join(self.path, key + ISO_SUFFIX))
+        self.evict_isos()
+
+    def evict_isos (self, max_age=ISO_MAX_AGE):
+        removed = []
+        cutoff = time.time() - max_age
+        for name in os.listdir(self.path) if os.path.isdir(self.path) else []:
+            path = os.path.join(self.path, name)
+            try:
+                if name.endswith(ISO_SUFFIX) and os.stat(path).st_mtime < cutoff:
+                    os.unlink(path)
+                    removed.append(path)
+            except OSError:
+                pass
+        return removed
+
+    def entry_path (self, key):
+        return os.path.join(self.path, key + ENTRY_SUFFIX)
+
+    def fetch (self, key):
+        """Return the base VDI for key, or None if it isn't cached."""
+        entry = self.entry_path(key)
+        if not os.path.isfile(entry):
+            return None
+        os.utime(entry, None) # for LRU eviction
+        return entry
+
+    def store (self, key, builder):
+        """Run builder(dirname) to create a VDI in dirname, returning its
+        path; keep it as the entry for key, and return the entry's path."""
+        self._ensure_dir()
+        workdir = tempfile.mkdtemp(prefix='build-', dir=self.path)
+        try:
+            built = builder(workdir)
+            _replace(built, self.entry_path(key))
+        finally:
+            for name in os.listdir(workdir):
+                os.unlink(os.path.join(workdir, name))
+            os.rmdir(workdir)
+        self.evict(keep=self.entry_path(key))
+        return self.entry_path(key)
+
+    def _ensure_dir (self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def entries (self):
+        """List (path, stat) of every entry, least recently used first."""
+        found = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return found
+        for name in names:
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            entry = os.path.join(self.path, name)
+            try:
+                found.append((entry, os.stat(entry)))
+            except OSError:
+                pass
+        found.sort(key=lambda e: e[1].st_mtime)
+        return found
+
+    def evict (self, keep=None, max_size=None):
+        """Remove entries, oldest first, until they fit in max_size bytes
+        (the cache's own limit by default).  Bases that VirtualBox still has
+        differencing disks on are skipped."""
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return []
+        entries = self.entries()
+        total = sum(disk_usage(st) for _, st in entries)
+        registered = None
+        removed = []
+        for entry, st in entries:
+            if total <= max_size:
+                break
+            if entry == keep:
+                continue
+            if registered is None:
+                registered = self.registered_media()
+            if os.path.realpath(entry) in registered and not self.backend.close_medium(entry):
+                continue # still the parent of some VM's disk
+            try:
+                os.unlink(entry)
+            except OSError:
+                continue
+            total -= disk_usage(st)
+            removed.append(entry)
+        return removed
+
+    def registered_media (self):
+        # the real paths of every disk VirtualBox knows about
+        if self.backend is None:
+            return set()
+        return set(os.path.realpath(path) for path in self.backend.disk_locations())
+
+    def report (self, out=sys.stdout):
+        entries = self.entries()
+        print("{:<68} {:>14} {:>14}  {}".format('entry', 'disk bytes', 'virtual bytes', 'last used'), file=out)
+        for entry, st in reversed(entries):
+            print("{:<68} {:>14,} {:>14,}  {}".format(
+                os.path.basename(entry), disk_usage(st), st.st_size,
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(st.st_mtime))), file=out)
+        print("{} entries, {:,} bytes on disk, in {}".format(
+            len(entries), sum(disk_usage(st) for _, st in entries), self.path), file=out)
+
+def disk_usage (st):
+    # VDIs are sparse files, so count the blocks, where the OS says
+    blocks = getattr(st, 'st_blocks', None)
+    if blocks is None:
+        return st.st_size
+    return blocks * 512
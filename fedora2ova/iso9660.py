@@ -0,0 +1,218 @@
+# vim: fileencoding=utf-8
+"""A minimal ISO9660 image writer, for cloud-init's cidata disc.
+
+Writes a single root directory of regular files, in three namespaces: plain
+ISO9660 names, Joliet (UCS-2) names, and Rock Ridge names and permissions,
+so that every guest sees the files by their real names.  The whole image is
+built in memory; it's only a few sectors long.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import re
+import struct
+import time
+
+SECTOR = 2048
+# sectors 0-15 are the system area; descriptors start at 16
+FIRST_DESCRIPTOR = 16
+
+RRIP_ID = b'RRIP_1991A'
+RRIP_DESCRIPTOR = b'THE ROCK RIDGE INTERCHANGE PROTOCOL PROVIDES SUPPORT FOR POSIX FILE SYSTEM SEMANTICS'
+RRIP_SOURCE = (b'PLEASE CONTACT DISC PUBLISHER FOR SPECIFICATION SOURCE.  '
+               b'SEE PUBLISHER IDENTIFIER IN PRIMARY VOLUME DESCRIPTOR FOR CONTACT INFORMATION.')
+FILE_MODE = 0o100444
+DIR_MODE = 0o040555
+
+def both16 (n):
+    return struct.pack('<H', n) + struct.pack('>H', n)
+
+def both32 (n):
+    return struct.pack('<I', n) + struct.pack('>I', n)
+
+def _pad (data, size, fill=b' '):
+    if len(data) > size:
+        raise ValueError("Identifier too long: {!r}".format(data))
+    return data + (fill * size)[:size - len(data)]
+
+def _sectors (size):
+    return (size + SECTOR - 1) // SECTOR
+
+def record_date (t):
+    # the 7-byte date of a directory record, in UTC
+    tm = time.gmtime(t)
+    return struct.pack('7B', tm.tm_year - 1900, tm.tm_mon, tm.tm_mday,
+                       tm.tm_hour, tm.tm_min, tm.tm_sec, 0)
+
+def volume_date (t):
+    # the 17-byte date of a volume descriptor, in UTC
+    return time.strftime('%Y%m%d%H%M%S00', time.gmtime(t)).encode('ascii') + b'\0'
+
+def primary_name (name):
+    # ISO9660 level 2: d-characters, one dot, and a version number
+    base, dot, ext = name.upper().rpartition('.')
+    if not dot:
+        base, ext = ext, ''
+    base = re.sub(r'[^A-Z0-9_]', '_', base)[:30 - len(ext)]
+    ext = re.sub(r'[^A-Z0-9_]', '_', ext)
+    return (base + '.' + ext + ';1').encode('ascii')
+
+def joliet_name (name):
+    return (name + ';1').encode('utf-16-be')
+
+
+class _Susp (object):
+    # System Use Sharing Protocol entries, for Rock Ridge
+    @staticmethod
+    def entry (sig, data):
+        return sig + struct.pack('BB', 4 + len(data), 1) + data
+
+    @classmethod
+    def sp (cls):
+        return cls.entry(b'SP', b'\xbe\xef\0')
+
+    @classmethod
+    def ce (cls, lba, offset, length):
+        return cls.entry(b'CE', both32(lba) + both32(offset) + both32(length))
+
+    @classmethod
+    def er (cls):
+        return cls.entry(b'ER', struct.pack('4B', len(RRIP_ID), len(RRIP_DESCRIPTOR), len(RRIP_SOURCE), 1)
+                         + RRIP_ID + RRIP_DESCRIPTOR + RRIP_SOURCE)
+
+    @classmethod
+    def px (cls, mode, nlink):
+        return cls.entry(b'PX', both32(mode) + both32(nlink) + both32(0) + both32(0))
+
+    @classmethod
+    def tf (cls, t):
+        # modify, access, and attribute-change times
+        return cls.entry(b'TF', b'\x0e' + record_date(t) * 3)
+
+    @classmethod
+    def nm (cls, name):
+        return cls.entry(b'NM', b'\0' + name.encode('utf-8'))
+
+
+def dir_record (ident, lba, size, t, is_dir=False, system_use=b''):
+    head = 33 + len(ident)
+    pad = b'\0' if head % 2 else b''
+    length = head + len(pad) + len(system_use)
+    if length > 255:
+        raise ValueError("Directory record too long for {!r}".format(ident))
+    return (struct.pack('BB', length, 0) + both32(lba) + both32(size) + record_date(t)
+            + struct.pack('BBB', 2 if is_dir else 0, 0, 0) + both16(1)
+            + struct.pack('B', len(ident)) + ident + pad + system_use)
+
+def pack_directory (records):
+    """Lay out records in sectors; a record never crosses a sector boundary."""
+    out = bytearray()
+    for record in records:
+        room = SECTOR - len(out) % SECTOR
+        if len(record) > room:
+            out += b'\0' * room
+        out += record
+    out += b'\0' * ((SECTOR - len(out) % SECTOR) % SECTOR)
+    return bytes(out)
+
+def path_table (root_lba, big_endian):
+    # the root directory is the only one
+    fmt = '>IH' if big_endian else '<IH'
+    return struct.pack('BB', 1, 0) + struct.pack(fmt, root_lba, 1) + b'\0\0'
+
+
+class IsoWriter (object):
+    """Build an image of files (a list of (name, bytes)) in the root."""
+    def __init__ (self, files, volume_id, mtime=None, system_id='LINUX',
+                  application_id='FEDORA2OVA'):
+        self.files = list(files)
+        self.volume_id = volume_id
+        self.mtime = time.time() if mtime is None else mtime
+        self.system_id = system_id
+        self.application_id = application_id
+
+    def _primary_dir (self, root_lba, root_size, ce_lba, extents):
+        t = self.mtime
+        er = _Susp.er()
+        dot = _Susp.sp() + _Susp.ce(ce_lba, 0, len(er)) + _Susp.px(DIR_MODE, 2) + _Susp.tf(t)
+        records = [dir_record(b'\0', root_lba, root_size, t, True, dot),
+                   dir_record(b'\1', root_lba, root_size, t, True, _Susp.px(DIR_MODE, 2))]
+        for name, data in sorted(self.files, key=lambda f: primary_name(f[0])):
+            su = _Susp.px(FILE_MODE, 1) + _Susp.tf(t) + _Susp.nm(name)
+            records.append(dir_record(primary_name(name), extents[name], len(data), t, False, su))
+        return pack_directory(records)
+
+    def _joliet_dir (self, root_lba, root_size, extents):
+        t = self.mtime
+        records = [dir_record(b'\0', root_lba, root_size, t, True),
+                   dir_record(b'\1', root_lba, root_size, t, True)]
+        for name, data in sorted(self.files, key=lambda f: joliet_name(f[0])):
+            records.append(dir_record(joliet_name(name), extents[name], len(data), t))
+        return pack_directory(records)
+
+    def _descriptor (self, kind, total, root, pt_size, l_pt, m_pt):
+        joliet = kind == 2
+        def ident (text, size):
+            if joliet:
+                return _pad(text.encode('utf-16-be'), size, b'\0 ')
+            return _pad(text.encode('ascii'), size)
+        date = volume_date(self.mtime)
+        d = (struct.pack('B', kind) + b'CD001\1\0'
+             + ident(self.system_id, 32) + ident(self.volume_id, 32)
+             + b'\0' * 8 + both32(total)
+             + _pad(b'%/E' if joliet else b'', 32, b'\0')
+             + both16(1) + both16(1) + both16(SECTOR)
+             + both32(pt_size) + struct.pack('<I', l_pt) + b'\0' * 4
+             + struct.pack('>I', m_pt) + b'\0' * 4
+             + root
+             + ident('', 128) * 3 + ident(self.application_id, 128)
+             + ident('', 37) * 3
+             + date * 2 + b'0' * 16 + b'\0' + date
+             + b'\1\0')
+        return d + b'\0' * (SECTOR - len(d))
+
+    def write (self):
+        """Return the whole image, as bytes."""
+        names = [name for name, _ in self.files]
+        if len(set(primary_name(n) for n in names)) != len(names):
+            raise ValueError("File names collide as ISO9660 names: {}".format(names))
+
+        # the layout: descriptors, path tables, the primary root directory,
+        # its Rock Ridge continuation area (readers like libarchive only
+        # look forward), the Joliet root directory, then the files
+        l_pt, m_pt, jl_pt, jm_pt = 19, 20, 21, 22
+        placeholder = dict((name, 0) for name in names)
+        primary_size = len(self._primary_dir(0, 0, 0, placeholder))
+        joliet_size = len(self._joliet_dir(0, 0, placeholder))
+        primary_lba = 23
+        ce_lba = primary_lba + primary_size // SECTOR
+        joliet_lba = ce_lba + 1
+        lba = joliet_lba + joliet_size // SECTOR
+        extents = {}
+        for name, data in self.files:
+            extents[name] = lba
+            lba += _sectors(len(data))
+        total = lba
+
+        t = self.mtime
+        pt_size = len(path_table(0, False))
+        out = bytearray(b'\0' * (FIRST_DESCRIPTOR * SECTOR))
+        out += self._descriptor(1, total, dir_record(b'\0', primary_lba, primary_size, t, True),
+                                pt_size, l_pt, m_pt)
+        out += self._descriptor(2, total, dir_record(b'\0', joliet_lba, joliet_size, t, True),
+                                pt_size, jl_pt, jm_pt)
+        out += b'\xffCD001\1' + b'\0' * (SECTOR - 7)
+        for lba, big in ((primary_lba, False), (primary_lba, True), (joliet_lba, False), (joliet_lba, True)):
+            table = path_table(lba, big)
+            out += table + b'\0' * (SECTOR - len(table))
+        out += self._primary_dir(primary_lba, primary_size, ce_lba, extents)
+        er = _Susp.er()
+        out += er + b'\0' * (SECTOR - len(er))
+        out += self._joliet_dir(joliet_lba, joliet_size, extents)
+        for name, data in self.files:
+            out += data + b'\0' * ((SECTOR - len(data) % SECTOR) % SECTOR)
+        return bytes(out)
+
+def build_iso (files, volume_id, mtime=None):
+    """Return an ISO9660 image (Joliet and Rock Ridge) of the files, a list
+    of (name, bytes), all in its root directory."""
+    return IsoWriter(files, volume_id, mtime).write()
@@ -0,0 +1,245 @@
+# vim: fileencoding=utf-8
+"""Write an OVA of the built VM directly, instead of VBoxManage export.
+
+The OVA is a tar of an OVF descriptor, a streamOptimized VMDK, and a
+manifest of their SHA256 digests.  The VMDK is written from the VM's VDI
+(and its parent), compressing its 64 KiB grains on a process pool; blocks
+that were never allocated, and grains of zeros, are left out.  The tar
+member's header is filled in once the VMDK's size is known, so everything
+is written in one pass; that's also why the manifest comes last, rather
+than straight after the descriptor.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import hashlib
+import os
+import os.path
+import random
+import string
+import struct
+import tarfile
+import uuid
+import zlib
+from xml.sax.saxutils import escape
+
+from . import vdi
+from .pool import imap_ordered
+
+SECTOR = 512
+GRAIN_SIZE = 64 * 1024
+GTES_PER_GT = 512
+GD_AT_END = 0xffffffffffffffff
+MARKER_EOS, MARKER_GT, MARKER_GD, MARKER_FOOTER = 0, 1, 2, 3
+
+# the CIM operating system types VirtualBox exports these as
+CIM_OS_TYPES = {'Fedora': 36, 'Fedora_64': 101}
+
+class VmSettings (object):
+    """What build_vm set up, for the OVF descriptor."""
+    def __init__ (self, name, vm_name, os_type, memory, vram, sshport, disks):
+        self.name = name
+        self.vm_name = vm_name
+        self.os_type = os_type
+        self.memory = memory
+        self.vram = vram
+        self.sshport = sshport
+        # the VM's disk, then the images it's based on
+        self.disks = disks
+
+
+def _sectors (n):
+    return (n + SECTOR - 1) // SECTOR
+
+def _pad_sector (data):
+    return data + b'\0' * (-len(data) % SECTOR)
+
+def _marker (value, kind):
+    return struct.pack('<QII', value, 0, kind) + b'\0' * (SECTOR - 16)
+
+def sparse_header (capacity, descriptor_sectors, gd_offset):
+    # the sparse extent header, in sector 0 and again in the footer
+    fields = struct.pack('<4sIIQQQQIQQQB4sH',
+                         b'KDMV', 3, 0x30001, capacity, GRAIN_SIZE // SECTOR,
+                         1, descriptor_sectors, GTES_PER_GT, 0, gd_offset,
+                         1 + descriptor_sectors, 0, b'\n \r\n', 1)
+    return fields + b'\0' * (SECTOR - len(fields))
+
+def descriptor (capacity, filename, image_uuid):
+    cylinders = min(capacity // (16 * 63), 16383)
+    text = '\n'.join([
+        '# Disk DescriptorFile',
+        'version=1',
+        'CID={:08x}'.format(random.getrandbits(32)),
+        'parentCID=ffffffff',
+        'createType="streamOptimized"',
+        '',
+        '# Extent description',
+        'RW {} SPARSE "{}"'.format(capacity, filename),
+        '',
+        '# The disk Data Base',
+        '#DDB',
+        '',
+        'ddb.virtualHWVersion = "4"',
+        'ddb.adapterType="ide"',
+        'ddb.geometry.cylinders="{}"'.format(cylinders),
+        'ddb.geometry.heads="16"',
+        'ddb.geometry.sectors="63"',
+        'ddb.uuid.image="{}"'.format(image_uuid),
+        '',
+    ])
+    return _pad_sector(text.encode('ascii'))
+
+def compress_block (path, offset, block_size, first_grain, level=6):
+    """Runs in a worker process: read one VDI block, and return the
+    (grain number, compressed grain) of each grain that isn't all zeros."""
+    zeros = b'\0' * GRAIN_SIZE
+    out = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(block_size)
+    for start in range(0, len(data), GRAIN_SIZE):
+        grain = data[start:start + GRAIN_SIZE]
+        if grain != zeros[:len(grain)]:
+            if len(grain) < GRAIN_SIZE:
+                grain += zeros[len(grain):]
+            out.append((first_grain + start // GRAIN_SIZE, zlib.compress(grain, level)))
+    return out
+
+class StreamVmdkWriter (object):
+    """Writes a streamOptimized VMDK of a VdiImage to a file, counting and
+    returning its size."""
+    def __init__ (self, image, filename, image_uuid, workers=None, level=6):
+        if image.block_size % GRAIN_SIZE:
+            raise ValueError("VDI block size {} isn't a multiple of the grain size".format(
+                image.block_size))
+        self.image = image
+        self.filename = filename
+        self.image_uuid = image_uuid
+        self.workers = workers
+        self.level = level
+        self.capacity = _sectors(image.disk_size)
+
+    def jobs (self):
+        grains_per_block = self.image.block_size // GRAIN_SIZE
+        for index in range(self.image.blocks):
+            location = self.image.locate(index)
+            if location is not None:
+                path, offset = location
+                size = min(self.image.block_size, self.image.disk_size - index * self.image.block_size)
+                yield path, offset, size, index * grains_per_block, self.level
+
+    def write (self, out):
+        desc = descriptor(self.capacity, self.filename, self.image_uuid)
+        desc_sectors = len(desc) // SECTOR
+        out.write(sparse_header(self.capacity, desc_sectors, GD_AT_END))
+        out.write(desc)
+        sector = 1 + desc_sectors
+
+        grain_sectors = GRAIN_SIZE // SECTOR
+        total_grains = (self.capacity + grain_sectors - 1) // grain_sectors
+        tables = [None] * ((total_grains + GTES_PER_GT - 1) // GTES_PER_GT)
+        for grains in imap_ordered(compress_block, self.jobs(), self.workers):
+            for number, data in grains:
+                table = tables[number // GTES_PER_GT]
+                if table is None:
+                    table = tables[number // GTES_PER_GT] = [0] * GTES_PER_GT
+                table[number % GTES_PER_GT] = sector
+                grain = _pad_sector(struct.pack('<QI', number * grain_sectors, len(data)) + data)
+                out.write(grain)
+                sector += len(grain) // SECTOR
+
+        # grain tables, then the directory of them; tables without any
+        # grains are left out, with 0 in the directory
+        table_sectors = GTES_PER_GT * 4 // SECTOR
+        directory = []
+        for table in tables:
+            if table is None:
+                directory.append(0)
+                continue
+            out.write(_marker(table_sectors, MARKER_GT))
+            out.write(struct.pack('<{}I'.format(GTES_PER_GT), *table))
+            directory.append(sector + 1)
+            sector += 1 + table_sectors
+        gd = _pad_sector(struct.pack('<{}I'.format(len(directory)), *directory))
+        out.write(_marker(len(gd) // SECTOR, MARKER_GD))
+        out.write(gd)
+        gd_offset = sector + 1
+        sector += 1 + len(gd) // SECTOR
+
+        out.write(_marker(1, MARKER_FOOTER))
+        out.write(sparse_header(self.capacity, desc_sectors, gd_offset))
+        out.write(_marker(0, MARKER_EOS))
+        return (sector + 3) * SECTOR
+
+
+def render_ovf (vm, disk_file, disk_capacity, disk_uuid, template):
+    values = dict(
+        name=vm.name, os_type=vm.os_type, cim_os_type=CIM_OS_TYPES.get(vm.os_type, 36),
+        memory=vm.memory, vram=vm.vram, sshport=vm.sshport,
+        disk_file=disk_file, disk_capacity=disk_capacity, disk_uuid=disk_uuid,
+        machine_uuid=uuid.uuid4(),
+    )
+    values = dict((k, escape("{}".format(v), {'"': '&quot;'})) for k, v in values.items())
+    return string.Template(template).substitute(values).encode('utf-8')
+
+def _tar_header (name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    # ustar holds sizes up to 8 GiB; GNU tar's headers hold anything, in
+    # the same 512 bytes
+    fmt = tarfile.USTAR_FORMAT if size < 8**11 else tarfile.GNU_FORMAT
+    return info.tobuf(fmt)
+
+class _CountingWriter (object):
+    def __init__ (self, f):
+        self.f = f
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def write (self, data):
+        self.f.write(data)
+        self.size += len(data)
+        self.sha256.update(data)
+
+def manifest (digests):
+    # digests: (name, hex SHA256), in the order of the archive
+    return ''.join('SHA256 ({}) = {}\n'.format(name, digest)
+                   for name, digest in digests).encode('utf-8')
+
+def write_ova (filename, vm, template, workers=None, level=6):
+    """Write the OVA of vm (VmSettings) to filename; return filename."""
+    import time
+    image = vdi.open_chain(vm.disks)
+    base = os.path.splitext(os.path.basename(filename))[0]
+    disk_file = base + '-disk001.vmdk'
+    disk_uuid = uuid.uuid4()
+    ovf = render_ovf(vm, disk_file, image.disk_size, disk_uuid, template)
+    mtime = int(time.time())
+
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_tar_header(base + '.ovf', len(ovf), mtime))
+            f.write(_pad_sector(ovf))
+            # a placeholder header for the disk, filled in when its size is known
+            header_at = f.tell()
+            f.write(b'\0' * SECTOR)
+            writer = _CountingWriter(f)
+            StreamVmdkWriter(image, disk_file, disk_uuid, workers, level).write(writer)
+            f.write(b'\0' * (-writer.size % SECTOR))
+            end = f.tell()
+            f.seek(header_at)
+            f.write(_tar_header(disk_file, writer.size, mtime))
+            f.seek(end)
+            mf = manifest([(base + '.ovf', hashlib.sha256(ovf).hexdigest()),
+                           (disk_file, writer.sha256.hexdigest())])
+            f.write(_tar_header(base + '.mf', len(mf), mtime))
+            f.write(_pad_sector(mf))
+            # end of archive
+            f.write(b'\0' * (2 * SECTOR))
+    except BaseException:
+        os.unlink(filename)
+        raise
+    return filename
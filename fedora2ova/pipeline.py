@@ -0,0 +1,145 @@
+# vim: fileencoding=utf-8
+"""Run a build as a series of stages, checkpointed so that it can resume.
+
+After each stage, what it made and how long it took are written to
+STATE_FILE in the build's tmpdir.  A resumed build checks what the finished
+stages made, and runs again from the first stage whose results are missing
+or no longer valid; anything the later stages had made is discarded first.
+The state only applies to a build with the same inputs (image, options, and
+so on); otherwise the build starts over.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import json
+import os
+import os.path
+import sys
+import tempfile
+import time
+
+STATE_FILE = 'fedora2ova-state.json'
+STATE_FORMAT = 1
+
+_replace = getattr(os, 'replace', os.rename)
+
+class Stage (object):
+    """One step of a build.
+
+    run(results) does the step, given the results of the stages before it
+    (by name), and returns its own result, which must be JSON-serializable.
+    check(result, results) says whether a finished stage's result is still
+    there to build on.  discard(result) undoes what the stage made, when a
+    resumed build runs it again.  If the stage has to run again, because it
+    didn't finish or its result has gone, the build resumes from the stage
+    named by restart instead: booting a VM changes its disk, for instance.
+    """
+    def __init__ (self, name, run, check=None, discard=None, restart=None):
+        self.name = name
+        self.run = run
+        self.check = check
+        self.discard = discard
+        self.restart = restart
+
+
+class BuildState (object):
+    """The state file of a build in tmpdir."""
+    def __init__ (self, tmpdir, inputs):
+        self.path = os.path.join(tmpdir, STATE_FILE)
+        self.inputs = inputs
+        self.stages = []
+        self.started = None
+
+    def load (self):
+        """Return the stages recorded by an earlier run, as {name: record},
+        the stage it was in the middle of, and whether its inputs were the
+        same as these."""
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}, None, False
+        if state.get('format') != STATE_FORMAT:
+            return {}, None, False
+        return (dict((r['name'], r) for r in state.get('stages', [])), state.get('started'),
+                state.get('inputs') == self.inputs)
+
+    def save (self):
+        state = dict(format=STATE_FORMAT, inputs=self.inputs, stages=self.stages,
+                     started=self.started)
+        fd, tmp_name = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(self.path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        _replace(tmp_name, self.path)
+
+    def start (self, name):
+        self.started = name
+        self.save()
+
+    def finish (self, name, result, seconds, resumed=False):
+        record = dict(name=name, result=result, seconds=round(seconds, 3),
+                      finished=int(time.time()))
+        if resumed:
+            record['resumed'] = True
+        self.stages.append(record)
+        self.started = None
+        self.save()
+
+
+def run_stages (stages, state, resume=False):
+    """Run the stages in order, skipping those an earlier run finished when
+    resuming; return their results, by name."""
+    done, interrupted, same = state.load() if resume else ({}, None, False)
+    if done and not same:
+        # what that build made isn't this build's to throw away
+        print("The build's inputs have changed since {}; starting over".format(state.path))
+        done = {}
+    names = [s.name for s in stages]
+    first = 0
+    if done and all(name in done for name in names):
+        # finished; unless what it finished with has gone since
+        last = stages[-1]
+        results = dict((name, done[name]['result']) for name in names)
+        if last.check is None or last.check(results[last.name], results):
+            first = len(stages)
+
+    if done and first < len(stages):
+        # the first stage that needs to run
+        if interrupted in names:
+            restart = stages[names.index(interrupted)].restart
+            first = names.index(restart) if restart in names else names.index(interrupted)
+        else:
+            first = len(stages)
+        results = {}
+        for i, stage in enumerate(stages[:first]):
+            record = done.get(stage.name)
+            if record is None or (stage.check is not None
+                                  and not stage.check(record['result'], results)):
+                first = i
+                break
+            results[stage.name] = record['result']
+        restart = stages[first].restart if first < len(stages) else None
+        if restart in names[:first]:
+            first = names.index(restart)
+
+        # undo whatever will be made again, last first
+        for stage in reversed(stages[first:]):
+            record = done.get(stage.name)
+            if record is not None and stage.discard is not None:
+                try:
+                    stage.discard(record['result'])
+                except Exception as e:
+                    print("Couldn't discard the old {} stage: {}".format(stage.name, e),
+                          file=sys.stderr)
+
+    results = {}
+    for stage in stages[:first]:
+        record = done[stage.name]
+        print("Resuming: {} is done".format(stage.name))
+        results[stage.name] = record['result']
+        state.finish(stage.name, record['result'], record['seconds'], resumed=True)
+    for stage in stages[first:]:
+        state.start(stage.name)
+        start = time.time()
+        results[stage.name] = stage.run(results)
+        state.finish(stage.name, results[stage.name], time.time() - start)
+    return results
@@ -0,0 +1,34 @@
+# vim: fileencoding=utf-8
+"""Process pools for the CPU-heavy stages (decompression, compression)."""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import collections
+
+from cloud_maker.util import cpu_count
+
+def process_pool (workers):
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:
+        return None # Python 2 without the futures backport
+    return ProcessPoolExecutor(workers)
+
+def imap_ordered (fn, jobs, workers=None, window=None):
+    """Yield fn(*job) for each job, in order, running up to window jobs
+    ahead on a process pool (or all in this process, without one)."""
+    workers = workers or cpu_count()
+    pool = process_pool(workers) if workers > 1 else None
+    if pool is None:
+        for job in jobs:
+            yield fn(*job)
+        return
+
+    window = window or workers * 2
+    with pool:
+        pending = collections.deque()
+        for job in jobs:
+            pending.append(pool.submit(fn, *job))
+            if len(pending) > window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,265 @@
+# vim: fileencoding=utf-8
+"""VirtualBox VDI disk images: just enough of the format to read them, to
+write empty ones, and to write them from raw images.
+
+A dynamic VDI is a header, a map of its blocks (1 MiB each, normally), and
+the blocks that have been allocated, in any order.  A differencing image has
+the same layout, and its unallocated blocks are read from its parent.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import struct
+import sys
+import uuid
+from array import array
+
+SIGNATURE = 0xbeda107f
+VERSION = 0x00010001
+HEADER_SIZE = 0x190 # of the version 1.1 header, after the signature and version
+PRE_HEADER = b'<<< Oracle VM VirtualBox Disk Image >>>\n'
+
+TYPE_DYNAMIC = 1
+TYPE_FIXED = 2
+TYPE_DIFF = 4
+
+# block map entries that aren't offsets
+BLOCK_FREE = 0xffffffff
+BLOCK_ZERO = 0xfffffffe
+
+# after the 64-byte pre-header, signature, and version:
+# cbHeader, type, flags, comment, offBlocks, offData, legacy geometry (4),
+# dummy, cbDisk, cbBlock, cbBlockExtra, cBlocks, cBlocksAllocated,
+# 4 UUIDs (create, modify, linkage, parent modify), LCHS geometry (4)
+_HEADER = struct.Struct('<III256sII4IIQIIII16s16s16s16s4I')
+
+class VdiHeader (object):
+    """The fields of a VDI header that matter here."""
+    def __init__ (self, image_type, disk_size, block_size=1024*1024, blocks_offset=0x200,
+                  data_offset=None, block_extra=0, allocated=0, uuid_create=None,
+                  uuid_modify=None, uuid_parent=None, uuid_parent_modify=None,
+                  comment=b'', flags=0):
+        self.image_type = image_type
+        self.disk_size = disk_size
+        self.block_size = block_size
+        self.block_extra = block_extra
+        self.blocks = (disk_size + block_size - 1) // block_size
+        self.blocks_offset = blocks_offset
+        if data_offset is None:
+            # the block map, rounded up to whole sectors
+            data_offset = blocks_offset + (self.blocks * 4 + 511) // 512 * 512
+        self.data_offset = data_offset
+        self.allocated = allocated
+        self.uuid_create = uuid_create or uuid.uuid4()
+        self.uuid_modify = uuid_modify or uuid.uuid4()
+        self.uuid_parent = uuid_parent
+        self.uuid_parent_modify = uuid_parent_modify
+        self.comment = comment
+        self.flags = flags
+
+    @classmethod
+    def read (cls, f, path='VDI'):
+        f.seek(0)
+        data = f.read(0x48 + _HEADER.size)
+        if len(data) < 0x48 + _HEADER.size:
+            raise ValueError("{} is not a VDI image".format(path))
+        signature, version = struct.unpack('<II', data[0x40:0x48])
+        if signature != SIGNATURE:
+            raise ValueError("{} is not a VDI image".format(path))
+        if version >> 16 != 1:
+            raise ValueError("{} is VDI version {:#x}, not 1.x".format(path, version))
+        fields = _HEADER.unpack(data[0x48:])
+        (_, image_type, flags, comment, blocks_offset, data_offset) = fields[0:6]
+        (disk_size, block_size, block_extra, blocks, allocated) = fields[11:16]
+        header = cls(image_type, disk_size, block_size, blocks_offset, data_offset,
+                     block_extra, allocated, uuid.UUID(bytes_le=fields[16]),
+                     uuid.UUID(bytes_le=fields[17]), _uuid_or_none(fields[18]),
+                     _uuid_or_none(fields[19]), comment.rstrip(b'\0'), flags)
+        if blocks * block_size < disk_size:
+            raise ValueError("{} has {} blocks for {} bytes".format(path, blocks, disk_size))
+        header.blocks = blocks
+        return header
+
+    def pack (self):
+        """The header, from the start of the file up to the block map."""
+        # the legacy CHS geometry is left for VirtualBox to work out
+        fields = _HEADER.pack(HEADER_SIZE, self.image_type, self.flags, self.comment,
+                              self.blocks_offset, self.data_offset, 0, 0, 0, 512, 0,
+                              self.disk_size, self.block_size, self.block_extra,
+                              self.blocks, self.allocated,
+                              self.uuid_create.bytes_le, self.uuid_modify.bytes_le,
+                              _uuid_bytes(self.uuid_parent), _uuid_bytes(self.uuid_parent_modify),
+                              0, 0, 0, 512)
+        head = (PRE_HEADER + b'\0' * (64 - len(PRE_HEADER))
+                + struct.pack('<II', SIGNATURE, VERSION) + fields)
+        if len(head) > self.blocks_offset:
+            raise ValueError("VDI block map overlaps its header")
+        return head + b'\0' * (self.blocks_offset - len(head))
+
+def _uuid_bytes (u):
+    return b'\0' * 16 if u is None else u.bytes_le
+
+def _uuid_or_none (raw):
+    u = uuid.UUID(bytes_le=raw)
+    return None if u.int == 0 else u
+
+
+class VdiImage (object):
+    """A VDI file, and the parent it reads unallocated blocks from."""
+    def __init__ (self, path, parent=None):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.header = h = VdiHeader.read(f, path)
+            f.seek(h.blocks_offset)
+            raw = f.read(h.blocks * 4)
+        if len(raw) != h.blocks * 4:
+            raise ValueError("{} has a truncated block map".format(path))
+        self.block_map = struct.unpack('<{}I'.format(h.blocks), raw)
+        self.parent = None
+        if parent is not None:
+            self.set_parent(parent)
+
+    def set_parent (self, parent):
+        if self.header.uuid_parent != parent.header.uuid_create:
+            raise ValueError("{} is not the parent of {}".format(parent.path, self.path))
+        if parent.header.block_size != self.header.block_size:
+            raise ValueError("{} and its parent {} have different block sizes".format(
+                self.path, parent.path))
+        self.parent = parent
+
+    @property
+    def disk_size (self):
+        return self.header.disk_size
+
+    @property
+    def block_size (self):
+        return self.header.block_size
+
+    @property
+    def blocks (self):
+        return self.header.blocks
+
+    def locate (self, index):
+        """Return (path, offset) of block index's data, or None if it
+        reads as zeros."""
+        image = self
+        while image is not None:
+            entry = image.block_map[index] if index < image.blocks else BLOCK_FREE
+            if entry == BLOCK_ZERO:
+                return None
+            if entry != BLOCK_FREE:
+                h = image.header
+                return image.path, h.data_offset + entry * (h.block_size + h.block_extra) + h.block_extra
+            image = image.parent
+        return None
+
+def write_empty (path, header):
+    """Create a VDI at path with header, and no blocks allocated."""
+    header.allocated = 0
+    with open(path, 'wb') as f:
+        f.write(header.pack())
+        f.write(struct.pack('<{}I'.format(header.blocks), *([BLOCK_FREE] * header.blocks)))
+        f.write(b'\0' * (header.data_offset - f.tell()))
+
+def create_diff (path, parent_path):
+    """Create an empty differencing image over the VDI at parent_path."""
+    with open(parent_path, 'rb') as f:
+        parent = VdiHeader.read(f, parent_path)
+    write_empty(path, VdiHeader(TYPE_DIFF, parent.disk_size, parent.block_size,
+                                uuid_parent=parent.uuid_create,
+                                uuid_parent_modify=parent.uuid_modify))
+
+def _chunks (data, size):
+    # the bytes of a file object or an iterable of bytes, as size-byte chunks
+    if hasattr(data, 'read'):
+        while True:
+            chunk = data.read(size)
+            if not chunk:
+                return
+            while len(chunk) < size:
+                more = data.read(size - len(chunk))
+                if not more:
+                    break
+                chunk += more
+            yield chunk
+        return
+    pending = []
+    pending_size = 0
+    for piece in data:
+        pending.append(piece)
+        pending_size += len(piece)
+        if pending_size >= size:
+            buf = b''.join(pending)
+            start = 0
+            while pending_size - start >= size:
+                yield buf[start:start + size]
+                start += size
+            pending = [buf[start:]]
+            pending_size -= start
+    if pending_size:
+        yield b''.join(pending)
+
+def write_raw (path, data, size, disk_size=None, block_size=1024*1024):
+    """Write a dynamic VDI at path of size bytes of raw disk, from data (a
+    file object, or an iterable of bytes), in one pass.  Blocks of zeros
+    are left unallocated.  The virtual disk is disk_size bytes, if that's
+    given, instead of just big enough for the raw image."""
+    if disk_size is None:
+        disk_size = size
+    elif disk_size < size:
+        # not a ValueError: decompressing the image some other way won't help
+        raise RuntimeError("Can't fit a {}-byte image on a {}-byte disk".format(size, disk_size))
+    header = VdiHeader(TYPE_DYNAMIC, disk_size, block_size)
+    # blocks start on a whole block, for the host's sake
+    header.data_offset = (header.data_offset + block_size - 1) // block_size * block_size
+    block_map = array(str('I'), [BLOCK_FREE]) * header.blocks
+    zeros = b'\0' * block_size
+    done = 0
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.seek(header.data_offset)
+            for index, block in enumerate(_chunks(data, block_size)):
+                done += len(block)
+                if done > size:
+                    raise ValueError("The raw image is longer than {} bytes".format(size))
+                if block == zeros[:len(block)]:
+                    continue
+                block_map[index] = header.allocated
+                header.allocated += 1
+                f.write(block)
+                if len(block) < block_size:
+                    f.write(zeros[len(block):])
+            if done < size:
+                raise ValueError("The raw image ended after {} of {} bytes".format(done, size))
+            f.seek(0)
+            f.write(header.pack())
+            if sys.byteorder == 'big':
+                block_map.byteswap()
+            f.write(block_map.tobytes() if hasattr(block_map, 'tobytes') else block_map.tostring())
+            # a disk with no blocks allocated still has all of its header
+            f.truncate(header.data_offset + header.allocated * block_size)
+    except BaseException:
+        os.unlink(path)
+        raise
+
+def convert_from_raw (vdi, raw_path=None, size=None, data=None, disk_size=None):
+    """Convert a raw image to the VDI at vdi, like a backend's
+    convert_from_raw, but in-process and sized to disk_size at once."""
+    if raw_path is not None:
+        with open(raw_path, 'rb') as f:
+            write_raw(vdi, f, os.fstat(f.fileno()).st_size, disk_size)
+    else:
+        write_raw(vdi, data, size, disk_size)
+
+def open_chain (paths):
+    """Open a VDI and its ancestors, from the child to the base image."""
+    image = None
+    for path in reversed(paths):
+        if image is None:
+            image = VdiImage(path)
+            if image.header.image_type == TYPE_DIFF:
+                raise ValueError("{} is a differencing image, but has no parent".format(path))
+        else:
+            image = VdiImage(path, image)
+    return image
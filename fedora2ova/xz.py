@@ -0,0 +1,258 @@
+# vim: fileencoding=utf-8
+"""Decompress .xz disk images quickly, and without writing their holes.
+
+An .xz file ends with an index of its blocks, and each block can be decoded
+on its own, so files compressed in several blocks (xz -T, pixz, pxz) are
+decoded on every CPU at once.  Each block is wrapped in a minimal stream of
+its own for Python's lzma module, which then still verifies its check.
+
+Runs of zeros in the output are skipped over rather than written, which
+leaves them as holes in the (sparse) raw image.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import struct
+import sys
+import zlib
+try:
+    import lzma
+except ImportError:
+    lzma = None # Python 2: use the xz command instead
+
+from .pool import cpu_count, imap_ordered, process_pool
+
+HEADER_MAGIC = b'\xfd7zXZ\x00'
+FOOTER_MAGIC = b'YZ'
+SPARSE_CHUNK = 64 * 1024
+_ZEROS = b'\0' * SPARSE_CHUNK
+
+class XzBlock (object):
+    """One block of an .xz file: where it is, and what it decodes to."""
+    __slots__ = ('flags', 'offset', 'unpadded', 'uncompressed', 'out_offset')
+
+    def __init__ (self, flags, offset, unpadded, uncompressed, out_offset):
+        self.flags = flags # the stream flags, naming the check type
+        self.offset = offset
+        self.unpadded = unpadded
+        self.uncompressed = uncompressed
+        self.out_offset = out_offset
+
+    def as_tuple (self):
+        # for sending to another process
+        return (self.flags, self.offset, self.unpadded, self.uncompressed, self.out_offset)
+
+def _round4 (n):
+    return (n + 3) & ~3
+
+def _varint (data, pos):
+    # xz's multibyte integers: 7 bits per byte, least significant first
+    value = 0
+    for i in range(9):
+        byte = bytearray(data[pos + i:pos + i + 1])
+        if not byte:
+            raise ValueError("Truncated xz index")
+        value |= (byte[0] & 0x7f) << (7 * i)
+        if not byte[0] & 0x80:
+            return value, pos + i + 1
+    raise ValueError("Corrupt xz index")
+
+def _encode_varint (n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def _read_at (f, offset, size):
+    f.seek(offset, os.SEEK_SET)
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated xz file")
+    return data
+
+def read_index (path):
+    """List the XzBlocks of the .xz file at path, in order.
+
+    Raises ValueError if the file isn't an intact .xz file.
+    """
+    streams = []
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        while pos > 0:
+            # streams may be separated by padding, in 4-byte words of zeros
+            if pos >= 4 and _read_at(f, pos - 4, 4) == b'\0\0\0\0':
+                pos -= 4
+                continue
+            if pos < 24:
+                raise ValueError("{} is not an xz file".format(path))
+            footer = _read_at(f, pos - 12, 12)
+            if footer[10:12] != FOOTER_MAGIC:
+                raise ValueError("{} is not an xz file".format(path))
+            if struct.unpack('<I', footer[0:4])[0] != zlib.crc32(footer[4:10]) & 0xffffffff:
+                raise ValueError("Corrupt xz stream footer in {}".format(path))
+            flags = footer[8:10]
+            index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+            index_start = pos - 12 - index_size
+            index = _read_at(f, index_start, index_size)
+            if bytearray(index[0:1])[0] != 0:
+                raise ValueError("Corrupt xz index in {}".format(path))
+            if struct.unpack('<I', index[-4:])[0] != zlib.crc32(index[:-4]) & 0xffffffff:
+                raise ValueError("Corrupt xz index in {}".format(path))
+
+            count, p = _varint(index, 1)
+            records = []
+            for _ in range(count):
+                unpadded, p = _varint(index, p)
+                uncompressed, p = _varint(index, p)
+                records.append((unpadded, uncompressed))
+
+            stream_start = index_start - sum(_round4(u) for u, _ in records) - 12
+            if stream_start < 0 or _read_at(f, stream_start, 12)[:8] != HEADER_MAGIC + flags:
+                raise ValueError("Corrupt xz stream in {}".format(path))
+            offset = stream_start + 12
+            blocks = []
+            for unpadded, uncompressed in records:
+                blocks.append((flags, offset, unpadded, uncompressed))
+                offset += _round4(unpadded)
+            streams.append(blocks)
+            pos = stream_start
+
+    result = []
+    out_offset = 0
+    for blocks in reversed(streams):
+        for flags, offset, unpadded, uncompressed in blocks:
+            result.append(XzBlock(flags, offset, unpadded, uncompressed, out_offset))
+            out_offset += uncompressed
+    return result
+
+def uncompressed_size (path):
+    return sum(b.uncompressed for b in read_index(path))
+
+def _stream_header (flags):
+    return HEADER_MAGIC + flags + struct.pack('<I', zlib.crc32(flags) & 0xffffffff)
+
+def _stream_tail (flags, unpadded, uncompressed):
+    # the index and footer of a stream holding only this block
+    index = b'\0' + _encode_varint(1) + _encode_varint(unpadded) + _encode_varint(uncompressed)
+    index += b'\0' * (_round4(len(index)) - len(index))
+    index += struct.pack('<I', zlib.crc32(index) & 0xffffffff)
+    rest = struct.pack('<I', len(index) // 4 - 1) + flags
+    return index + struct.pack('<I', zlib.crc32(rest) & 0xffffffff) + rest + FOOTER_MAGIC
+
+def iter_block (path, block, bufsize=1024*1024, max_length=8*1024*1024):
+    """Yield the decoded contents of one block (an XzBlock or its tuple)."""
+    if isinstance(block, XzBlock):
+        block = block.as_tuple()
+    flags, offset, unpadded, uncompressed, _ = block
+    d = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+    limited = sys.version_info >= (3, 5) # max_length is new in 3.5
+
+    def feed (data):
+        # zeros compress so well that one read can expand to gigabytes;
+        # max_length keeps each piece small
+        if not limited:
+            out = d.decompress(data)
+            if out:
+                yield out
+            return
+        while True:
+            out = d.decompress(data, max_length)
+            data = b''
+            if out:
+                yield out
+            if d.eof or d.needs_input:
+                return
+
+    for out in feed(_stream_header(flags)):
+        yield out
+    with open(path, 'rb') as f:
+        f.seek(offset, os.SEEK_SET)
+        left = _round4(unpadded)
+        while left > 0:
+            data = f.read(min(bufsize, left))
+            if not data:
+                raise ValueError("Truncated xz file {}".format(path))
+            left -= len(data)
+            for out in feed(data):
+                yield out
+    for out in feed(_stream_tail(flags, unpadded, uncompressed)):
+        yield out
+    if not d.eof:
+        raise ValueError("Corrupt xz block at offset {} of {}".format(offset, path))
+
+def write_sparse (fd, data, offset):
+    """Write data at offset of fd, skipping all-zero chunks; return the
+    offset just past it."""
+    for start in range(0, len(data), SPARSE_CHUNK):
+        chunk = data[start:start + SPARSE_CHUNK]
+        if chunk != _ZEROS[:len(chunk)]:
+            os.lseek(fd, offset + start, os.SEEK_SET)
+            os.write(fd, chunk)
+    return offset + len(data)
+
+def _decode_block_into (path, block, out_path):
+    # runs in a worker process: decode one block into its place in out_path
+    fd = os.open(out_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        offset = block[4]
+        for data in iter_block(path, block):
+            offset = write_sparse(fd, data, offset)
+        if offset != block[4] + block[3]:
+            raise ValueError("xz block at offset {} of {} decoded to the wrong size".format(block[1], path))
+    finally:
+        os.close(fd)
+
+def decompress (path, out_path, workers=None):
+    """Decompress the .xz file at path into a new (sparse) file, out_path.
+
+    Returns the size of the decompressed file.
+    """
+    blocks = read_index(path)
+    total = sum(b.uncompressed for b in blocks)
+    fd = os.open(out_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        try:
+            # all holes, for the blocks to fill in
+            os.ftruncate(fd, total)
+        finally:
+            os.close(fd)
+
+        workers = workers or cpu_count()
+        pool = process_pool(min(workers, len(blocks))) if len(blocks) > 1 and workers > 1 else None
+        if pool is None:
+            for block in blocks:
+                _decode_block_into(path, block.as_tuple(), out_path)
+        else:
+            with pool:
+                futures = [pool.submit(_decode_block_into, path, b.as_tuple(), out_path) for b in blocks]
+                for future in futures:
+                    future.result()
+    except BaseException:
+        os.unlink(out_path)
+        raise
+    return total
+
+def _decode_block (path, block):
+    # runs in a worker process: the whole decoded block
+    return b''.join(iter_block(path, block))
+
+def iter_decompressed (path, workers=None, max_parallel_block=64*1024*1024):
+    """Yield the decompressed contents of the .xz file at path, in order.
+
+    Blocks are decoded ahead on a process pool, when there are several and
+    they are small enough to hold a few of them in memory at once.
+    """
+    blocks = read_index(path)
+    workers = workers or cpu_count()
+    if len(blocks) < 2 or workers < 2 or max(b.uncompressed for b in blocks) > max_parallel_block:
+        for block in blocks:
+            for data in iter_block(path, block):
+                yield data
+        return
+
+    jobs = ((path, block.as_tuple()) for block in blocks)
+    for data in imap_ordered(_decode_block, jobs, workers, window=workers):
+        yield data
@@ -1,28 +1,16 @@
 # vim: fileencoding=utf-8
 from __future__ import print_function, absolute_import, unicode_literals
 
+# Only what every run needs is imported here; the rest is imported where
+# it's used, so that --version, usage errors, and --from-server start fast.
+# (python -m make_provisioner.bench --startup keeps an eye on that.)
 from . import VERSION
-from .data import get_data
-from .template import Template
 
 raw_open = open
-from argparse import ArgumentParser
 from codecs import open
-try:
-    import configparser
-    _CONFIG_PARSER = configparser.ConfigParser
-except ImportError:
-    import ConfigParser as configparser
-    _CONFIG_PARSER = configparser.SafeConfigParser
 import os
 import os.path
-import platform
-import posixpath
-import shutil
 import sys
-import tarfile
-import tempfile
-import traceback
 
 def _first_key (d, keys, default=None):
     for k in keys:
@@ -33,6 +21,24 @@ def _first_key (d, keys, default=None):
 def shquote (s):
     return "\\'".join("'" + p + "'" for p in s.split("'"))
 
+_BOOLEAN_STATES = {'1': True, 'yes': True, 'true': True, 'on': True,
+                   '0': False, 'no': False, 'false': False, 'off': False}
+
+def config_bool (value, name='option'):
+    try:
+        return _BOOLEAN_STATES[value.strip().lower()]
+    except KeyError:
+        raise ValueError("{} must be a boolean (yes/no): {!r}".format(name, value))
+
+def config_number (value, scale=1, name='option'):
+    # empty or missing means "unlimited"
+    if value is None or not value.strip():
+        return None
+    try:
+        return float(value) * scale
+    except ValueError:
+        raise ValueError("{} must be a number: {!r}".format(name, value))
+
 class Provisioner (object):
     PROG = 'make_provisioner'
     config = None
@@ -40,6 +46,7 @@ class Provisioner (object):
     handlers = None
 
     def parse_args (self, args, prog):
+        from argparse import ArgumentParser
         desc = "Creates a shell provisioner for guest machines"
         p = ArgumentParser(prog=prog, description=desc)
         p.add_argument('--version', action='version',
@@ -49,27 +56,101 @@ class Provisioner (object):
                        help='Read configuration of systems from FILE (provisioner.ini)')
         p.add_argument('--output', '-o', metavar='FILE',
                        help='Write the resulting provisioner to the given FILE (config file\'s "output_file" option)')
-        p.add_argument('system', metavar='SYSTEM',
+        p.add_argument('--no-cache', dest='cache', action='store_false', default=None,
+                       help='Always rebuild, neither using nor updating the build cache (config file\'s "cache" option)')
+        p.add_argument('--cache-dir', metavar='DIR',
+                       help='Keep previously built provisioners in DIR (config file\'s "cache_dir" option)')
+        p.add_argument('--compression', '-z', metavar='CODEC[:LEVEL]',
+                       help='Compress the payload with CODEC (none, gzip, pgzip, xz, or zstd) at LEVEL (config file\'s "compression" option, or gzip:9)')
+        p.add_argument('--compression-report', action='store_true',
+                       help='Instead of building, report the size and time of each compression method on the SYSTEM\'s tree')
+        p.add_argument('--profile-payload', action='store_true',
+                       help='Instead of building, report which files, directories, and file types make up the SYSTEM\'s payload')
+        p.add_argument('--profile-json', metavar='FILE',
+                       help='With --profile-payload, also save the full profile as JSON to FILE')
+        p.add_argument('--reproducible', action='store_true', default=None,
+                       help='Build byte-identical output from identical input (config file\'s "reproducible" option)')
+        p.add_argument('--dedup', action='store_true', default=None,
+                       help='Store files with identical contents once, as hard links (config file\'s "dedup" option)')
+        p.add_argument('--serve', metavar='ADDRESS',
+                       help='Run a server that builds provisioners on request, at ADDRESS (unix:PATH, HOST:PORT, or PORT)')
+        p.add_argument('--server-cache-size', metavar='MB', type=float, default=1024,
+                       help='With --serve, keep up to MB megabytes of built payloads in memory (1024)')
+        p.add_argument('--from-server', metavar='ADDRESS',
+                       help='Fetch the SYSTEM\'s provisioner from a --serve server at ADDRESS instead of building it')
+        p.add_argument('--watch', action='store_true',
+                       help='Keep running, and rebuild the SYSTEM\'s provisioner whenever its tree or the config file changes')
+        p.add_argument('--all', '-a', action='store_true',
+                       help='Create the provisioner for every system in the configuration file')
+        p.add_argument('--jobs', '-j', metavar='N', type=int,
+                       help='Build up to N distinct payloads at once, when building several systems (CPU count)')
+        p.add_argument('system', metavar='SYSTEM', nargs='*',
                        help='Create the provisioner for the SYSTEM listed in the configuration file')
         self.options = p.parse_args(args)
+        if not (self.options.system or self.options.all or self.options.serve):
+            p.error('a SYSTEM or --all is required')
+        if self.options.from_server and (self.options.all or len(self.options.system) != 1):
+            p.error('--from-server fetches exactly one SYSTEM')
+        if self.options.watch and (self.options.all or len(self.options.system) != 1):
+            p.error('--watch rebuilds exactly one SYSTEM')
+        if self.options.output is not None and (self.options.all or len(self.options.system) > 1):
+            p.error('--output only applies to a single SYSTEM; use the "output_file" option for several')
 
     def execute (self, args=sys.argv[1:]):
         self.parse_args(args, self.PROG)
-        self.read_config(self.options.system, self.options.config)
+        options = self.options
+        if options.serve:
+            from . import server
+            server.serve(self, options.config, options.serve, int(options.server_cache_size * 1024*1024))
+            return 0
+        if options.from_server:
+            # no config needed: the server has it
+            from . import server
+            server.fetch(options.from_server, options.system[0], options.output or 'provisioner.sh')
+            return 0
+        if options.watch:
+            from . import watch
+            watch.watch(self, options.config, options.system[0], options.output)
+            return 0
 
+        ini = self.load_config(options.config)
+        if options.all or len(options.system) > 1:
+            systems = ini.sections() if options.all else options.system
+            self.create_many(ini, systems)
+            return 0
+
+        self.set_config(ini, options.system[0])
         conf = self.config
-        output = self.options.output
-        if output is None:
-            try:
-                output = conf['output_file']
-            except KeyError:
-                output = 'provisioner.sh'
-        self.create_provisioner(output, conf['stage2_dir'])
+        if options.compression_report:
+            self.report_compression(conf['stage2_dir'])
+            return 0
+        if options.profile_payload:
+            self.profile_payload(conf['stage2_dir'], options.profile_json)
+            return 0
+
+        output = self.get_output()
+        cache = self.get_cache()
+        if cache is None:
+            self.create_provisioner(output, conf['stage2_dir'])
+        else:
+            self.create_cached(cache, output, conf['stage2_dir'])
         return 0
 
-    def read_config (self, system, path, encoding='utf-8'):
+    def get_output (self, default='provisioner.sh'):
+        output = getattr(self.options, 'output', None)
+        if output is None:
+            output = self.config.get('output_file', default)
+        return output
+
+    def load_config (self, path, encoding='utf-8'):
+        try:
+            import configparser
+            parser = configparser.ConfigParser
+        except ImportError:
+            import ConfigParser as configparser
+            parser = configparser.SafeConfigParser
         default = configparser.DEFAULTSECT
-        ini = _CONFIG_PARSER() # ConfigParser [py3] or SafeConfigParser [py2]
+        ini = parser()
         ini.optionxform = lambda o: o
         with open(path, 'r', encoding=encoding) as fp:
             try:
@@ -84,110 +165,517 @@ class Provisioner (object):
             ini.set(default, 'USER', _first_key(os.environ, ("USER", "USERNAME", "LOGNAME"), ''))
         if not ini.has_option(default, 'INI_DIR'):
             ini.set(default, 'INI_DIR', os.path.abspath(os.path.dirname(path)))
+        # and each system's own name, so output_file can tell them apart
+        for section in ini.sections():
+            if not ini.has_option(section, 'SYSTEM'):
+                ini.set(section, 'SYSTEM', section)
+        return ini
 
+    def set_config (self, ini, system):
         # make a dictionary interface to the config because I like it.
         # the difference: this version resolves HOME/USER now, not later.
         # so if you're extending this, beware of that, I guess :-/
         self.config = dict(ini.items(system))
 
-    def get_sfx_stub (self):
+    def read_config (self, system, path, encoding='utf-8'):
+        self.set_config(self.load_config(path, encoding), system)
+
+    def for_system (self, ini, system):
+        """Return a new Provisioner, sharing our options, for the system."""
+        p = self.__class__()
+        p.options = self.options
+        p.set_config(ini, system)
+        return p
+
+    def create_many (self, ini, systems):
+        # Every system gets its own stub, but systems with the same tree and
+        # payload settings share one build of the (expensive) payload.
+        import shutil
+        import tempfile
+        builds = []
+        outputs = {}
+        for system in systems:
+            p = self.for_system(ini, system)
+            output = p.get_output('provisioner-{}.sh'.format(system))
+            real_output = os.path.realpath(output)
+            if real_output in outputs:
+                err = "Systems {} and {} would both write {}; try output_file = %(SYSTEM)s.sh"
+                raise ValueError(err.format(outputs[real_output], system, output))
+            outputs[real_output] = system
+            builds.append((system, p, output))
+
+        pending = []
+        manifests = {}
+        for system, p, output in builds:
+            cache = p.get_cache()
+            key = None
+            if cache is not None:
+                key = p.get_cache_key(p.config['stage2_dir'], manifests)
+                if cache.fetch(key, output):
+                    print("{}: {} (cached)".format(system, output))
+                    continue
+            pending.append((system, p, output, cache, key))
+        if not pending:
+            return
+
+        groups = []
+        group_of = {}
+        for item in pending:
+            payload_key = item[1].get_payload_key()
+            if payload_key not in group_of:
+                group_of[payload_key] = len(groups)
+                groups.append([])
+            groups[group_of[payload_key]].append(item)
+
+        tmpdir = tempfile.mkdtemp(prefix=self.PROG)
+        try:
+            jobs = []
+            for i, group in enumerate(groups):
+                p = group[0][1]
+                payload = os.path.join(tmpdir, "payload-{}".format(i))
+                jobs.append((p.__class__, p.config, p.options, p.config['stage2_dir'], payload))
+            # parallel codecs already keep every CPU busy on their own
+            workers = getattr(self.options, 'jobs', None)
+            if any(g[0][1].get_compression()[0].parallel for g in groups):
+                workers = 1
+            payloads = _run_jobs(_build_payload, jobs, workers)
+
+            for payload, group in zip(payloads, groups):
+                for system, p, output, cache, key in group:
+                    builder = lambda path, p=p, payload=payload: p.assemble_provisioner(path, *payload)
+                    if cache is None:
+                        builder(output)
+                    else:
+                        cache.store(key, builder, output)
+                    print("{}: {}".format(system, output))
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+    def get_cache (self):
+        # command line overrides the config file; the cache is on by default
+        from .cache import BuildCache, default_cache_dir
+        conf = self.config
+        options = self.options
+        enabled = getattr(options, 'cache', None)
+        if enabled is None:
+            enabled = config_bool(conf.get('cache', 'yes'), 'cache')
+        if not enabled:
+            return None
+
+        path = getattr(options, 'cache_dir', None) or conf.get('cache_dir') or default_cache_dir()
+        # sizes are in megabytes and ages in days, like the rest of the tools
+        max_size = config_number(conf.get('cache_max_size', '1024'), 1024*1024, 'cache_max_size')
+        max_age = config_number(conf.get('cache_max_age', '30'), 86400, 'cache_max_age')
+        return BuildCache(path, max_size, max_age)
+
+    def get_layers (self, stage2_dir):
+        # stage2_dir, then the directories unpacked over it, in order
+        layers = [stage2_dir]
+        for line in self.config.get('stage2_layers', '').splitlines():
+            if line.strip():
+                layers.append(line.strip())
+        for layer in layers[1:]:
+            if not os.path.isdir(layer):
+                raise ValueError("stage2_layers entry is not a directory: {!r}".format(layer))
+        return layers
+
+    def get_manifest (self, stage2_dir, manifests=None):
+        layers = self.get_layers(stage2_dir)
+        if len(layers) == 1:
+            return self.get_tree_manifest(stage2_dir, manifests)
+        manifest = []
+        for layer in layers:
+            manifest.append("layer\t" + os.path.realpath(layer))
+            manifest.extend(self.get_tree_manifest(layer, manifests))
+        return manifest
+
+    def get_tree_manifest (self, stage2_dir, manifests=None):
+        # manifests: optional dict to share tree walks between systems
+        from .cache import tree_manifest
+        from .ignore import load_rules
+        conf = self.config
+        hash_all = config_bool(conf.get('cache_hash_contents', 'no'), 'cache_hash_contents')
+        excludes = tuple(self.get_excludes())
+        memo = (os.path.realpath(stage2_dir), hash_all, excludes)
+        if manifests is not None and memo in manifests:
+            return manifests[memo]
+        rules = load_rules(stage2_dir, excludes)
+        manifest = tree_manifest(stage2_dir, hash_all, rules=rules)
+        if manifests is not None:
+            manifests[memo] = manifest
+        return manifest
+
+    def get_cache_key (self, stage2_dir, manifests=None):
+        from .cache import cache_key
+        manifest = self.get_manifest(stage2_dir, manifests)
+        return cache_key(self.get_sfx_stub(), manifest, self.get_build_settings())
+
+    def get_layer_cache_key (self, layer):
+        from .cache import cache_key
+        settings = ['layer=' + os.path.realpath(layer)] + self.get_build_settings()
+        return cache_key('', self.get_tree_manifest(layer), settings)
+
+    def get_payload_cache_key (self, stage2_dir, manifests=None):
+        # like get_cache_key(), but shared by every system with this payload
+        from .cache import cache_key
+        manifest = self.get_manifest(stage2_dir, manifests)
+        settings = [os.path.realpath(stage2_dir)] + self.get_build_settings()
+        return cache_key('', manifest, settings)
+
+    def get_build_settings (self):
+        # anything besides the stub and the tree that changes the output bytes
+        import platform
+        from . import compression
+        codec, level = self.get_compression()
+        epoch = self.get_source_date_epoch()
+        return ['platform=' + platform.system(),
+                'compression=' + compression.format_spec(codec, level),
+                'reproducible=' + ('no' if epoch is None else str(epoch)),
+                'exclude=' + ' '.join(self.get_excludes()),
+                'dedup=' + ('yes' if self.get_dedup_enabled() else 'no')]
+
+    def get_dedup_enabled (self):
+        enabled = getattr(self.options, 'dedup', None)
+        if enabled is None:
+            enabled = config_bool(self.config.get('dedup', 'no'), 'dedup')
+        return enabled
+
+    def get_deduplicator (self, rootdir):
+        from .dedup import DigestCache, Deduplicator
+        if not self.get_dedup_enabled():
+            return None
+        # hashes persist alongside the build cache, when there is one
+        cache = self.get_cache()
+        if cache is None:
+            digests = DigestCache()
+        else:
+            digests = DigestCache.for_tree(cache.path, rootdir)
+        return Deduplicator(digests)
+
+    def get_excludes (self):
+        # patterns from the config; the tree's .provisionerignore adds more
+        from .ignore import split_patterns
+        return split_patterns(self.config.get('exclude', ''))
+
+    def get_source_date_epoch (self):
+        # None unless building reproducibly; then the timestamp for every
+        # archive member, from $SOURCE_DATE_EPOCH or the config (or 0.)
+        enabled = getattr(self.options, 'reproducible', None)
+        if enabled is None:
+            enabled = config_bool(self.config.get('reproducible', 'no'), 'reproducible')
+        if not enabled:
+            return None
+        epoch = os.environ.get('SOURCE_DATE_EPOCH') or self.config.get('source_date_epoch') or '0'
+        try:
+            return int(epoch)
+        except ValueError:
+            raise ValueError("SOURCE_DATE_EPOCH must be an integer: {!r}".format(epoch))
+
+    def get_tarinfo_filter (self):
+        epoch = self.get_source_date_epoch()
+        if epoch is None:
+            return None
+
+        def normalize (fi):
+            fi.mtime = epoch
+            fi.uid = fi.gid = 0
+            fi.uname = fi.gname = 'root'
+            if fi.isdir() or fi.mode & 0o111:
+                fi.mode = (fi.mode & ~0o7777) | 0o755
+            elif not fi.issym():
+                fi.mode = (fi.mode & ~0o7777) | 0o644
+            return fi
+        return normalize
+
+    def get_compression (self):
+        from . import compression
+        spec = getattr(self.options, 'compression', None)
+        if spec is None:
+            spec = self.config.get('compression', compression.DEFAULT_SPEC)
+        codec, level = compression.parse_spec(spec)
+        if not codec.available():
+            raise ValueError("Compression {} is not available on this host".format(codec.name))
+        return codec, level
+
+    def report_compression (self, stage2_dir):
+        # build the bare tar once, then time each codec on the same bytes
+        import tempfile
+        from . import compression
+        with tempfile.TemporaryFile() as raw:
+            self.build_payload(raw, stage2_dir, (compression.CODECS['none'], None))
+            compression.report(raw)
+
+    def profile_payload (self, stage2_dir, json_file=None):
+        from . import profiler
+        profile = profiler.profile_payload(self, stage2_dir)
+        profile.report()
+        if json_file:
+            profile.save(json_file)
+
+    def get_payload_key (self):
+        # systems with equal keys can share a single build of the payload
+        layers = [os.path.realpath(d) for d in self.get_layers(self.config['stage2_dir'])]
+        return tuple(layers) + tuple(self.get_build_settings())
+
+    def create_cached (self, cache, out_file, stage2_dir):
+        key = self.get_cache_key(stage2_dir)
+        if cache.fetch(key, out_file):
+            return
+        cache.store(key, lambda path: self.create_provisioner(path, stage2_dir), out_file)
+
+    def get_sfx_stub (self, payload_size=0, payload_sha256='0'*64):
+        # The payload fields are fixed-width, so the stub is the same length
+        # whatever their values: it can be written before the payload is
+        # built, then rewritten in place once the size and hash are known.
+        from .data import get_data
+        from .template import Template
         txt = get_data('scripts/guest.sh').decode('utf-8')
 
         # I would check that RUNNER would not be '../../pwnx0r', but the
         # provisioner could just be "exec /var/pwnx0r" instead.  Without this.
         conf = self.config
-        d = {"CUT_LINE": 1 + txt.count("\n"),
+        codec, level = self.get_compression()
+        # layers are separate archives, one after the other; tar would stop
+        # at the end-of-archive blocks of the first without -i
+        layered = len(self.get_layers(conf['stage2_dir'])) > 1
+        d = {"PAYLOAD_OFFSET": _fixed_width(0, 12),
+             "PAYLOAD_SIZE": _fixed_width(payload_size, 20),
+             "PAYLOAD_SHA256": payload_sha256,
              "CLOUD_DIR": shquote(conf.get("guest_stage2_dir", "/var/tmp/cloud-maker")),
              "RUNNER": shquote('./' + conf.get("stage2_script", "main.sh")),
+             "DECOMPRESS": codec.guest_script(),
+             "TAR_EXTRACT": 'xp -i' if layered else 'xp',
             }
 
-        return Template(txt).substitute(d)
+        # the payload starts at the byte after the (substituted) stub;
+        # tail -c counts from 1.
+        tpl = Template(txt)
+        stub_len = len(tpl.substitute(d).encode('utf-8'))
+        d["PAYLOAD_OFFSET"] = _fixed_width(1 + stub_len, 12)
+        return tpl.substitute(d)
 
-    def build_tar (self, fp, rootdir):
-        # If we're not on Windows, rely on the host's executable bits.
-        # Otherwise, split off for a massive hack.
-        tar = tarfile.open(mode='w:gz', fileobj=fp, compresslevel=9)
+    def build_payload (self, fp, stage2_dir, method=None):
+        """Write the compressed payload for stage2_dir and its layers to fp.
+
+        Each layer is a complete compressed archive, and the payload is
+        their concatenation, which every codec's decompressor reads as one
+        stream.  With the cache on, layers are compressed once and reused
+        by every build (and system) that includes them.
+        """
+        from . import fastcopy
+        layers = self.get_layers(stage2_dir)
+        cache = self.get_cache() if method is None else None
+        if len(layers) == 1 or cache is None:
+            for layer in layers:
+                self.build_tar(fp, layer, method)
+            return
+        for layer in layers:
+            member = cache.open_layer(self.get_layer_cache_key(layer),
+                                      lambda path, layer=layer: self.build_layer(path, layer))
+            with member:
+                fastcopy.copyfileobj(member, fp)
+
+    def build_layer (self, out_file, rootdir):
+        with raw_open(out_file, 'wb') as fp:
+            self.build_tar(fp, rootdir)
+
+    def build_tar (self, fp, rootdir, method=None):
+        # method: a (Codec, level) pair, overriding the configured one
+        import tarfile
+        codec, level = method or self.get_compression()
+        # with a fixed compressor header when building reproducibly
+        zfp = codec.open(fp, level, mtime=self.get_source_date_epoch())
         try:
-            if platform.system() == 'Windows':
-                self._build_tar_win(fp, rootdir, tar)
-            else:
-                self._build_tar_posix(fp, rootdir, tar)
+            tar = tarfile.open(mode='w|', fileobj=zfp, format=self.get_tar_format())
+            try:
+                self.add_tree(tar, rootdir)
+            finally:
+                tar.close()
         finally:
-            tar.close()
-
-    def _posixify (self, os_path):
-        # danger: don't pass absolute OS paths through here, only dir-relative
-        # ones. POSIX won't find "c:\\/Users/alice/..."
-        rseg = []
-        while True:
-            bit = os.path.split(os_path)
-            rseg.append(bit[1])
-            if not bit[0]:
-                break
-            os_path = bit[0]
-
-        rseg.reverse()
-        return posixpath.join(*rseg)
-
-    def _build_tar_win (self, fp, rootdir, tar):
+            zfp.close()
+
+    def get_tar_format (self):
+        # reproducible builds need a format that doesn't vary with the
+        # Python version
+        import tarfile
+        if self.get_source_date_epoch() is None:
+            return tarfile.DEFAULT_FORMAT
+        return tarfile.PAX_FORMAT
+
+    def add_tree (self, tar, rootdir):
+        """Add the payload's members for rootdir to the open TarFile."""
+        import platform
+        from .walker import SkipStats
+        skipped = SkipStats()
+        dedup = self.get_deduplicator(rootdir)
+        # If we're not on Windows, rely on the host's executable bits.
+        # Otherwise, split off for a massive hack.
+        if platform.system() == 'Windows':
+            self._build_tar_win(rootdir, tar, skipped, dedup)
+        else:
+            self._build_tar_posix(rootdir, tar, skipped, dedup)
+        if skipped:
+            print("{}: {}".format(rootdir, skipped.summary()), file=sys.stderr)
+        if dedup is not None:
+            dedup.digests.save()
+            if dedup:
+                print("{}: {}".format(rootdir, dedup.summary()), file=sys.stderr)
+
+    def walk (self, rootdir, skipped=None):
+        # the payload's view of the tree: sorted, minus excluded entries
+        from .ignore import load_rules
+        from .walker import scan_tree
+        rules = load_rules(rootdir, self.get_excludes())
+        return scan_tree(rootdir, rules, skipped)
+
+    def _build_tar_win (self, rootdir, tar, skipped=None, dedup=None):
         # Python's archive builders don't set anything executable inside the
         # archive on Windows, which the guest needs.  We set the x-bit inside
         # the archive based on whether the file 'looks executable' (begins
         # with a shebang, or ELF magic.)
         #
-        # We can't use tar.add() with a filter, because the TarInfo doesn't
-        # have the external path to examine. Nor does it generate names
-        # relative to the root.  We don't want to pack things as
+        # The walker names entries relative to the root, with POSIX
+        # separators; we don't want to pack things as
         # "/Users/betty/provisioner/aws/stage2.sh"...
-        for container, dirs, files in os.walk(rootdir):
-            tar_dir = self._posixify(os.path.relpath(container, rootdir))
-            if tar_dir == '.':
-                tar_dir = ''
-            for dname in dirs:
-                # abs_name: fully-qualified host OS path
-                # tar_dir: in-tar dirname (always POSIX)
-                abs_name = os.path.join(container, dname)
-                fi = tar.gettarinfo(abs_name, posixpath.join(tar_dir, dname))
-                fi.mode &= 0o755
-                tar.addfile(fi)
-
-            for fname in files:
-                abs_name = os.path.join(container, fname)
-                fi = tar.gettarinfo(abs_name, posixpath.join(tar_dir, fname))
-                fi.mode &= 0o755
-                with raw_open(abs_name, 'rb') as magic:
-                    zero = magic.tell()
-                    try:
+        from .dedup import link_tarinfo, member_meta
+        from .walker import add_member, make_tarinfo, read_ahead
+        normalize = self.get_tarinfo_filter() or (lambda fi: fi)
+        for entry, data in read_ahead(self.walk(rootdir, skipped)):
+            fi = make_tarinfo(tar, entry)
+            if fi is None:
+                continue
+            fi.mode &= 0o755
+            if not fi.isreg():
+                tar.addfile(normalize(fi))
+                continue
+
+            target = None
+            if dedup is not None:
+                # the same contents get the same x-bits below
+                target = dedup.link_target(entry.path, fi.name, entry.st, data,
+                                           member_meta(normalize(fi)))
+            if target is not None:
+                tar.addfile(normalize(link_tarinfo(fi, target)))
+                continue
+            if data is not None:
+                m4 = data[:4]
+            else:
+                try:
+                    with raw_open(entry.path, 'rb') as magic:
                         m4 = magic.read(4)
-                        if m4.startswith(b'#!') or m4 == b'\x7fELF':
-                            fi.mode |= 0o111
-                    except Exception as e:
-                        print("exec hack for " + abs_name + ": " + str(e))
-                    finally:
-                        magic.seek(zero, 0)
-                    # add fully-constructed fileinfo to archive
-                    tar.addfile(fi, magic)
-
-    def _build_tar_posix (self, fp, rootdir, tar):
-        # a stripped-down _build_tar_win(), see there for detail
-        for container, dirs, files in os.walk(rootdir):
-            tar_dir = self._posixify(os.path.relpath(container, rootdir))
-            for fname in files:
-                abs_name = os.path.join(container, fname)
-                tar.add(abs_name, arcname=posixpath.join(tar_dir, fname))
-
-    def create_provisioner (self, out_file, stage2_dir):
+                except Exception as e:
+                    print("exec hack for " + entry.path + ": " + str(e))
+                    m4 = b''
+            if m4.startswith(b'#!') or m4 == b'\x7fELF':
+                fi.mode |= 0o111
+            # add fully-constructed fileinfo to archive
+            add_member(tar, normalize(fi), entry, data)
+
+    def _build_tar_posix (self, rootdir, tar, skipped=None, dedup=None):
+        # a stripped-down _build_tar_win(), see there for detail.  Only
+        # non-directories are packed; tar creates their parents as needed.
+        from .dedup import link_tarinfo, member_meta
+        from .walker import add_member, make_tarinfo, read_ahead
+        normalize = self.get_tarinfo_filter() or (lambda fi: fi)
+        for entry, data in read_ahead(self.walk(rootdir, skipped)):
+            if entry.is_dir:
+                continue
+            fi = make_tarinfo(tar, entry)
+            if fi is None:
+                continue
+            if dedup is not None and fi.isreg():
+                target = dedup.link_target(entry.path, fi.name, entry.st, data,
+                                           member_meta(normalize(fi)))
+                if target is not None:
+                    tar.addfile(normalize(link_tarinfo(fi, target)))
+                    continue
+            add_member(tar, normalize(fi), entry, data)
+
+    def create_provisioner (self, out_file, stage2_dir, build_payload=None):
+        # build_payload(fp, stage2_dir) writes the payload, if not the usual way
+        import tempfile
+        from . import compression, fastcopy
+        from .cache import break_link
+        build_payload = build_payload or self.build_payload
+        break_link(out_file)
+        with raw_open(out_file, 'wb') as sfx:
+            if not _seekable(sfx):
+                # can't patch the stub afterward, so build the payload aside
+                with tempfile.TemporaryFile() as tgz:
+                    payload = compression.HashingWriter(tgz)
+                    build_payload(payload, stage2_dir)
+                    tgz.seek(0, os.SEEK_SET)
+                    stub = self.get_sfx_stub(payload.size, payload.hexdigest())
+                    sfx.write(stub.encode('utf-8'))
+                    fastcopy.copyfileobj(tgz, sfx)
+                return
+
+            # write a placeholder SFX stub to the provisioner
+            zero = sfx.tell()
+            stub = self.get_sfx_stub().encode('utf-8')
+            sfx.write(stub)
+
+            # then stream the payload archive right after it; tarfile only
+            # writes (never seeks) in stream mode, so no tmpfile is needed.
+            payload = compression.HashingWriter(sfx)
+            build_payload(payload, stage2_dir)
+
+            # and fill in the payload's size and hash
+            final = self.get_sfx_stub(payload.size, payload.hexdigest()).encode('utf-8')
+            if len(final) != len(stub):
+                raise RuntimeError("SFX stub changed length from {} to {}".format(len(stub), len(final)))
+            sfx.seek(zero, os.SEEK_SET)
+            sfx.write(final)
+
+    def assemble_provisioner (self, out_file, payload_file, payload_size, payload_sha256):
+        # like create_provisioner(), with an already-built payload
+        from . import fastcopy
+        from .cache import break_link
+        break_link(out_file)
         with raw_open(out_file, 'wb') as sfx:
-            # write the SFX stub to the provisioner
-            sfx.write(self.get_sfx_stub().encode('utf-8'))
+            sfx.write(self.get_sfx_stub(payload_size, payload_sha256).encode('utf-8'))
+            with raw_open(payload_file, 'rb') as payload:
+                fastcopy.copyfileobj(payload, sfx)
 
-            # create the tmpfile for the payload archive to be attached
-            with tempfile.TemporaryFile() as tgz:
-                # tarfile can't write into a non-zero position
-                zero = tgz.tell()
-                self.build_tar(tgz, stage2_dir)
-                tgz.seek(zero, 0)
-                shutil.copyfileobj(tgz, sfx)
+def _fixed_width (n, width):
+    # shell assignments end at whitespace, so pad with spaces, not zeros
+    text = str(n)
+    if len(text) > width:
+        raise ValueError("{} does not fit in {} digits".format(n, width))
+    return text.ljust(width)
+
+def _seekable (fp):
+    try:
+        return fp.seekable()
+    except AttributeError:
+        try:
+            fp.seek(0, os.SEEK_CUR)
+            return True
+        except (IOError, OSError):
+            return False
+
+def _build_payload (cls, config, options, stage2_dir, payload_file):
+    # runs in a worker process: build one payload archive into a file
+    from . import compression
+    p = cls()
+    p.config = config
+    p.options = options
+    with raw_open(payload_file, 'wb') as fp:
+        payload = compression.HashingWriter(fp)
+        p.build_payload(payload, stage2_dir)
+    return payload_file, payload.size, payload.hexdigest()
+
+def _run_jobs (fn, jobs, workers=None):
+    # fn(*job) for each job, in a process pool when there's more than one
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:
+        ProcessPoolExecutor = None # Python 2 without the futures backport
+    if len(jobs) < 2 or ProcessPoolExecutor is None or workers == 1:
+        return [fn(*job) for job in jobs]
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(fn, *job) for job in jobs]
+        return [f.result() for f in futures]
 
 def main ():
     try:
@@ -197,5 +685,6 @@ def main ():
     except SystemExit as e:
         return e.code
     except:
+        import traceback
         traceback.print_exc()
         return 2
@@ -0,0 +1,265 @@
+# vim: fileencoding=utf-8
+"""Benchmarks for make_provisioner's packing steps.
+
+Run with ``python -m make_provisioner.bench``.  Synthetic stage2 trees are
+generated in a temporary directory, so this runs offline; each phase of a
+build is timed separately, and the results can be saved as JSON and
+compared with an earlier run.
+
+With ``--startup``, it instead times importing each command's entry point
+(with ``python -X importtime``), and fails if any is over its budget.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+from argparse import ArgumentParser, Namespace
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import VERSION
+from . import compression
+from .app import Provisioner
+
+PHASES = ('config', 'walk', 'tar', 'compress', 'write')
+
+def _random_bytes (rng, n):
+    try:
+        return rng.getrandbits(8 * n).to_bytes(n, 'little') if n else b''
+    except AttributeError:
+        return os.urandom(n) # Python 2
+
+def _write (path, data):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def make_tiny (root, rng, scale):
+    # many small shell scripts: per-file overhead dominates
+    for i in range(int(5000 * scale)):
+        body = "#!/bin/sh\n# script {}\n".format(i) + "echo step {}\n".format(rng.randint(0, 99)) * rng.randint(1, 20)
+        _write(os.path.join(root, "d{:02d}".format(i % 50), "s{:05d}.sh".format(i)), body.encode('utf-8'))
+
+def make_large (root, rng, scale):
+    # a few big, moderately compressible binaries (repeated random blocks)
+    blocks = [_random_bytes(rng, 4096) for _ in range(64)]
+    for i in range(4):
+        n = int(8192 * scale)
+        data = b''.join(blocks[rng.randrange(len(blocks))] for _ in range(n))
+        _write(os.path.join(root, "pkg{}.bin".format(i)), data)
+
+def make_deep (root, rng, scale):
+    # deep nesting: directory handling and long names
+    for branch in range(int(20 * scale) or 1):
+        path = root
+        for depth in range(30):
+            path = os.path.join(path, "level{:02d}-{}".format(depth, branch))
+            _write(os.path.join(path, "f.txt"), "depth {}\n".format(depth).encode('utf-8') * 10)
+
+def make_random (root, rng, scale):
+    # incompressible data: the compressor can only lose
+    for i in range(4):
+        _write(os.path.join(root, "noise{}.dat".format(i)), _random_bytes(rng, int(16*1024*1024 * scale)))
+
+SHAPES = [('tiny', make_tiny), ('large', make_large), ('deep', make_deep), ('random', make_random)]
+
+# entry point modules, and their import time budgets in milliseconds: a few
+# times what they take on a laptop, to catch a heavy import sneaking back in.
+STARTUP_BUDGETS = [('make_provisioner.app', 40), ('fedora2ova.app', 40), ('cloud_maker.__main__', 20)]
+
+
+class _MemoryWriter (object):
+    # keeps the bytes in memory, so compress doesn't measure disk
+    def __init__ (self):
+        self.size = 0
+        self.chunks = []
+
+    def write (self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush (self):
+        pass
+
+
+def _timed (fn):
+    start = time.time()
+    result = fn()
+    return time.time() - start, result
+
+def bench_tree (workdir, root, spec, repeat=1):
+    """Time each phase of building a provisioner for root.
+
+    Each phase runs repeat times, and the fastest time is kept.
+    """
+    ini_path = os.path.join(workdir, 'bench.ini')
+    with open(ini_path, 'w') as f:
+        f.write("[bench]\nstage2_dir = {}\ncompression = {}\n".format(root, spec))
+    out_path = os.path.join(workdir, 'provisioner.sh')
+    codec, level = compression.parse_spec(spec)
+
+    times = dict((phase, []) for phase in PHASES)
+    result = {}
+    for _ in range(repeat):
+        p = Provisioner()
+        p.options = Namespace(cache=False)
+        seconds, _ = _timed(lambda: p.read_config('bench', ini_path))
+        times['config'].append(seconds)
+
+        seconds, entries = _timed(lambda: sum(1 for e in p.walk(root) if not e.is_dir))
+        times['walk'].append(seconds)
+        result['files'] = entries
+
+        with tempfile.TemporaryFile() as raw:
+            seconds, _ = _timed(lambda: p.build_tar(raw, root, (compression.CODECS['none'], None)))
+            times['tar'].append(seconds)
+            result['raw_bytes'] = raw.tell()
+
+            raw.seek(0, os.SEEK_SET)
+            sink = _MemoryWriter()
+            seconds, _ = _timed(lambda: compression.compress_file(raw, sink, codec, level))
+            times['compress'].append(seconds)
+            result['compressed_bytes'] = sink.size
+
+        # write times only the stub and copying out the finished payload
+        payload_path = os.path.join(workdir, 'payload')
+        with open(payload_path, 'wb') as f:
+            payload = compression.HashingWriter(f)
+            for chunk in sink.chunks:
+                payload.write(chunk)
+        del sink
+        seconds, _ = _timed(lambda: p.assemble_provisioner(out_path, payload_path, payload.size,
+                                                            payload.hexdigest()))
+        times['write'].append(seconds)
+        result['output_bytes'] = os.path.getsize(out_path)
+        os.unlink(out_path)
+        os.unlink(payload_path)
+
+    result['seconds'] = dict((phase, min(t)) for phase, t in times.items())
+    return result
+
+def run (shapes, spec, scale=1.0, repeat=1, seed=0, out=sys.stdout):
+    workdir = tempfile.mkdtemp(prefix='make_provisioner-bench')
+    try:
+        results = {}
+        for name, make in SHAPES:
+            if name not in shapes:
+                continue
+            root = os.path.join(workdir, name)
+            os.makedirs(root)
+            make(root, random.Random(seed), scale)
+            results[name] = bench_tree(workdir, root, spec, repeat)
+            print_result(name, results[name], out)
+    finally:
+        shutil.rmtree(workdir, True)
+    return {
+        'version': VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.time(),
+        'compression': spec,
+        'scale': scale,
+        'results': results,
+    }
+
+def print_result (name, result, out=sys.stdout):
+    secs = result['seconds']
+    print("{:<8} {:>7} files {:>13,} raw {:>13,} out  ".format(
+        name, result['files'], result['raw_bytes'], result['output_bytes']) +
+          ' '.join("{} {:.3f}s".format(phase, secs[phase]) for phase in PHASES), file=out)
+
+def compare (old, new, out=sys.stdout):
+    """Print each phase's change from the old run to the new one."""
+    print("{:<8} {:<9} {:>9} {:>9} {:>8}".format('tree', 'phase', 'before', 'after', 'change'), file=out)
+    for name in sorted(new['results']):
+        if name not in old.get('results', {}):
+            continue
+        before = old['results'][name]
+        after = new['results'][name]
+        rows = [(phase, before['seconds'][phase], after['seconds'][phase], 's') for phase in PHASES]
+        rows.append(('size', before['output_bytes'], after['output_bytes'], 'B'))
+        for label, a, b, unit in rows:
+            change = (float(b) - a) / a * 100 if a else 0.0
+            if unit == 's':
+                print("{:<8} {:<9} {:>8.3f}s {:>8.3f}s {:>+7.1f}%".format(name, label, a, b, change), file=out)
+            else:
+                print("{:<8} {:<9} {:>9,} {:>9,} {:>+7.1f}%".format(name, label, a, b, change), file=out)
+
+def import_time (module, repeat=5):
+    """Return the fastest time, in seconds, to import module in a new python."""
+    best = None
+    for _ in range(repeat):
+        proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError("Importing {} failed:\n{}".format(module, err.decode('utf-8', 'replace')))
+        # lines are "import time: self [us] | cumulative | name", nested
+        # imports indented; the module itself comes last.
+        for line in err.decode('utf-8', 'replace').splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == module:
+                micros = int(fields[1].strip())
+                if best is None or micros < best:
+                    best = micros
+    if best is None:
+        raise RuntimeError("python -X importtime did not report {} (Python 3.7+ is needed)".format(module))
+    return best / 1e6
+
+def check_startup (scale=1.0, repeat=5, out=sys.stdout):
+    """Print each entry point's import time; return whether all are in budget."""
+    ok = True
+    print("{:<22} {:>9} {:>9}".format('module', 'ms', 'budget'), file=out)
+    for module, budget in STARTUP_BUDGETS:
+        ms = import_time(module, repeat) * 1000
+        over = ms > budget * scale
+        ok = ok and not over
+        print("{:<22} {:>9.1f} {:>9.1f}{}".format(module, ms, budget * scale, '  OVER' if over else ''), file=out)
+    return ok
+
+def main (args=sys.argv[1:]):
+    p = ArgumentParser(prog='python -m make_provisioner.bench',
+                       description="Time make_provisioner's packing steps on synthetic trees")
+    p.add_argument('--shape', action='append', choices=[name for name, _ in SHAPES],
+                   help='Only benchmark this tree shape (repeatable; default all)')
+    p.add_argument('--compression', '-z', default=compression.DEFAULT_SPEC, metavar='CODEC[:LEVEL]',
+                   help='Compression to benchmark ({})'.format(compression.DEFAULT_SPEC))
+    p.add_argument('--scale', type=float, default=1.0,
+                   help='Multiply tree sizes by SCALE (1.0)')
+    p.add_argument('--repeat', '-r', type=int, default=1,
+                   help='Run each phase N times and keep the fastest (1)')
+    p.add_argument('--seed', type=int, default=0,
+                   help='Seed for generating the trees (0)')
+    p.add_argument('--output', '-o', metavar='FILE',
+                   help='Save results as JSON to FILE')
+    p.add_argument('--compare', metavar='FILE',
+                   help='Compare results with an earlier JSON run from FILE')
+    p.add_argument('--startup', action='store_true',
+                   help='Instead, time importing each entry point, and fail if any is over budget')
+    p.add_argument('--budget-scale', type=float, default=1.0, metavar='FACTOR',
+                   help='With --startup, multiply the budgets by FACTOR, for slow machines (1.0)')
+    options = p.parse_args(args)
+    if options.startup:
+        return 0 if check_startup(options.budget_scale, max(options.repeat, 5)) else 1
+
+    shapes = options.shape or [name for name, _ in SHAPES]
+    results = run(shapes, options.compression, options.scale, options.repeat, options.seed)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare, 'r') as f:
+            compare(json.load(f), results)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,205 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import hashlib
+import os
+import os.path
+import shutil
+import stat
+import tempfile
+import time
+
+from cloud_maker.util import file_digest, mtime_key
+
+# bump this to invalidate every existing cache entry after a format change
+CACHE_FORMAT = 1
+ENTRY_SUFFIX = '.sh'
+# compressed payload layers, which provisioners are assembled from
+LAYER_SUFFIX = '.layer'
+# Files modified this recently may change again without their size or mtime
+# changing (coarse filesystem timestamps), so their contents get hashed.
+RACY_SECONDS = 2.0
+
+_replace = getattr(os, 'replace', os.rename)
+
+def default_cache_dir ():
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'cloud-maker')
+
+def tree_manifest (rootdir, hash_all=False, now=None, rules=None):
+    """Describe the tree under rootdir as a sorted list of text lines.
+
+    Each line holds the relative path, type, mode, size, and mtime of one
+    entry.  Regular files also carry a content hash when hash_all is set, or
+    when they were modified too recently for their mtime to be trusted.
+    Entries that the IgnoreRules exclude from the payload are left out.
+    """
+    from .walker import scan_tree
+    if now is None:
+        now = time.time()
+    lines = []
+    for entry in scan_tree(rootdir, rules):
+        st = entry.st
+        mode = st.st_mode
+        if stat.S_ISLNK(mode):
+            extra = os.readlink(entry.path)
+        elif stat.S_ISREG(mode) and (hash_all or now - st.st_mtime < RACY_SECONDS):
+            extra = file_digest(entry.path)
+        else:
+            extra = '-'
+        lines.append("{}\t{:o}\t{}\t{}\t{}".format(
+            entry.name, mode, st.st_size, mtime_key(st), extra))
+    return lines
+
+def cache_key (stub, manifest, settings=()):
+    h = hashlib.sha256()
+    h.update("cloud-maker cache {}\n".format(CACHE_FORMAT).encode('utf-8'))
+    for item in settings:
+        h.update("{}\n".format(item).encode('utf-8'))
+    h.update(stub.encode('utf-8'))
+    h.update(b'\0')
+    for line in manifest:
+        h.update(line.encode('utf-8', 'surrogateescape') + b'\n')
+    return h.hexdigest()
+
+def _umask ():
+    mask = os.umask(0o022)
+    os.umask(mask)
+    return mask
+
+def break_link (path):
+    # The output may be a hard link into the cache; writing through it in
+    # place would corrupt the cache entry, so drop that name first.  Special
+    # files (say, /dev/stdout) are left alone.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+        os.unlink(path)
+
+def place_file (src, dst):
+    """Put src at dst, as a hard link if possible, or else as a copy."""
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            return
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        shutil.copyfile(src, dst)
+
+class BuildCache (object):
+    """A directory of built provisioners, named by their cache key.
+
+    Compressed payload layers are kept here too, and evicted alongside.
+
+    max_size is in bytes, max_age in seconds; either may be None to disable
+    that kind of eviction.
+    """
+    path = None
+    max_size = None
+    max_age = None
+
+    def __init__ (self, path, max_size=None, max_age=None):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+
+    def entry_path (self, key, suffix=ENTRY_SUFFIX):
+        return os.path.join(self.path, key + suffix)
+
+    def fetch (self, key, out_file):
+        """Place the cached build for key at out_file; return success."""
+        entry = self.entry_path(key)
+        if not os.path.isfile(entry):
+            return False
+        # refresh the timestamp that LRU eviction goes by
+        os.utime(entry, None)
+        place_file(entry, out_file)
+        return True
+
+    def store (self, key, builder, out_file):
+        """Run builder(path) to create the entry for key, then place it."""
+        entry = self._build(key, builder, ENTRY_SUFFIX)
+        place_file(entry, out_file)
+
+    def open_layer (self, key, builder):
+        """Open the layer for key (binary, for reading), running
+        builder(path) first if it isn't cached.
+
+        Another build may evict the entry at any time, so it's held open
+        instead of reopened by name: the open file stays readable after
+        the entry is unlinked (and Windows won't unlink it at all.)
+        """
+        entry = self.entry_path(key, LAYER_SUFFIX)
+        try:
+            fp = open(entry, 'rb')
+        except (IOError, OSError):
+            return self._build(key, builder, LAYER_SUFFIX, hold=True)[1]
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass # evicted already; we still have it
+        return fp
+
+    def _build (self, key, builder, suffix, hold=False):
+        # hold: also return the entry opened for reading, before evicting
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        entry = self.entry_path(key, suffix)
+        fd, tmp_name = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        os.close(fd)
+        try:
+            # mkstemp is private; give the entry the usual new-file mode
+            os.chmod(tmp_name, 0o666 & ~_umask())
+            builder(tmp_name)
+            _replace(tmp_name, entry)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+        if not hold:
+            self.evict(keep=entry)
+            return entry
+        fp = open(entry, 'rb')
+        self.evict(keep=entry)
+        return entry, fp
+
+    def entries (self):
+        """List (path, stat) of every entry, oldest first."""
+        found = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return found
+        for name in names:
+            if not name.endswith((ENTRY_SUFFIX, LAYER_SUFFIX)):
+                continue
+            entry = os.path.join(self.path, name)
+            try:
+                found.append((entry, os.stat(entry)))
+            except OSError:
+                pass
+        found.sort(key=lambda e: e[1].st_mtime)
+        return found
+
+    def evict (self, keep=None, now=None):
+        # keep: the path of an entry to spare, usually the one just built
+        if now is None:
+            now = time.time()
+        entries = self.entries()
+        total = sum(st.st_size for _, st in entries)
+        for entry, st in entries:
+            if entry == keep:
+                continue
+            too_old = self.max_age is not None and now - st.st_mtime > self.max_age
+            too_big = self.max_size is not None and total > self.max_size
+            if not (too_old or too_big):
+                continue
+            try:
+                os.unlink(entry)
+            except OSError:
+                continue
+            total -= st.st_size
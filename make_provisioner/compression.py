@@ -0,0 +1,349 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import collections
+import gzip
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None # Python 2 without the futures backport
+try:
+    import lzma
+except ImportError:
+    lzma = None # Python 2; fall back to the xz command
+try:
+    from compression import zstd as _zstd_std # Python 3.14+
+except ImportError:
+    _zstd_std = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+from cloud_maker.util import cpu_count
+
+DEFAULT_SPEC = 'gzip:9'
+
+# specs tried by the --compression-report table
+REPORT_SPECS = ['none', 'gzip:1', 'gzip:6', 'gzip:9', 'pgzip:6', 'pgzip:9',
+                'xz:1', 'xz:6', 'xz:9', 'zstd:3', 'zstd:10', 'zstd:19']
+
+
+class _Passthrough (object):
+    # a writer that leaves the underlying file open when closed
+    def __init__ (self, fp):
+        self.fp = fp
+
+    def write (self, data):
+        self.fp.write(data)
+        return len(data)
+
+    def close (self):
+        self.fp.flush()
+
+
+class HashingWriter (object):
+    """Pass writes through to fp, keeping their SHA-256 and total size."""
+    def __init__ (self, fp):
+        self.fp = fp
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def write (self, data):
+        self.fp.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush (self):
+        self.fp.flush()
+
+    def hexdigest (self):
+        return self.sha256.hexdigest()
+
+
+class _PipeWriter (object):
+    """Compress by feeding an external command, whose output goes to fp.
+
+    fp only needs a write() method; a thread copies the command's output to
+    it, so fp can be another wrapper rather than a real file.
+    """
+    def __init__ (self, cmd, fp, bufsize=1024*1024):
+        self.cmd = cmd
+        self.fp = fp
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.error = None
+        self.reader = threading.Thread(target=self._pump, args=(bufsize,))
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _pump (self, bufsize):
+        try:
+            while True:
+                buf = self.proc.stdout.read(bufsize)
+                if not buf:
+                    break
+                self.fp.write(buf)
+        except Exception as e:
+            self.error = e
+
+    def write (self, data):
+        self.proc.stdin.write(data)
+        return len(data)
+
+    def close (self):
+        self.proc.stdin.close()
+        self.reader.join()
+        rc = self.proc.wait()
+        if self.error is not None:
+            raise self.error
+        if rc != 0:
+            raise RuntimeError("Compressor {} failed with exit code {}".format(self.cmd[0], rc))
+
+
+def _gzip_member (data, level):
+    # runs in a worker process: one complete, independent gzip member
+    z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return z.compress(data) + z.flush()
+
+
+class _ParallelGzipWriter (object):
+    """Write a gzip file as a series of members compressed in parallel.
+
+    Concatenated members are a valid gzip file, which gzip -d (and Python's
+    gzip module) will decompress as a single stream.  Each chunk loses the
+    window of the chunk before it, which costs a little in size.
+    """
+    def __init__ (self, fp, level, workers=None, chunk_size=4*1024*1024):
+        self.fp = fp
+        self.level = level
+        self.workers = workers or cpu_count()
+        self.chunk_size = chunk_size
+        self.buf = []
+        self.buf_len = 0
+        self.pending = collections.deque()
+        self.pool = ProcessPoolExecutor(self.workers)
+
+    def write (self, data):
+        self.buf.append(data)
+        self.buf_len += len(data)
+        if self.buf_len >= self.chunk_size:
+            self._submit()
+        return len(data)
+
+    def _submit (self):
+        data = b''.join(self.buf)
+        self.buf = []
+        self.buf_len = 0
+        for start in range(0, len(data), self.chunk_size):
+            chunk = data[start:start+self.chunk_size]
+            self.pending.append(self.pool.submit(_gzip_member, chunk, self.level))
+        # bound memory: keep only a couple of chunks per worker in flight
+        while len(self.pending) > 2 * self.workers:
+            self.fp.write(self.pending.popleft().result())
+
+    def close (self):
+        try:
+            if self.buf_len:
+                self._submit()
+            while self.pending:
+                self.fp.write(self.pending.popleft().result())
+        finally:
+            self.pool.shutdown()
+
+
+class Codec (object):
+    """A payload compression method, for both the host and the guest.
+
+    Each codec has an open(fp, level, mtime=None) method, returning a
+    writer that compresses into the binary file fp at the given level and
+    whose close() finishes the stream without closing fp.  mtime is the
+    timestamp for formats with one in their header (or None for the
+    current time.)
+
+    guest_commands lists shell pipelines to decompress stdin to stdout; the
+    stub uses the first one whose program exists on the guest.
+    """
+    name = None
+    default_level = None
+    min_level = None
+    max_level = None
+    parallel = False
+    guest_commands = ()
+
+    def available (self):
+        return True
+
+    def guest_script (self, indent='    '):
+        lines = []
+        for cmd in self.guest_commands:
+            prog = cmd.split(None, 1)[0]
+            test = 'elif' if lines else 'if'
+            lines.append("{} command -v {} >/dev/null 2>&1; then".format(test, prog))
+            lines.append("{}decompress () {{ {}; }}".format(indent, cmd))
+        lines.append("else")
+        lines.append("{}echo \"No {} decompressor found (any of: {})\" >&2".format(
+            indent, self.name, ' '.join(c.split(None, 1)[0] for c in self.guest_commands)))
+        lines.append("{}exit 1".format(indent))
+        lines.append("fi")
+        return "\n".join(lines)
+
+def _python_fallbacks (code):
+    # every python the guest might have, as a last resort
+    return tuple("{} -c '{}'".format(py, code) for py in ('python3', 'python'))
+
+_PY_COPY = "import sys, shutil; i = getattr(sys.stdin, \"buffer\", sys.stdin); o = getattr(sys.stdout, \"buffer\", sys.stdout); "
+
+
+class NoCodec (Codec):
+    name = 'none'
+    guest_commands = ('cat',)
+
+    def open (self, fp, level, mtime=None):
+        return _Passthrough(fp)
+
+
+class GzipCodec (Codec):
+    name = 'gzip'
+    default_level = 9
+    min_level = 1
+    max_level = 9
+    guest_commands = ('gzip -dc',) + _python_fallbacks(
+        _PY_COPY + "import gzip; shutil.copyfileobj(gzip.GzipFile(fileobj=i), o)")
+
+    def open (self, fp, level, mtime=None):
+        return gzip.GzipFile(filename='', mode='wb', compresslevel=level,
+                             fileobj=fp, mtime=mtime)
+
+
+class ParallelGzipCodec (GzipCodec):
+    name = 'pgzip'
+    parallel = True
+
+    def available (self):
+        return ProcessPoolExecutor is not None
+
+    def open (self, fp, level, mtime=None):
+        # zlib always writes a zero mtime in its gzip headers
+        return _ParallelGzipWriter(fp, level)
+
+
+class XzCodec (Codec):
+    name = 'xz'
+    default_level = 6
+    min_level = 0
+    max_level = 9
+    guest_commands = ('xz -dc', 'unxz -c') + _python_fallbacks(
+        _PY_COPY + "import lzma; shutil.copyfileobj(lzma.LZMAFile(i), o)")
+
+    def available (self):
+        return lzma is not None or which('xz') is not None
+
+    def open (self, fp, level, mtime=None):
+        if lzma is not None:
+            return lzma.LZMAFile(fp, 'wb', preset=level)
+        return _PipeWriter(['xz', '-{}'.format(level), '-c'], fp)
+
+
+class ZstdCodec (Codec):
+    name = 'zstd'
+    default_level = 3
+    min_level = 1
+    max_level = 19
+    # Python only has zstd built in from 3.14; before that, it needs the
+    # zstandard package, and says so if it has neither.
+    guest_commands = ('zstd -dc', 'unzstd -c') + _python_fallbacks(
+        _PY_COPY + "\n"
+        "try:\n"
+        "    from compression import zstd; f = zstd.ZstdFile(i)\n"
+        "except ImportError:\n"
+        "    try:\n"
+        "        import zstandard\n"
+        "    except ImportError:\n"
+        "        sys.exit(\"No zstd decompressor found (zstd, or Python 3.14+, or the zstandard package)\")\n"
+        "    f = zstandard.ZstdDecompressor().stream_reader(i, read_across_frames=True)\n"
+        "shutil.copyfileobj(f, o)")
+
+    def available (self):
+        return _zstd_std is not None or zstandard is not None or which('zstd') is not None
+
+    def open (self, fp, level, mtime=None):
+        if _zstd_std is not None:
+            return _zstd_std.ZstdFile(fp, 'wb', level=level)
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=level).stream_writer(fp, closefd=False)
+        return _PipeWriter(['zstd', '-{}'.format(level), '-q', '-c'], fp)
+
+
+CODECS = collections.OrderedDict((c.name, c) for c in (
+    NoCodec(), GzipCodec(), ParallelGzipCodec(), XzCodec(), ZstdCodec()))
+
+def parse_spec (spec):
+    """Parse 'codec[:level]' into a (Codec, level) pair."""
+    name, _, level = spec.strip().lower().partition(':')
+    try:
+        codec = CODECS[name]
+    except KeyError:
+        err = "Unknown compression {!r} (expected one of: {})"
+        raise ValueError(err.format(name, ', '.join(CODECS)))
+
+    if not level:
+        return codec, codec.default_level
+    if codec.default_level is None:
+        raise ValueError("Compression {} takes no level: {!r}".format(name, spec))
+    try:
+        level = int(level)
+    except ValueError:
+        raise ValueError("Compression level must be a number: {!r}".format(spec))
+    if not (codec.min_level <= level <= codec.max_level):
+        err = "Compression level for {} must be {}-{}: {!r}"
+        raise ValueError(err.format(name, codec.min_level, codec.max_level, spec))
+    return codec, level
+
+def format_spec (codec, level):
+    if level is None:
+        return codec.name
+    return "{}:{}".format(codec.name, level)
+
+def compress_file (src, dst, codec, level, bufsize=1024*1024):
+    zfp = codec.open(dst, level)
+    try:
+        while True:
+            buf = src.read(bufsize)
+            if not buf:
+                break
+            zfp.write(buf)
+    finally:
+        zfp.close()
+
+def report (raw_fp, specs=REPORT_SPECS, out=sys.stdout):
+    """Print the time and size each spec takes to compress raw_fp."""
+    raw_fp.seek(0, os.SEEK_END)
+    raw_size = raw_fp.tell()
+    print("{:<10} {:>14} {:>7} {:>9}".format('codec', 'bytes', 'ratio', 'seconds'), file=out)
+    for spec in specs:
+        codec, level = parse_spec(spec)
+        if not codec.available():
+            print("{:<10} {:>14}".format(spec, 'unavailable'), file=out)
+            continue
+        raw_fp.seek(0, os.SEEK_SET)
+        with tempfile.TemporaryFile() as dst:
+            start = time.time()
+            compress_file(raw_fp, dst, codec, level)
+            dst.flush()
+            elapsed = time.time() - start
+            size = dst.tell()
+        ratio = float(size) / raw_size if raw_size else 1.0
+        print("{:<10} {:>14,} {:>7.3f} {:>9.2f}".format(spec, size, ratio, elapsed), file=out)
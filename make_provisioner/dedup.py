@@ -0,0 +1,137 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import hashlib
+import json
+import os
+import os.path
+import stat
+import tarfile
+import tempfile
+import time
+
+from .cache import RACY_SECONDS, file_digest, mtime_key
+
+_replace = getattr(os, 'replace', os.rename)
+
+class DigestCache (object):
+    """Content hashes of files, keyed by (device, inode, size, mtime).
+
+    When path is set, the hashes are loaded from and saved to that JSON
+    file, so later builds don't reread unchanged files.  Only the hashes
+    used since loading are saved, which keeps the file to one tree's worth.
+    A file modified too recently for its mtime to be trusted (see
+    cache.tree_manifest) is always hashed, and its hash isn't kept.
+    """
+    path = None
+
+    def __init__ (self, path=None):
+        self.path = path
+        self.known = {}
+        self.used = {}
+        if path is not None and os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    self.known = json.load(f)
+            except ValueError:
+                pass # corrupt cache: start over
+
+    @classmethod
+    def for_tree (cls, cache_dir, rootdir):
+        name = hashlib.sha1(os.path.realpath(rootdir).encode('utf-8')).hexdigest()[:16]
+        return cls(os.path.join(cache_dir, "digests-{}.json".format(name)))
+
+    def digest (self, abs_name, st, data=None, now=None):
+        # data: the file's contents, if they have already been read
+        if now is None:
+            now = time.time()
+        racy = now - st.st_mtime < RACY_SECONDS
+        key = "{}:{}:{}:{}".format(st.st_dev, st.st_ino, st.st_size, mtime_key(st))
+        value = None if racy else self.used.get(key) or self.known.get(key)
+        if value is None and data is not None:
+            value = hashlib.sha256(data).hexdigest()
+        elif value is None:
+            value = file_digest(abs_name)
+        if not racy:
+            self.used[key] = value
+        return value
+
+    def save (self):
+        if self.path is None:
+            return
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmp_name = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.used, f)
+            _replace(tmp_name, self.path)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+class Deduplicator (object):
+    """Finds files whose contents were already added to the archive.
+
+    Only a file sharing its size with an earlier one can possibly be a
+    duplicate, so the first file of each size isn't hashed until a second
+    one turns up; files of a unique size are never hashed.
+    """
+    def __init__ (self, digests):
+        self.digests = digests
+        # (size, meta): the first file of that kind, not yet hashed
+        self.unhashed = {}
+        self.hashed = set()
+        self.first = {}
+        self.files = 0
+        self.bytes = 0
+
+    def __bool__ (self):
+        return bool(self.files)
+    __nonzero__ = __bool__
+
+    def link_target (self, abs_name, arcname, st, data=None, meta=None):
+        """Return the arcname holding the same contents, or None.
+
+        meta is what the archive records of the file besides its contents
+        (see member_meta); a hard link shares its target's, so only files
+        that match in it are linked.  A None return means abs_name is the
+        first copy of its contents, and is remembered under arcname for any
+        later copies.
+        """
+        if not stat.S_ISREG(st.st_mode) or not st.st_size:
+            return None
+        if meta is None:
+            meta = (stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid)
+        group = (st.st_size, meta)
+        if group not in self.hashed:
+            earlier = self.unhashed.pop(group, None)
+            if earlier is None:
+                self.unhashed[group] = (abs_name, arcname, st)
+                return None
+            self.hashed.add(group)
+            first_name, first_arcname, first_st = earlier
+            self.first[group + (self.digests.digest(first_name, first_st),)] = first_arcname
+        key = group + (self.digests.digest(abs_name, st, data),)
+        target = self.first.get(key)
+        if target is None:
+            self.first[key] = arcname
+            return None
+        self.files += 1
+        self.bytes += st.st_size
+        return target
+
+    def summary (self):
+        return "Stored {} duplicate files ({:,} bytes) as hard links".format(self.files, self.bytes)
+
+def member_meta (fi):
+    """The mode and owner a TarInfo will be stored with."""
+    return (stat.S_IMODE(fi.mode), fi.uid, fi.gid, fi.uname, fi.gname)
+
+def link_tarinfo (fi, target):
+    """Turn a regular file's TarInfo into a hard link to target."""
+    fi.type = tarfile.LNKTYPE
+    fi.linkname = target
+    fi.size = 0
+    return fi
@@ -0,0 +1,69 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import errno
+import os
+import shutil
+
+# errors meaning "this kernel path can't do that pair of files", not failure
+_UNSUPPORTED = set(getattr(errno, name) for name in
+                   ('EINVAL', 'ENOSYS', 'EXDEV', 'EBADF', 'ENOTSUP', 'EOPNOTSUPP')
+                   if hasattr(errno, name))
+
+def _kernel_copy (copy, src_fd, dst_fd, count):
+    # returns bytes copied (short only at EOF), or None if the kernel
+    # refused this pair of files before anything was written
+    done = 0
+    try:
+        while done < count:
+            n = copy(src_fd, dst_fd, count - done)
+            if n == 0:
+                break
+            done += n
+    except OSError as e:
+        if done or e.errno not in _UNSUPPORTED:
+            raise
+        return None
+    return done
+
+def _copy_file_range (src_fd, dst_fd, count):
+    return os.copy_file_range(src_fd, dst_fd, count)
+
+def _sendfile (src_fd, dst_fd, count):
+    return os.sendfile(dst_fd, src_fd, None, count)
+
+def copyfileobj (src, dst):
+    """Copy the rest of file src to the end of file dst.
+
+    Uses copy_file_range(2) or sendfile(2) when the files allow it, so the
+    data never passes through userspace, and plain reads and writes when
+    they don't.
+    """
+    try:
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        start = src.tell()
+        count = os.fstat(src_fd).st_size - start
+    except (AttributeError, IOError, OSError, ValueError):
+        shutil.copyfileobj(src, dst)
+        return
+
+    dst.flush()
+    os.lseek(src_fd, start, os.SEEK_SET)
+    done = 0
+    for name, copy in (('copy_file_range', _copy_file_range), ('sendfile', _sendfile)):
+        if hasattr(os, name):
+            result = _kernel_copy(copy, src_fd, dst_fd, count)
+            if result is not None:
+                done = result
+                break
+
+    # the file objects' own positions are stale after the kernel moved the
+    # descriptors; resync, then let userspace finish whatever is left.
+    src.seek(start + done, os.SEEK_SET)
+    try:
+        dst.seek(0, os.SEEK_CUR)
+    except (IOError, OSError):
+        pass # pipes have no position to resync
+    if done < count:
+        shutil.copyfileobj(src, dst)
@@ -0,0 +1,136 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os.path
+import re
+
+IGNORE_FILE = '.provisionerignore'
+
+def _translate (pat):
+    # gitignore glob -> regex source, for POSIX paths relative to the root
+    i, n = 0, len(pat)
+    res = []
+    while i < n:
+        if pat.startswith('**/', i):
+            res.append('(?:.*/)?')
+            i += 3
+        elif pat.startswith('/**', i) and i + 3 == n:
+            res.append('/.*')
+            i += 3
+        elif pat.startswith('**', i):
+            res.append('.*')
+            i += 2
+        elif pat[i] == '*':
+            res.append('[^/]*')
+            i += 1
+        elif pat[i] == '?':
+            res.append('[^/]')
+            i += 1
+        elif pat[i] == '[':
+            end = pat.find(']', i + 2)
+            if end < 0:
+                res.append(re.escape('['))
+                i += 1
+                continue
+            body = pat[i+1:end]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            res.append('[' + body.replace('\\', '\\\\') + ']')
+            i = end + 1
+        elif pat[i] == '\\' and i + 1 < n:
+            res.append(re.escape(pat[i+1]))
+            i += 2
+        else:
+            res.append(re.escape(pat[i]))
+            i += 1
+    return ''.join(res)
+
+class IgnoreRule (object):
+    pattern = None
+    negate = False
+    dir_only = False
+    regex = None
+
+    def __init__ (self, pattern):
+        self.pattern = pattern
+        if pattern.startswith('!'):
+            self.negate = True
+            pattern = pattern[1:]
+        if pattern.endswith('/'):
+            self.dir_only = True
+            pattern = pattern.rstrip('/')
+        # a slash anywhere but the end anchors the pattern to the root;
+        # otherwise it matches a name at any depth.
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+        prefix = '' if anchored else '(?:.*/)?'
+        self.regex = re.compile('^' + prefix + _translate(pattern) + '$', re.S)
+
+    def matches (self, path, is_dir):
+        if self.dir_only and not is_dir:
+            return False
+        return self.regex.match(path) is not None
+
+class IgnoreRules (object):
+    """An ordered list of gitignore-style patterns.
+
+    Paths are POSIX-style and relative to the stage2_dir.  As in git, the
+    last matching pattern decides, and a file can't be re-included with !
+    once its directory is excluded (the walk never enters that directory.)
+    Paths in silent are left out without being counted as skipped.
+    """
+    rules = None
+    silent = frozenset()
+
+    def __init__ (self, patterns=()):
+        self.rules = []
+        for pattern in patterns:
+            self.add(pattern)
+
+    def __bool__ (self):
+        return bool(self.rules)
+    __nonzero__ = __bool__
+
+    def add (self, line):
+        # comments, blank lines, and trailing spaces as in .gitignore;
+        # a backslash makes a leading # or ! literal (see _translate)
+        line = line.rstrip('\r\n')
+        if not line.strip() or line.startswith('#'):
+            return
+        while line.endswith(' ') and not line.endswith('\\ '):
+            line = line[:-1]
+        if line:
+            self.rules.append(IgnoreRule(line))
+
+    def add_file (self, path, encoding='utf-8'):
+        with open(path, 'rb') as f:
+            for line in f.read().decode(encoding).splitlines():
+                self.add(line)
+
+    def ignored (self, path, is_dir=False):
+        result = False
+        for rule in self.rules:
+            if rule.negate == result and rule.matches(path, is_dir):
+                result = not rule.negate
+        return result
+
+def load_rules (rootdir, patterns=()):
+    """Rules from the given patterns, then the root's .provisionerignore.
+
+    The ignore file itself is left out (silently), unless a pattern puts
+    it back.
+    """
+    ignore_file = os.path.join(rootdir, IGNORE_FILE)
+    if not os.path.isfile(ignore_file):
+        return IgnoreRules(patterns)
+    rules = IgnoreRules(['/' + IGNORE_FILE])
+    rules.silent = frozenset([IGNORE_FILE])
+    for pattern in patterns:
+        rules.add(pattern)
+    rules.add_file(ignore_file)
+    return rules
+
+def split_patterns (value):
+    # config values hold whitespace-separated patterns, possibly over
+    # several (indented) lines; use .provisionerignore for names with spaces
+    return value.split() if value else []
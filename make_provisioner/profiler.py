@@ -0,0 +1,190 @@
+# vim: fileencoding=utf-8
+"""Where a payload's bytes and compression time go.
+
+Every archive member is compressed on its own with the configured codec, so
+its compressed size is an estimate of its share of the real payload: small
+files come out somewhat larger than they would inside one stream.  Raw
+sizes are the files' own; what the tar headers and padding add is kept
+apart, as tar bytes.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import collections
+import json
+import os
+import posixpath
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+from . import compression
+
+class _Counter (object):
+    # a file that only counts what is written to it
+    def __init__ (self):
+        self.size = 0
+
+    def write (self, data):
+        self.size += len(data)
+        return len(data)
+
+    def flush (self):
+        pass
+
+class EntryProfile (object):
+    __slots__ = ('name', 'kind', 'size', 'tar', 'compressed', 'seconds')
+
+    def __init__ (self, name, kind, size, tar, compressed, seconds):
+        self.name = name
+        self.kind = kind
+        self.size = size
+        # the member's bytes in the archive: header, data, and padding
+        self.tar = tar
+        self.compressed = compressed
+        self.seconds = seconds
+
+    def as_dict (self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+def file_type (name):
+    ext = posixpath.splitext(posixpath.basename(name))[1].lower()
+    return ext or '(none)'
+
+class _ProfileWriter (object):
+    """The file that a _ProfilingTarFile writes: compresses each member."""
+    def __init__ (self, codec, level, spool_size=8*1024*1024):
+        self.codec = codec
+        self.level = level
+        self.spool_size = spool_size
+        self.offset = 0
+        self.entries = []
+        self.raw = tempfile.SpooledTemporaryFile(spool_size)
+
+    def write (self, data):
+        self.raw.write(data)
+        self.offset += len(data)
+        return len(data)
+
+    def tell (self):
+        return self.offset
+
+    def measure (self, name, kind, size):
+        tar_size = self.raw.tell()
+        self.raw.seek(0, os.SEEK_SET)
+        counter = _Counter()
+        start = time.time()
+        zfp = self.codec.open(counter, self.level)
+        try:
+            shutil.copyfileobj(self.raw, zfp, 1024*1024)
+        finally:
+            zfp.close()
+        seconds = time.time() - start
+        self.raw.close()
+        self.raw = tempfile.SpooledTemporaryFile(self.spool_size)
+        self.entries.append(EntryProfile(name, kind, size, tar_size, counter.size, seconds))
+
+class _ProfilingTarFile (tarfile.TarFile):
+    def addfile (self, tarinfo, fileobj=None):
+        tarfile.TarFile.addfile(self, tarinfo, fileobj)
+        kind = 'dir' if tarinfo.isdir() else file_type(tarinfo.name) if tarinfo.isreg() else 'link'
+        self.fileobj.measure(tarinfo.name, kind, tarinfo.size)
+
+def profile_payload (provisioner, stage2_dir):
+    """Return a PayloadProfile of the provisioner's payload for stage2_dir."""
+    codec, level = provisioner.get_compression()
+    if codec.parallel:
+        codec = compression.CODECS['gzip'] # same output, one member at a time
+    writer = _ProfileWriter(codec, level)
+    for layer in provisioner.get_layers(stage2_dir):
+        tar = _ProfilingTarFile(fileobj=writer, mode='w', format=provisioner.get_tar_format())
+        try:
+            provisioner.add_tree(tar, layer)
+        finally:
+            tar.close()
+        writer.raw.seek(0, os.SEEK_SET)
+        writer.raw.truncate() # end-of-archive padding isn't anyone's
+    return PayloadProfile(compression.format_spec(codec, level), writer.entries)
+
+class PayloadProfile (object):
+    def __init__ (self, spec, entries):
+        self.spec = spec
+        self.entries = entries
+
+    def files (self):
+        return sorted(self.entries, key=lambda e: (-e.size, e.name))
+
+    def directories (self):
+        # every file's totals count toward each directory above it
+        dirs = collections.defaultdict(lambda: [0, 0, 0.0, 0])
+        for e in self.entries:
+            parent = posixpath.dirname(e.name)
+            while parent:
+                d = dirs[parent]
+                d[0] += e.size
+                d[1] += e.compressed
+                d[2] += e.seconds
+                d[3] += 1
+                parent = posixpath.dirname(parent)
+        return sorted(((name, raw, comp, secs, n) for name, (raw, comp, secs, n) in dirs.items()),
+                      key=lambda d: (-d[2], d[0]))
+
+    def types (self):
+        kinds = collections.defaultdict(lambda: [0, 0, 0.0, 0])
+        for e in self.entries:
+            k = kinds[e.kind]
+            k[0] += e.size
+            k[1] += e.compressed
+            k[2] += e.seconds
+            k[3] += 1
+        return sorted(((kind, raw, comp, secs, n) for kind, (raw, comp, secs, n) in kinds.items()),
+                      key=lambda k: (-k[2], k[0]))
+
+    def as_dict (self):
+        return {
+            'compression': self.spec,
+            'raw_bytes': sum(e.size for e in self.entries),
+            'tar_bytes': sum(e.tar for e in self.entries),
+            'compressed_bytes': sum(e.compressed for e in self.entries),
+            'seconds': sum(e.seconds for e in self.entries),
+            'files': [e.as_dict() for e in self.files()],
+            'directories': [dict(name=d[0], raw=d[1], compressed=d[2], seconds=d[3], entries=d[4],
+                                 ratio=_ratio(d[2], d[1]))
+                            for d in self.directories()],
+            'types': [dict(type=t[0], raw=t[1], compressed=t[2], seconds=t[3], entries=t[4],
+                           ratio=_ratio(t[2], t[1]))
+                      for t in self.types()],
+        }
+
+    def save (self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+    def report (self, top=20, out=sys.stdout):
+        totals = self.as_dict()
+        print("Payload profile ({}, each entry compressed alone): {} entries, {:,} raw bytes "
+              "({:,} as tar), {:,} compressed, {:.2f}s".format(
+                  self.spec, len(self.entries), totals['raw_bytes'], totals['tar_bytes'],
+                  totals['compressed_bytes'], totals['seconds']), file=out)
+        row = "{:>14} {:>14} {:>7} {:>8}  {}"
+        num = "{:>14,} {:>14,} {:>7.3f} {:>8.3f}  {}"
+        print("\nLargest files", file=out)
+        print(row.format('raw', 'compressed', 'ratio', 'seconds', 'name'), file=out)
+        for e in self.files()[:top]:
+            print(num.format(e.size, e.compressed, _ratio(e.compressed, e.size), e.seconds, e.name), file=out)
+        print("\nSlowest files to compress", file=out)
+        print(row.format('raw', 'compressed', 'ratio', 'seconds', 'name'), file=out)
+        for e in sorted(self.entries, key=lambda e: (-e.seconds, e.name))[:top]:
+            print(num.format(e.size, e.compressed, _ratio(e.compressed, e.size), e.seconds, e.name), file=out)
+        print("\nDirectories, by compressed size", file=out)
+        print(row.format('raw', 'compressed', 'ratio', 'seconds', 'name'), file=out)
+        for name, raw, comp, secs, n in self.directories()[:top]:
+            print(num.format(raw, comp, _ratio(comp, raw), secs, name + '/'), file=out)
+        print("\nFile types, by compressed size", file=out)
+        print(row.format('raw', 'compressed', 'ratio', 'seconds', 'type (entries)'), file=out)
+        for kind, raw, comp, secs, n in self.types():
+            print(num.format(raw, comp, _ratio(comp, raw), secs, "{} ({})".format(kind, n)), file=out)
+
+def _ratio (compressed, raw):
+    return float(compressed) / raw if raw else 1.0
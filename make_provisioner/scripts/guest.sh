@@ -2,7 +2,43 @@
 set -e
 self_file="$0"
 export CLOUD_DIR=@CLOUD_DIR
+payload_offset=@PAYLOAD_OFFSET
+payload_size=@PAYLOAD_SIZE
+payload_sha256=@PAYLOAD_SHA256
+marker="${CLOUD_DIR}/.cloud-maker-payload"
+@DECOMPRESS
+payload_digest () {
+    if command -v sha256sum >/dev/null 2>&1; then
+        sha256sum | cut -d ' ' -f 1
+    elif command -v shasum >/dev/null 2>&1; then
+        shasum -a 256 | cut -d ' ' -f 1
+    elif command -v openssl >/dev/null 2>&1; then
+        openssl dgst -sha256 | sed -e 's/^.* //'
+    else
+        return 1
+    fi
+}
 sudo install -d -m 0700 -o "`id -u`" -g "`id -g`" "${CLOUD_DIR}"
-tail -n +@CUT_LINE "${self_file}" | gzip -dc - | tar xp -C "${CLOUD_DIR}" -f -
+if [ -f "${marker}" ] && [ "`cat "${marker}"`" = "${payload_sha256}" ]; then
+    echo "Payload ${payload_sha256} is already unpacked in ${CLOUD_DIR}" >&2
+else
+    # catch truncated uploads before unpacking anything
+    file_size=$((`wc -c < "${self_file}"`))
+    if [ "${file_size}" -ne $((payload_offset - 1 + payload_size)) ]; then
+        echo "${self_file} is ${file_size} bytes, expected $((payload_offset - 1 + payload_size))" >&2
+        exit 1
+    fi
+    if digest=`tail -c +${payload_offset} "${self_file}" | payload_digest`; then
+        if [ "${digest}" != "${payload_sha256}" ]; then
+            echo "${self_file} payload is damaged: sha256 ${digest}, expected ${payload_sha256}" >&2
+            exit 1
+        fi
+    else
+        echo "No sha256 tool found; skipping the payload integrity check" >&2
+    fi
+    rm -f "${marker}"
+    tail -c +${payload_offset} "${self_file}" | decompress | tar @TAR_EXTRACT -C "${CLOUD_DIR}" -f -
+    echo "${payload_sha256}" > "${marker}"
+fi
 cd "${CLOUD_DIR}"
 exec @RUNNER
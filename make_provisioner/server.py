@@ -0,0 +1,264 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import collections
+import io
+import json
+import os
+import os.path
+import socket
+import sys
+import threading
+import traceback
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from http.client import HTTPConnection
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import quote, unquote, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from httplib import HTTPConnection
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urllib import quote, unquote
+    from urlparse import urlparse
+
+from . import VERSION
+
+UNIX_PREFIX = 'unix:'
+
+class UnknownSystemError (LookupError):
+    pass
+
+def parse_address (address):
+    """'unix:PATH', 'HOST:PORT', or 'PORT' (on localhost) to a bind address."""
+    if address.startswith(UNIX_PREFIX):
+        return address[len(UNIX_PREFIX):]
+    host, _, port = address.rpartition(':')
+    try:
+        return (host or '127.0.0.1', int(port))
+    except ValueError:
+        raise ValueError("Server address must be unix:PATH, HOST:PORT, or PORT: {!r}".format(address))
+
+
+class _Pending (object):
+    # a build in progress, which other requests for it can wait on
+    def __init__ (self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def finish (self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+    def wait (self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class PayloadLRU (object):
+    """Built payloads in memory, least recently used dropped first.
+
+    Values are (payload bytes, SHA-256 hex) pairs; max_bytes bounds the
+    total payload size held.  Requests for a key that is already being
+    built wait for that build instead of starting another.
+    """
+    def __init__ (self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.total = 0
+        self.building = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.builds = 0
+
+    def get (self, key, build):
+        with self.lock:
+            if key in self.entries:
+                value = self.entries.pop(key)
+                self.entries[key] = value # now the most recently used
+                self.hits += 1
+                return value
+            pending = self.building.get(key)
+            owner = pending is None
+            if owner:
+                pending = self.building[key] = _Pending()
+        if not owner:
+            return pending.wait()
+
+        try:
+            value = build()
+        except BaseException as e:
+            with self.lock:
+                del self.building[key]
+            pending.finish(error=e)
+            raise
+        with self.lock:
+            del self.building[key]
+            self.builds += 1
+            self._add(key, value)
+        pending.finish(value)
+        return value
+
+    def _add (self, key, value):
+        size = len(value[0])
+        if size > self.max_bytes:
+            return # serve it, but don't flush everything else for it
+        while self.entries and self.total + size > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.total -= len(old[0])
+        self.entries[key] = value
+        self.total += size
+
+
+class ProvisionerHandler (BaseHTTPRequestHandler):
+    """GET /systems lists the systems; GET /systems/NAME sends one SFX."""
+    server_version = 'make_provisioner/' + VERSION
+
+    def address_string (self):
+        # Unix sockets have no client address
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return str(self.client_address[0])
+        return 'local'
+
+    def do_GET (self):
+        parts = [unquote(p) for p in urlparse(self.path).path.split('/') if p]
+        try:
+            if parts == ['systems']:
+                body = json.dumps(self.server.app.systems()).encode('utf-8')
+                self.send_body(200, body, 'application/json')
+            elif len(parts) == 2 and parts[0] == 'systems':
+                self.send_provisioner(parts[1])
+            else:
+                self.send_body(404, b'Not found\n')
+        except UnknownSystemError as e:
+            self.send_body(404, "Unknown system: {}\n".format(e.args[0]).encode('utf-8'))
+        except Exception as e:
+            traceback.print_exc()
+            self.send_body(500, "{}\n".format(e).encode('utf-8'))
+
+    def send_body (self, code, body, content_type='text/plain; charset=utf-8'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_provisioner (self, system):
+        stub, payload = self.server.app.build(system)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-sh')
+        self.send_header('Content-Length', str(len(stub) + len(payload)))
+        self.end_headers()
+        self.wfile.write(stub)
+        self.wfile.write(payload)
+
+
+class ProvisionerApp (object):
+    """The server's state: the config file, and the payload LRU."""
+    def __init__ (self, provisioner, config_path, cache_bytes):
+        self.provisioner = provisioner
+        self.config_path = config_path
+        self.payloads = PayloadLRU(cache_bytes)
+        self.lock = threading.Lock()
+        self.ini = None
+        self.ini_mtime = None
+
+    def get_ini (self):
+        # parse the config once, and again only when it changes
+        mtime = os.stat(self.config_path).st_mtime
+        with self.lock:
+            if self.ini is None or mtime != self.ini_mtime:
+                self.ini = self.provisioner.load_config(self.config_path)
+                self.ini_mtime = mtime
+            return self.ini
+
+    def systems (self):
+        return self.get_ini().sections()
+
+    def build (self, system):
+        """Return the (stub, payload) bytes of the system's provisioner."""
+        from .compression import HashingWriter
+        ini = self.get_ini()
+        if not ini.has_section(system):
+            raise UnknownSystemError(system)
+        p = self.provisioner.for_system(ini, system)
+        stage2_dir = p.config['stage2_dir']
+        key = p.get_payload_cache_key(stage2_dir)
+
+        def build_payload ():
+            buf = io.BytesIO()
+            payload = HashingWriter(buf)
+            p.build_payload(payload, stage2_dir)
+            return buf.getvalue(), payload.hexdigest()
+
+        data, sha256 = self.payloads.get(key, build_payload)
+        return p.get_sfx_stub(len(data), sha256).encode('utf-8'), data
+
+
+class ThreadingHTTPServer (ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixHTTPServer (ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def make_server (app, address):
+    bind = parse_address(address)
+    if isinstance(bind, tuple):
+        server = ThreadingHTTPServer(bind, ProvisionerHandler)
+    else:
+        if os.path.exists(bind):
+            os.unlink(bind) # stale socket from an earlier run
+        server = ThreadingUnixHTTPServer(bind, ProvisionerHandler)
+    server.app = app
+    return server
+
+def serve (provisioner, config_path, address, cache_bytes):
+    server = make_server(ProvisionerApp(provisioner, config_path, cache_bytes), address)
+    print("Serving provisioners from {} on {}".format(config_path, address), file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if address.startswith(UNIX_PREFIX):
+            try:
+                os.unlink(address[len(UNIX_PREFIX):])
+            except OSError:
+                pass
+
+
+class _UnixHTTPConnection (HTTPConnection):
+    def __init__ (self, path):
+        HTTPConnection.__init__(self, 'localhost')
+        self.unix_path = path
+
+    def connect (self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_path)
+
+def fetch (address, system, out_file, bufsize=1024*1024):
+    """Download the system's provisioner from a server into out_file."""
+    from .cache import break_link
+    bind = parse_address(address)
+    if isinstance(bind, tuple):
+        conn = HTTPConnection(*bind)
+    else:
+        conn = _UnixHTTPConnection(bind)
+    try:
+        conn.request('GET', '/systems/' + quote(system, safe=''))
+        response = conn.getresponse()
+        if response.status != 200:
+            err = "Server could not provide {}: {} {}"
+            raise RuntimeError(err.format(system, response.status, response.read().decode('utf-8', 'replace').strip()))
+        break_link(out_file)
+        with open(out_file, 'wb') as f:
+            while True:
+                buf = response.read(bufsize)
+                if not buf:
+                    break
+                f.write(buf)
+    finally:
+        conn.close()
@@ -0,0 +1,235 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import collections
+import io
+import os
+import os.path
+import posixpath
+import stat
+import tarfile
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None # Python 2 without the futures backport
+try:
+    import grp
+    import pwd
+except ImportError:
+    grp = pwd = None # Windows
+
+class SkipStats (object):
+    """Counts what the ignore rules kept out of the payload.
+
+    Excluded directories are pruned without being entered, so only the
+    skipped files' sizes are known.
+    """
+    def __init__ (self):
+        self.files = 0
+        self.bytes = 0
+        self.dirs = 0
+
+    def __bool__ (self):
+        return bool(self.files or self.dirs)
+    __nonzero__ = __bool__
+
+    def summary (self):
+        parts = []
+        if self.files:
+            parts.append("{} files ({:,} bytes)".format(self.files, self.bytes))
+        if self.dirs:
+            parts.append("{} directories (contents not counted)".format(self.dirs))
+        return "Skipped {} matching exclude rules".format(" and ".join(parts))
+
+class Entry (object):
+    """One thing found in the tree, with the lstat() result of the scan.
+
+    path is the host OS path; name is the POSIX path relative to the root.
+    """
+    __slots__ = ('path', 'name', 'st', 'is_dir')
+
+    def __init__ (self, path, name, st, is_dir):
+        self.path = path
+        self.name = name
+        self.st = st
+        self.is_dir = is_dir
+
+    def is_file (self):
+        return stat.S_ISREG(self.st.st_mode)
+
+def _scandir (path):
+    # (name, lstat, is_dir) for each entry in path
+    try:
+        scandir = os.scandir
+    except AttributeError:
+        for name in os.listdir(path):
+            st = os.lstat(os.path.join(path, name))
+            yield name, st, stat.S_ISDIR(st.st_mode)
+        return
+    it = scandir(path)
+    try:
+        for d in it:
+            # on Windows, this stat comes free with the directory listing;
+            # elsewhere it's one lstat, which DirEntry then keeps.
+            st = d.stat(follow_symlinks=False)
+            yield d.name, st, stat.S_ISDIR(st.st_mode)
+    finally:
+        close = getattr(it, 'close', None)
+        if close is not None:
+            close()
+
+def scan_tree (rootdir, rules=None, skipped=None):
+    """Yield an Entry for everything under rootdir, in sorted order.
+
+    Directories are yielded before their contents; symlinks are never
+    followed.  rules is an IgnoreRules (or None to keep everything), and
+    ignored directories are pruned before the scan descends into them.
+    skipped, if given, is a SkipStats to update.
+    """
+    stack = [(rootdir, '')]
+    while stack:
+        path, rel = stack.pop()
+        found = sorted(_scandir(path))
+        subdirs = []
+        for name, st, is_dir in found:
+            rel_name = posixpath.join(rel, name)
+            if rules and rules.ignored(rel_name, is_dir):
+                if skipped is not None and rel_name not in rules.silent:
+                    if is_dir:
+                        skipped.dirs += 1
+                    else:
+                        skipped.files += 1
+                        skipped.bytes += st.st_size
+                continue
+            entry = Entry(os.path.join(path, name), rel_name, st, is_dir)
+            yield entry
+            if is_dir:
+                subdirs.append((entry.path, rel_name))
+        # depth first, in order: push the subdirectories in reverse
+        stack.extend(reversed(subdirs))
+
+def _read_file (path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def read_ahead (entries, workers=8, max_bytes=64*1024*1024, max_file=4*1024*1024):
+    """Yield (entry, data) pairs, reading small files on a thread pool.
+
+    data holds the contents of regular files up to max_file bytes, read in
+    the background while earlier entries are still being archived; it is
+    None for everything else, which the caller should open itself.  At most
+    max_bytes of file data are buffered at a time.
+    """
+    if ThreadPoolExecutor is None or workers < 1:
+        for entry in entries:
+            yield entry, None
+        return
+
+    queue = collections.deque()
+    buffered = [0]
+    def pop ():
+        entry, future = queue.popleft()
+        if future is None:
+            return entry, None
+        buffered[0] -= entry.st.st_size
+        return entry, future.result()
+
+    pool = ThreadPoolExecutor(workers)
+    try:
+        for entry in entries:
+            if entry.is_file() and entry.st.st_size <= max_file:
+                while queue and buffered[0] + entry.st.st_size > max_bytes:
+                    yield pop()
+                queue.append((entry, pool.submit(_read_file, entry.path)))
+                buffered[0] += entry.st.st_size
+            else:
+                queue.append((entry, None))
+            # keep the pool fed, but don't run arbitrarily far ahead
+            while len(queue) > 16 * workers:
+                yield pop()
+        while queue:
+            yield pop()
+    finally:
+        pool.shutdown(wait=True)
+
+
+_uname_cache = {}
+_gname_cache = {}
+
+def _owner_names (st):
+    # tarfile looks these up for every member; look each id up once
+    if pwd is None:
+        return '', ''
+    uname = _uname_cache.get(st.st_uid)
+    if uname is None:
+        try:
+            uname = pwd.getpwuid(st.st_uid)[0]
+        except KeyError:
+            uname = ''
+        _uname_cache[st.st_uid] = uname
+    gname = _gname_cache.get(st.st_gid)
+    if gname is None:
+        try:
+            gname = grp.getgrgid(st.st_gid)[0]
+        except KeyError:
+            gname = ''
+        _gname_cache[st.st_gid] = gname
+    return uname, gname
+
+def make_tarinfo (tar, entry, arcname=None):
+    """Build the TarInfo that tar.gettarinfo() would, from the scan's stat.
+
+    Returns None for types tar can't store (sockets.)  Like gettarinfo(),
+    it records inodes in tar.inodes, to store later names of a multiply
+    linked file as hard links.
+    """
+    st = entry.st
+    mode = st.st_mode
+    if arcname is None:
+        arcname = entry.name
+    fi = tar.tarinfo(arcname)
+    fi.tarfile = tar
+
+    inode = (st.st_ino, st.st_dev)
+    if stat.S_ISREG(mode):
+        if st.st_nlink > 1 and inode in tar.inodes and arcname != tar.inodes[inode]:
+            fi.type = tarfile.LNKTYPE
+            fi.linkname = tar.inodes[inode]
+        else:
+            fi.type = tarfile.REGTYPE
+            if inode[0]:
+                tar.inodes[inode] = arcname
+    elif stat.S_ISDIR(mode):
+        fi.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(mode):
+        fi.type = tarfile.SYMTYPE
+        fi.linkname = os.readlink(entry.path)
+    elif stat.S_ISFIFO(mode):
+        fi.type = tarfile.FIFOTYPE
+    elif stat.S_ISCHR(mode):
+        fi.type = tarfile.CHRTYPE
+    elif stat.S_ISBLK(mode):
+        fi.type = tarfile.BLKTYPE
+    else:
+        return None
+
+    fi.mode = stat.S_IMODE(mode)
+    fi.uid = st.st_uid
+    fi.gid = st.st_gid
+    fi.size = st.st_size if fi.type == tarfile.REGTYPE else 0
+    fi.mtime = st.st_mtime
+    fi.uname, fi.gname = _owner_names(st)
+    if fi.type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        fi.devmajor = os.major(st.st_rdev)
+        fi.devminor = os.minor(st.st_rdev)
+    return fi
+
+def add_member (tar, fi, entry, data=None):
+    """Add fi to tar, with contents from data or else the entry's file."""
+    if not fi.isreg():
+        tar.addfile(fi)
+    elif data is not None:
+        tar.addfile(fi, io.BytesIO(data))
+    else:
+        with open(entry.path, 'rb') as f:
+            tar.addfile(fi, f)
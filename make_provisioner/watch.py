@@ -0,0 +1,292 @@
+# vim: fileencoding=utf-8
+"""Rebuild a provisioner whenever its stage2 tree changes.
+
+The payload is written as one compressed member per archive entry; every
+supported codec decompresses concatenated members as a single stream.
+Members are kept between builds, keyed by the hash of their uncompressed
+bytes, so a rebuild only compresses the entries that changed.  The cost is
+a somewhat larger payload than a normal build, since no member shares its
+compression window with another.
+"""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import errno
+import hashlib
+import os
+import os.path
+import select
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import traceback
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+from . import compression
+from .cache import mtime_key
+
+_replace = getattr(os, 'replace', os.rename)
+_fsencode = getattr(os, 'fsencode', lambda path: path)
+
+
+class ChunkStore (object):
+    """Compressed archive members, as files in workdir named by the hash of
+    their uncompressed contents."""
+    def __init__ (self, workdir, codec, level, mtime=None):
+        # the codec the config asked for, which the members stay valid for
+        self.requested = codec.name
+        if codec.parallel:
+            # members are already compressed one by one; plain gzip it is
+            codec = compression.CODECS['gzip']
+        self.workdir = workdir
+        self.codec = codec
+        self.level = level
+        self.mtime = mtime
+        self.used = set()
+        self.chunks = 0
+        self.compressed = 0
+
+    def start (self):
+        self.used = set()
+        self.chunks = 0
+        self.compressed = 0
+
+    def finish (self):
+        # drop the members that the latest build didn't use
+        for name in os.listdir(self.workdir):
+            if name not in self.used:
+                os.unlink(os.path.join(self.workdir, name))
+
+    def write_chunk (self, digest, raw, out, bufsize=1024*1024):
+        # raw: the uncompressed bytes, in a file positioned at the start
+        path = os.path.join(self.workdir, digest)
+        if not os.path.isfile(path):
+            tmp_name = path + '.tmp'
+            with open(tmp_name, 'wb') as f:
+                zfp = self.codec.open(f, self.level, mtime=self.mtime)
+                try:
+                    shutil.copyfileobj(raw, zfp, bufsize)
+                finally:
+                    zfp.close()
+            _replace(tmp_name, path)
+            self.compressed += 1
+        self.used.add(digest)
+        self.chunks += 1
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, out, bufsize)
+
+
+class _ChunkWriter (object):
+    """The file that a _ChunkedTarFile writes, split at member boundaries."""
+    def __init__ (self, store, out, spool_size=8*1024*1024):
+        self.store = store
+        self.out = out
+        self.spool_size = spool_size
+        self.offset = 0
+        self._reset()
+
+    def _reset (self):
+        self.raw = tempfile.SpooledTemporaryFile(self.spool_size)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write (self, data):
+        self.raw.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        self.offset += len(data)
+        return len(data)
+
+    def tell (self):
+        return self.offset
+
+    def end_chunk (self):
+        if not self.size:
+            return
+        key = "{}-{}".format(self.sha256.hexdigest(), self.size)
+        self.raw.seek(0, os.SEEK_SET)
+        try:
+            self.store.write_chunk(key, self.raw, self.out)
+        finally:
+            self.raw.close()
+        self._reset()
+
+
+class _ChunkedTarFile (tarfile.TarFile):
+    # ends a chunk after every member
+    def addfile (self, tarinfo, fileobj=None):
+        tarfile.TarFile.addfile(self, tarinfo, fileobj)
+        self.fileobj.end_chunk()
+
+
+def build_payload (provisioner, store, fp, stage2_dir):
+    """Write the payload for stage2_dir to fp, from the store's members."""
+    for layer in provisioner.get_layers(stage2_dir):
+        writer = _ChunkWriter(store, fp)
+        tar = _ChunkedTarFile(fileobj=writer, mode='w', format=provisioner.get_tar_format())
+        try:
+            provisioner.add_tree(tar, layer)
+        finally:
+            tar.close()
+        # the end-of-archive blocks
+        writer.end_chunk()
+
+
+class PollWatcher (object):
+    """Notices changes by rescanning the trees every interval seconds."""
+    def __init__ (self, provisioner, dirs, interval=1.0):
+        self.interval = interval
+        self.update(provisioner, dirs)
+
+    def snapshot (self, provisioner, dirs):
+        return [[(e.name, e.st.st_mode, e.st.st_size, mtime_key(e.st)) for e in provisioner.walk(d)]
+                for d in dirs]
+
+    def update (self, provisioner, dirs):
+        self.provisioner = provisioner
+        self.dirs = dirs
+        self.state = self.snapshot(provisioner, dirs)
+
+    def wait (self, timeout):
+        # True if anything changed within timeout seconds
+        deadline = time.time() + timeout
+        while True:
+            time.sleep(max(0, min(self.interval, deadline - time.time())))
+            state = self.snapshot(self.provisioner, self.dirs)
+            if state != self.state:
+                self.state = state
+                return True
+            if time.time() >= deadline:
+                return False
+
+    def close (self):
+        pass
+
+
+_IN_EVENTS = (0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800)
+
+class InotifyWatcher (object):
+    """Notices changes through Linux inotify, on every directory watched."""
+    def __init__ (self, provisioner, dirs):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.update(provisioner, dirs)
+
+    @classmethod
+    def available (cls):
+        return ctypes is not None and sys.platform.startswith('linux') and hasattr(select, 'select')
+
+    def update (self, provisioner, dirs):
+        # new directories need their own watches; deleted ones drop theirs
+        for d in dirs:
+            self._add(d)
+            for entry in provisioner.walk(d):
+                if entry.is_dir:
+                    self._add(entry.path)
+
+    def _add (self, path):
+        if self.libc.inotify_add_watch(self.fd, _fsencode(path), _IN_EVENTS) < 0:
+            err = ctypes.get_errno()
+            if err != errno.ENOENT:
+                raise OSError(err, os.strerror(err), path)
+
+    def wait (self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        # the events themselves don't matter, only that there were some
+        while True:
+            try:
+                if not os.read(self.fd, 65536):
+                    break
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+        return True
+
+    def close (self):
+        os.close(self.fd)
+
+
+def make_watcher (provisioner, dirs):
+    if InotifyWatcher.available():
+        try:
+            return InotifyWatcher(provisioner, dirs)
+        except (OSError, AttributeError):
+            pass # no inotify in this libc or kernel
+    return PollWatcher(provisioner, dirs)
+
+
+def watch (provisioner, config_path, system, output=None, debounce=0.3, out=sys.stderr):
+    """Build the system's provisioner, then rebuild it on every change to
+    its tree or the config file, until interrupted."""
+    workdir = tempfile.mkdtemp(prefix='make_provisioner-watch')
+    watcher = None
+    try:
+        config_mtime = os.stat(config_path).st_mtime
+        p = provisioner.for_system(provisioner.load_config(config_path), system)
+        store = None
+        while True:
+            try:
+                mtime = os.stat(config_path).st_mtime
+                if mtime != config_mtime:
+                    config_mtime = mtime
+                    p = provisioner.for_system(provisioner.load_config(config_path), system)
+                store = _store_for(p, workdir, store)
+                stage2_dir = p.config['stage2_dir']
+                dirs = p.get_layers(stage2_dir)
+                rebuild(p, store, stage2_dir, output or p.get_output(), out)
+                if watcher is None:
+                    watcher = make_watcher(p, dirs)
+                else:
+                    watcher.update(p, dirs)
+            except Exception:
+                if watcher is None:
+                    raise # nothing to watch yet
+                traceback.print_exc()
+
+            # wait for a change, then for a quiet moment
+            while not (watcher.wait(1.0) or os.stat(config_path).st_mtime != config_mtime):
+                pass
+            while watcher.wait(debounce):
+                pass
+    finally:
+        if watcher is not None:
+            watcher.close()
+        shutil.rmtree(workdir, True)
+
+def _store_for (p, workdir, store=None):
+    # the members can be kept as long as the compression settings hold
+    codec, level = p.get_compression()
+    mtime = p.get_source_date_epoch()
+    if store is not None and (store.requested, store.level, store.mtime) == (codec.name, level, mtime):
+        return store
+    if store is not None:
+        shutil.rmtree(store.workdir, True)
+    return ChunkStore(tempfile.mkdtemp(dir=workdir), codec, level, mtime)
+
+def rebuild (p, store, stage2_dir, output, out=sys.stderr):
+    start = time.time()
+    store.start()
+    # build beside the output, then replace it in one step
+    tmp_name = "{}.{}.tmp".format(output, os.getpid())
+    try:
+        p.create_provisioner(tmp_name, stage2_dir,
+                             lambda fp, stage2_dir: build_payload(p, store, fp, stage2_dir))
+        _replace(tmp_name, output)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+    store.finish()
+    print("Built {} in {:.2f}s ({} of {} members compressed)".format(
+        output, time.time() - start, store.compressed, store.chunks), file=out)
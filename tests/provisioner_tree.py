@@ -0,0 +1,94 @@
+# vim: fileencoding=utf-8
+"""A scratch directory with a stage2 tree and a provisioner.ini, for the
+make_provisioner tests."""
+from __future__ import print_function, absolute_import, unicode_literals
+
+import io
+import os
+import os.path
+import shutil
+import tarfile
+import tempfile
+
+from make_provisioner.app import Provisioner
+
+class ProvisionerTree (object):
+    def __init__ (self, **settings):
+        self.root = tempfile.mkdtemp()
+        self.stage2 = os.path.join(self.root, 'stage2')
+        os.mkdir(self.stage2)
+        self.ini = os.path.join(self.root, 'provisioner.ini')
+        self.write_config(**settings)
+
+    def cleanup (self):
+        shutil.rmtree(self.root)
+
+    def path (self, *names):
+        return os.path.join(self.root, *names)
+
+    def write_config (self, systems=('test',), **settings):
+        lines = ['[DEFAULT]', 'stage2_dir = ' + self.stage2,
+                 'cache_dir = ' + self.path('cache')]
+        lines += ['{} = {}'.format(k, v) for k, v in sorted(settings.items())]
+        for system in systems:
+            lines.append('[{}]'.format(system))
+        with io.open(self.ini, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def add (self, name, data, mode=0o644, root=None):
+        path = os.path.join(root or self.stage2, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.chmod(path, mode)
+        return path
+
+    def provisioner (self, *args):
+        """A Provisioner set up for the command line args, as execute()
+        would."""
+        p = Provisioner()
+        p.parse_args(['-c', self.ini] + list(args), Provisioner.PROG)
+        p.read_config(p.options.system[0], self.ini)
+        return p
+
+    def build (self, *args):
+        out = self.path('provisioner.sh')
+        Provisioner().execute(['-c', self.ini, '-o', out] + list(args))
+        with open(out, 'rb') as f:
+            return f.read()
+
+def split_provisioner (data):
+    """Return the stub's fields (as text) and the payload of a built
+    provisioner."""
+    fields = {}
+    for line in data.split(b'\n'):
+        for name in (b'payload_offset', b'payload_size', b'payload_sha256'):
+            if line.startswith(name + b'='):
+                fields[name.decode('ascii')] = line[len(name) + 1:].decode('ascii').strip()
+        if line.startswith(b'exec '):
+            break
+    return fields, data[int(fields['payload_offset']) - 1:]
+
+def payload_members (payload, codec='gzip'):
+    """The (TarInfo, contents) of each member of a payload, across its
+    layers' archives."""
+    import zlib
+    if codec == 'gzip':
+        raw = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = b''
+        rest = payload
+        while rest:
+            data += raw.decompress(rest)
+            rest = raw.unused_data
+            raw = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif codec == 'none':
+        data = payload
+    else:
+        raise ValueError(codec)
+    members = []
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:', ignore_zeros=True) as tar:
+        for member in tar:
+            f = tar.extractfile(member) if member.isreg() else None
+            members.append((member, f.read() if f is not None else None))
+    return members
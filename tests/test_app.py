@@ -0,0 +1,55 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import os.path
+import unittest
+
+from make_provisioner.app import Provisioner
+from provisioner_tree import ProvisionerTree, split_provisioner
+
+BUNDLED_INI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'provisioner.ini')
+
+class OutputFileTest (unittest.TestCase):
+    def setUp (self):
+        self.tree = ProvisionerTree()
+        self.tree.add('main.sh', b'#!/bin/sh\n', 0o755)
+        self.cwd = os.getcwd()
+        os.chdir(self.tree.root)
+
+    def tearDown (self):
+        os.chdir(self.cwd)
+        self.tree.cleanup()
+
+    def run_all (self, **settings):
+        self.tree.write_config(systems=('web', 'db'), cache='no', **settings)
+        Provisioner().execute(['-c', self.tree.ini, '--all'])
+        return sorted(n for n in os.listdir(self.tree.root) if n.endswith('.sh'))
+
+    def test_bundled_default_is_per_system (self):
+        p = Provisioner()
+        ini = p.load_config(BUNDLED_INI)
+        outputs = [p.for_system(ini, s).get_output() for s in ini.sections()]
+        self.assertEqual(outputs, ['provisioner-{}.sh'.format(s) for s in ini.sections()])
+
+    def test_all_without_output_file (self):
+        self.assertEqual(self.run_all(), ['provisioner-db.sh', 'provisioner-web.sh'])
+        with open('provisioner-web.sh', 'rb') as f:
+            fields, payload = split_provisioner(f.read())
+        self.assertEqual(int(fields['payload_size']), len(payload))
+
+    def test_all_with_output_file (self):
+        self.assertEqual(self.run_all(output_file='%(SYSTEM)s.sh'), ['db.sh', 'web.sh'])
+
+    def test_all_with_shared_output_file (self):
+        with self.assertRaises(ValueError):
+            self.run_all(output_file='same.sh')
+
+    def test_single_system (self):
+        self.tree.write_config(systems=('web',), cache='no')
+        Provisioner().execute(['-c', self.tree.ini, 'web'])
+        self.assertTrue(os.path.isfile('provisioner.sh'))
+
+if __name__ == '__main__':
+    unittest.main()
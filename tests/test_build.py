@@ -0,0 +1,97 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+from fedora2ova import app
+from fedora2ova.backend import FakeBackend
+from fedora2ova.pipeline import STATE_FILE
+
+STAGES = ['config_iso', 'raw', 'vdi', 'vm', 'booted', 'exported', 'cleaned']
+
+def synthetic_image (path, blocks=3):
+    # a block of data, a block of zeros, and so on
+    raw = b''.join((b'fedora%d' % i) * (1024 * 1024 // 8) if i % 2 == 0
+                   else b'\0' * 1024 * 1024 for i in range(blocks))
+    with open(path, 'wb') as f:
+        f.write(lzma.compress(raw, format=lzma.FORMAT_XZ))
+    return raw
+
+@unittest.skipIf(lzma is None, "needs the lzma module")
+class FakeBuildTest (unittest.TestCase):
+    def setUp (self):
+        self.root = tempfile.mkdtemp()
+        self.image = os.path.join(self.root, 'cloud.raw.xz')
+        synthetic_image(self.image)
+        self.tmpdir = os.path.join(self.root, 'tmp')
+        self.objdir = os.path.join(self.root, 'out')
+        os.mkdir(self.tmpdir)
+        os.mkdir(self.objdir)
+
+    def tearDown (self):
+        shutil.rmtree(self.root)
+
+    def build (self, *args):
+        options = app.build_arg_parser().parse_args(
+            ['--backend', 'fake', '--no-cache', '-n', 'testhost', '-t', self.tmpdir,
+             '-o', self.objdir] + list(args) + [self.image])
+        options.pubkey_data = 'ssh-ed25519 AAAA test@example\n'
+        options.backend = FakeBackend(boot_seconds=0)
+        return options.backend, app.main_build(options)
+
+    def ops (self, backend):
+        return [op for op, args, seconds in backend.calls]
+
+    def test_vbox_export_calls (self):
+        backend, ova = self.build('--vbox-export')
+        self.assertEqual(ova, os.path.join(self.objdir, 'testhost.ova'))
+        ops = self.ops(backend)
+        for op in ('create_vm', 'storage_attach', 'start', 'export', 'unregister'):
+            self.assertIn(op, ops)
+        self.assertEqual([op for op in ops if op in ('create_vm', 'storage_attach', 'start',
+                                                     'export', 'unregister')],
+                         ['create_vm', 'storage_attach', 'storage_attach', 'start',
+                          'export', 'unregister'])
+        attached = [args[1] for op, args, seconds in backend.calls if op == 'storage_attach']
+        self.assertTrue(attached[0].endswith('.vdi'))
+        self.assertTrue(attached[1].endswith('-config.iso'))
+        # the serial port was turned off again before the export
+        self.assertLess(ops.index('power_button'), ops.index('export'))
+        self.assertEqual(backend.vms, {})
+
+    def test_native_export_writes_ova (self):
+        backend, ova = self.build()
+        self.assertNotIn('export', self.ops(backend))
+        self.assertGreater(os.path.getsize(ova), 0)
+
+    def test_stage_timings (self):
+        self.build()
+        with open(os.path.join(self.tmpdir, STATE_FILE)) as f:
+            state = json.load(f)
+        self.assertEqual([s['name'] for s in state['stages']], STAGES)
+        for record in state['stages']:
+            self.assertGreaterEqual(record['seconds'], 0)
+            self.assertNotIn('resumed', record)
+        self.assertIsNone(state['started'])
+
+    def test_resume_of_finished_build (self):
+        self.build()
+        backend, ova = self.build('--resume')
+        self.assertEqual(self.ops(backend), [])
+        self.assertTrue(os.path.exists(ova))
+        with open(os.path.join(self.tmpdir, STATE_FILE)) as f:
+            state = json.load(f)
+        self.assertTrue(all(s.get('resumed') for s in state['stages']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import io
+import subprocess
+import unittest
+
+from make_provisioner import compression
+
+def compress (codec, data):
+    fp = io.BytesIO()
+    zfp = codec.open(fp, codec.default_level, mtime=0)
+    zfp.write(data)
+    zfp.close()
+    return fp.getvalue()
+
+def run_sh (script, data):
+    proc = subprocess.Popen(['sh', '-c', script], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(data)
+    return proc.returncode, out, err.decode('utf-8', 'replace')
+
+@unittest.skipIf(compression.which('sh') is None, "needs sh")
+class GuestCommandsTest (unittest.TestCase):
+    def check_commands (self, name):
+        codec = compression.CODECS[name]
+        if not codec.available():
+            self.skipTest("{} is not available here".format(name))
+        # layered payloads are concatenated archives
+        parts = [b'first part\n' * 1000, b'second part\n' * 1000]
+        payload = b''.join(compress(codec, p) for p in parts)
+        tried = 0
+        for cmd in codec.guest_commands:
+            if compression.which(cmd.split(None, 1)[0]) is None:
+                continue
+            status, out, err = run_sh(cmd, payload)
+            if name == 'zstd' and cmd.startswith('python') and \
+                    'No zstd decompressor' in err:
+                # neither Python 3.14+ nor zstandard; it has to say so
+                self.assertNotEqual(status, 0)
+                continue
+            self.assertEqual((status, out), (0, b''.join(parts)), "{}: {}".format(cmd, err))
+            tried += 1
+        if not tried:
+            self.skipTest("no {} guest command runs here".format(name))
+
+    def test_none (self):
+        self.check_commands('none')
+
+    def test_gzip (self):
+        self.check_commands('gzip')
+
+    def test_pgzip (self):
+        self.check_commands('pgzip')
+
+    def test_xz (self):
+        self.check_commands('xz')
+
+    def test_zstd (self):
+        self.check_commands('zstd')
+
+    def test_guest_script_falls_through (self):
+        codec = compression.CODECS['zstd']
+        script = codec.guest_script().replace('command -v ', 'command -v no-such-')
+        status, out, err = run_sh(script + '\ndecompress', b'')
+        self.assertEqual(status, 1)
+        self.assertIn('No zstd decompressor found', err)
+        self.assertIn('python3', err)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import hashlib
+import os
+import os.path
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from make_provisioner.cache import mtime_key
+from make_provisioner.dedup import Deduplicator, DigestCache, member_meta
+
+class LinkTargetTest (unittest.TestCase):
+    def setUp (self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown (self):
+        shutil.rmtree(self.root)
+
+    def add (self, name, data, mode):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.chmod(path, mode)
+        return path
+
+    def link_target (self, dedup, path):
+        st = os.lstat(path)
+        fi = tarfile.TarInfo(os.path.basename(path))
+        fi.mode = st.st_mode & 0o7777
+        fi.uid, fi.gid = st.st_uid, st.st_gid
+        return dedup.link_target(path, fi.name, st, meta=member_meta(fi))
+
+    def test_same_contents_and_mode_are_linked (self):
+        paths = [self.add(name, b'#!/bin/sh\n', 0o755) for name in ('a.sh', 'b.sh')]
+        dedup = Deduplicator(DigestCache())
+        self.assertIsNone(self.link_target(dedup, paths[0]))
+        self.assertEqual(self.link_target(dedup, paths[1]), 'a.sh')
+        self.assertEqual(dedup.files, 1)
+
+    def test_different_modes_are_not_linked (self):
+        paths = [self.add('run.sh', b'#!/bin/sh\n', 0o755),
+                 self.add('copy.sh', b'#!/bin/sh\n', 0o644)]
+        dedup = Deduplicator(DigestCache())
+        self.assertIsNone(self.link_target(dedup, paths[0]))
+        self.assertIsNone(self.link_target(dedup, paths[1]))
+        self.assertFalse(dedup)
+
+    def test_unique_sizes_are_not_hashed (self):
+        paths = [self.add('one', b'1', 0o644), self.add('two', b'22', 0o644)]
+        digests = DigestCache()
+        dedup = Deduplicator(digests)
+        for path in paths:
+            self.assertIsNone(self.link_target(dedup, path))
+        self.assertEqual(digests.used, {})
+
+class DigestCacheTest (unittest.TestCase):
+    def setUp (self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'file')
+        with open(self.path, 'wb') as f:
+            f.write(b'new contents')
+
+    def tearDown (self):
+        shutil.rmtree(self.root)
+
+    def stale_cache (self, st):
+        # what an earlier build saved, before the file was rewritten at the
+        # same size within the same mtime tick
+        digests = DigestCache()
+        key = "{}:{}:{}:{}".format(st.st_dev, st.st_ino, st.st_size, mtime_key(st))
+        digests.known[key] = hashlib.sha256(b'old contents').hexdigest()
+        return digests, key
+
+    def test_racy_file_is_hashed (self):
+        st = os.stat(self.path)
+        digests, key = self.stale_cache(st)
+        self.assertEqual(digests.digest(self.path, st),
+                         hashlib.sha256(b'new contents').hexdigest())
+        self.assertNotIn(key, digests.used)
+
+    def test_racy_file_is_not_linked (self):
+        other = os.path.join(self.root, 'other')
+        with open(other, 'wb') as f:
+            f.write(b'old contents')
+        st = os.stat(self.path)
+        digests, key = self.stale_cache(st)
+        dedup = Deduplicator(digests)
+        self.assertIsNone(dedup.link_target(other, 'other', os.stat(other)))
+        self.assertIsNone(dedup.link_target(self.path, 'file', st))
+
+    def test_old_file_uses_saved_hash (self):
+        os.utime(self.path, (1000000000, 1000000000))
+        st = os.stat(self.path)
+        digests, key = self.stale_cache(st)
+        self.assertEqual(digests.digest(self.path, st), digests.known[key])
+        self.assertEqual(digests.used, {key: digests.known[key]})
+
+if __name__ == '__main__':
+    unittest.main()
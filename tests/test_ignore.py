@@ -0,0 +1,124 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import os.path
+import unittest
+
+from make_provisioner.ignore import IGNORE_FILE, IgnoreRules, load_rules, split_patterns
+from make_provisioner.walker import SkipStats, scan_tree
+from provisioner_tree import ProvisionerTree
+
+# (patterns, path, is_dir, ignored)
+CASES = [
+    # unanchored names match at any depth
+    (['*.swp'], 'a.swp', False, True),
+    (['*.swp'], 'deep/er/a.swp', False, True),
+    (['*.swp'], 'a.swpx', False, False),
+    (['build'], 'src/build', True, True),
+    (['build'], 'src/build', False, True),
+    (['?.txt'], 'ab.txt', False, False),
+    (['[abc].txt'], 'b.txt', False, True),
+    (['[!abc].txt'], 'b.txt', False, False),
+    # a slash anchors to the root
+    (['/build'], 'build', True, True),
+    (['/build'], 'src/build', True, False),
+    (['src/*.o'], 'src/a.o', False, True),
+    (['src/*.o'], 'src/sub/a.o', False, False),
+    (['src/*.o'], 'other/src/a.o', False, False),
+    # * doesn't cross directories; ** does
+    (['*'], 'a/b', False, True),
+    (['a/*'], 'a/b/c', False, False),
+    (['**/cache'], 'cache', True, True),
+    (['**/cache'], 'x/y/cache', True, True),
+    (['logs/**'], 'logs/a/b.log', False, True),
+    (['logs/**'], 'logs', True, False),
+    (['a/**/z'], 'a/z', False, True),
+    (['a/**/z'], 'a/b/c/z', False, True),
+    (['a/**/z'], 'b/a/z', False, False),
+    # a trailing slash matches only directories
+    (['tmp/'], 'tmp', True, True),
+    (['tmp/'], 'tmp', False, False),
+    (['tmp/'], 'x/tmp', True, True),
+    # negation, and the last match wins
+    (['*.log', '!keep.log'], 'keep.log', False, False),
+    (['*.log', '!keep.log'], 'other.log', False, True),
+    (['!keep.log', '*.log'], 'keep.log', False, True),
+    (['*.log', '!keep.log', 'keep.log'], 'keep.log', False, True),
+    (['!x'], 'x', False, False),
+    # comments, blanks, escapes, and trailing spaces
+    (['# note', '', '   '], 'note', False, False),
+    (['\\#note'], '#note', False, True),
+    (['\\!bang'], '!bang', False, True),
+    (['name   '], 'name', False, True),
+    (['name\\ '], 'name ', False, True),
+    (['a.b'], 'axb', False, False),
+]
+
+class IgnoreRulesTest (unittest.TestCase):
+    def test_cases (self):
+        for patterns, path, is_dir, expected in CASES:
+            rules = IgnoreRules(patterns)
+            self.assertEqual(rules.ignored(path, is_dir), expected,
+                             "{} on {}{}".format(patterns, path, '/' if is_dir else ''))
+
+    def test_empty (self):
+        self.assertFalse(IgnoreRules())
+        self.assertFalse(IgnoreRules(['# only a comment']))
+        self.assertTrue(IgnoreRules(['x']))
+
+    def test_split_patterns (self):
+        self.assertEqual(split_patterns(''), [])
+        self.assertEqual(split_patterns('.git/ *.swp\n    *~'), ['.git/', '*.swp', '*~'])
+
+class LoadRulesTest (unittest.TestCase):
+    def setUp (self):
+        self.tree = ProvisionerTree()
+        for name in ('main.sh', 'a.log', 'keep.log', 'build/out.o', 'src/build/x', 'notes.txt'):
+            self.tree.add(name, b'data')
+
+    def tearDown (self):
+        self.tree.cleanup()
+
+    def names (self, patterns=(), ignore_file=None):
+        if ignore_file is not None:
+            self.tree.add(IGNORE_FILE, ignore_file)
+        skipped = SkipStats()
+        rules = load_rules(self.tree.stage2, patterns)
+        names = [e.name for e in scan_tree(self.tree.stage2, rules, skipped) if not e.is_dir]
+        return names, skipped
+
+    def test_no_rules (self):
+        names, skipped = self.names()
+        self.assertIn('a.log', names)
+        self.assertFalse(skipped)
+
+    def test_config_then_file (self):
+        # the file's patterns come after the config's, so they win
+        names, skipped = self.names(['*.log', '/build/'], b'# keep this one\n!keep.log\n')
+        self.assertEqual(names, ['keep.log', 'main.sh', 'notes.txt', 'src/build/x'])
+        self.assertEqual((skipped.files, skipped.dirs), (1, 1))
+
+    def test_ignore_file_is_silent (self):
+        names, skipped = self.names(ignore_file=b'notes.txt\n')
+        self.assertNotIn(IGNORE_FILE, names)
+        self.assertNotIn('notes.txt', names)
+        self.assertEqual((skipped.files, skipped.bytes, skipped.dirs), (1, 4, 0))
+
+    def test_only_ignore_file (self):
+        names, skipped = self.names(ignore_file=b'# nothing\n')
+        self.assertNotIn(IGNORE_FILE, names)
+        self.assertFalse(skipped)
+
+    def test_ignore_file_put_back (self):
+        names, skipped = self.names(ignore_file=b'!/' + IGNORE_FILE.encode('ascii') + b'\n')
+        self.assertIn(IGNORE_FILE, names)
+
+    def test_excluded_directory_stays_excluded (self):
+        # as in git, a file can't be re-included from an excluded directory
+        names, skipped = self.names(['build/', '!build/out.o'])
+        self.assertNotIn('build/out.o', names)
+        self.assertNotIn('src/build/x', names)
+
+if __name__ == '__main__':
+    unittest.main()
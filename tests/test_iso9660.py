@@ -0,0 +1,123 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import struct
+import unittest
+
+from fedora2ova import app, iso9660
+
+SECTOR = iso9660.SECTOR
+
+def parse_record (data, pos):
+    length = bytearray(data[pos:pos + 1])[0]
+    lba = struct.unpack('<I', data[pos + 2:pos + 6])[0]
+    size = struct.unpack('<I', data[pos + 10:pos + 14])[0]
+    # the big-endian copies must agree
+    assert struct.unpack('>I', data[pos + 6:pos + 10])[0] == lba
+    assert struct.unpack('>I', data[pos + 14:pos + 18])[0] == size
+    flags = bytearray(data[pos + 25:pos + 26])[0]
+    id_len = bytearray(data[pos + 32:pos + 33])[0]
+    ident = data[pos + 33:pos + 33 + id_len]
+    su_start = pos + 33 + id_len + (0 if id_len % 2 else 1)
+    return dict(length=length, lba=lba, size=size, is_dir=bool(flags & 2), ident=ident,
+                system_use=data[su_start:pos + length])
+
+def read_dir (image, lba, size):
+    records = []
+    for sector in range(lba, lba + (size + SECTOR - 1) // SECTOR):
+        data = image[sector * SECTOR:(sector + 1) * SECTOR]
+        pos = 0
+        while pos < SECTOR and bytearray(data[pos:pos + 1])[0]:
+            record = parse_record(data, pos)
+            records.append(record)
+            pos += record['length']
+    return records
+
+def susp_entries (system_use):
+    entries = {}
+    pos = 0
+    while pos + 4 <= len(system_use):
+        sig = system_use[pos:pos + 2]
+        length = bytearray(system_use[pos + 2:pos + 3])[0]
+        entries[sig] = system_use[pos + 4:pos + length]
+        pos += length
+    return entries
+
+class BuildIsoTest (unittest.TestCase):
+    def setUp (self):
+        self.files = app.render_config('testhost', 'ssh-ed25519 AAAA test@example\n')
+        self.image = iso9660.build_iso(self.files, 'cidata', mtime=1500000000)
+
+    def descriptor (self, index):
+        return self.image[(16 + index) * SECTOR:(17 + index) * SECTOR]
+
+    def root (self, descriptor):
+        record = parse_record(descriptor, 156)
+        return read_dir(self.image, record['lba'], record['size'])
+
+    def test_layout (self):
+        self.assertEqual(len(self.image) % SECTOR, 0)
+        pvd = self.descriptor(0)
+        total = struct.unpack('<I', pvd[80:84])[0]
+        self.assertEqual(total * SECTOR, len(self.image))
+        self.assertEqual(struct.unpack('<H', pvd[128:130])[0], SECTOR)
+        self.assertEqual(self.descriptor(2)[0:7], b'\xffCD001\1')
+
+    def test_primary_volume_descriptor (self):
+        pvd = self.descriptor(0)
+        self.assertEqual(pvd[0:7], b'\1CD001\1')
+        self.assertEqual(pvd[40:72].rstrip(b' '), b'cidata')
+        self.assertEqual(pvd[813:829], b'2017071402400000')
+
+    def test_joliet_descriptor (self):
+        svd = self.descriptor(1)
+        self.assertEqual(svd[0:7], b'\2CD001\1')
+        self.assertEqual(svd[88:91], b'%/E')
+        self.assertEqual(svd[40:52].decode('utf-16-be'), 'cidata')
+        names = sorted(r['ident'].decode('utf-16-be') for r in self.root(svd)[2:])
+        self.assertEqual(names, ['meta-data;1', 'user-data;1'])
+
+    def test_directory_records (self):
+        records = self.root(self.descriptor(0))
+        self.assertEqual([r['ident'] for r in records[:2]], [b'\0', b'\1'])
+        self.assertTrue(records[0]['is_dir'] and records[1]['is_dir'])
+        self.assertEqual([r['ident'] for r in records[2:]], [b'META_DATA.;1', b'USER_DATA.;1'])
+        self.assertFalse(any(r['is_dir'] for r in records[2:]))
+        # Rock Ridge starts in the root's "." entry
+        dot = susp_entries(records[0]['system_use'])
+        self.assertEqual(dot[b'SP'], b'\xbe\xef\0')
+        # ...and its continuation area names the extension
+        ce_lba = struct.unpack('<I', dot[b'CE'][0:4])[0]
+        er = self.image[ce_lba * SECTOR:(ce_lba + 1) * SECTOR]
+        self.assertEqual(er[0:2], b'ER')
+        self.assertEqual(er[8:8 + len(iso9660.RRIP_ID)], iso9660.RRIP_ID)
+
+    def test_rock_ridge_names (self):
+        records = self.root(self.descriptor(0))[2:]
+        names = []
+        for record in records:
+            entries = susp_entries(record['system_use'])
+            names.append(entries[b'NM'][1:].decode('utf-8'))
+            mode = struct.unpack('<I', entries[b'PX'][0:4])[0]
+            self.assertEqual(mode, iso9660.FILE_MODE)
+        self.assertEqual(names, ['meta-data', 'user-data'])
+
+    def test_contents (self):
+        files = dict(self.files)
+        for joliet in (False, True):
+            found = {}
+            for record in self.root(self.descriptor(1 if joliet else 0))[2:]:
+                if joliet:
+                    name = record['ident'].decode('utf-16-be')[:-2]
+                else:
+                    name = susp_entries(record['system_use'])[b'NM'][1:].decode('utf-8')
+                start = record['lba'] * SECTOR
+                found[name] = self.image[start:start + record['size']]
+            self.assertEqual(found, files)
+
+    def test_name_collision (self):
+        with self.assertRaises(ValueError):
+            iso9660.build_iso([('user-data', b'a'), ('user_data', b'b')], 'cidata')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import os.path
+import subprocess
+import unittest
+
+from make_provisioner.cache import BuildCache
+from make_provisioner.compression import which
+from provisioner_tree import ProvisionerTree, payload_members, split_provisioner
+
+def read_tree (root):
+    found = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            with open(path, 'rb') as f:
+                found[os.path.relpath(path, root).replace(os.sep, '/')] = f.read()
+    return found
+
+class LayeredPayloadTest (unittest.TestCase):
+    def setUp (self):
+        self.tree = ProvisionerTree()
+        self.layers = [self.tree.path('layer1'), self.tree.path('layer2')]
+        self.tree.write_config(stage2_layers='\n    ' + '\n    '.join(self.layers))
+        files = [
+            (None, 'main.sh', b'#!/bin/sh\necho base\n'),
+            (None, 'etc/app.conf', b'base conf\n'),
+            (None, 'etc/base-only', b'base\n'),
+            (0, 'etc/app.conf', b'layer1 conf\n'),
+            (0, 'lib/one', b'one\n'),
+            (1, 'etc/app.conf', b'layer2 conf\n'),
+            (1, 'main.sh', b'#!/bin/sh\necho layer2\n'),
+            (1, 'lib/two', b'two\n'),
+        ]
+        for layer, name, data in files:
+            root = self.layers[layer] if layer is not None else None
+            self.tree.add(name, data, 0o755 if name.endswith('.sh') else 0o644, root=root)
+        self.merged = read_tree(self.tree.stage2)
+        for layer in self.layers:
+            self.merged.update(read_tree(layer))
+
+    def tearDown (self):
+        self.tree.cleanup()
+
+    def payload (self, *args):
+        fields, payload = split_provisioner(self.tree.build(*args + ('test',)))
+        return payload
+
+    def merge_members (self, payload):
+        # as tar -i does: each later member replaces the earlier one
+        found = {}
+        for member, data in payload_members(payload):
+            if member.isreg():
+                found[member.name] = data
+        return found
+
+    def test_later_layers_win (self):
+        for args in (('--no-cache',), ()):
+            self.assertEqual(self.merge_members(self.payload(*args)), self.merged)
+
+    def test_layers_are_cached (self):
+        first = self.payload('--reproducible')
+        cached = sorted(n for n in os.listdir(self.tree.path('cache')) if n.endswith('.layer'))
+        self.assertEqual(len(cached), 3)
+        # a change to one layer leaves the others' entries in use
+        self.tree.add('lib/two', b'two, changed\n', root=self.layers[1])
+        second = self.payload('--reproducible')
+        self.assertNotEqual(second, first)
+        now = sorted(n for n in os.listdir(self.tree.path('cache')) if n.endswith('.layer'))
+        self.assertEqual(len(set(now) - set(cached)), 1)
+        self.assertEqual(self.merge_members(second)['lib/two'], b'two, changed\n')
+
+    @unittest.skipIf(None in (which('sh'), which('tar'), which('gzip')),
+                     "needs sh, tar, and gzip")
+    def test_extracted_tree (self):
+        # what the guest does with the payload; $0 is the directory
+        out = self.tree.path('guest')
+        os.mkdir(out)
+        proc = subprocess.Popen(['sh', '-c', 'gzip -dc | tar xp -i -C "$0" -f -', out],
+                                stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        err = proc.communicate(self.payload())[1]
+        self.assertEqual(proc.returncode, 0, err)
+        self.assertEqual(read_tree(out), self.merged)
+
+class OpenLayerTest (unittest.TestCase):
+    def setUp (self):
+        self.tree = ProvisionerTree()
+        self.built = []
+
+    def tearDown (self):
+        self.tree.cleanup()
+
+    def builder (self, data):
+        def build (path):
+            self.built.append(data)
+            with open(path, 'wb') as f:
+                f.write(data)
+        return build
+
+    def test_cached (self):
+        cache = BuildCache(self.tree.path('cache'))
+        for i in range(2):
+            with cache.open_layer('a', self.builder(b'aaaa')) as f:
+                self.assertEqual(f.read(), b'aaaa')
+        self.assertEqual(self.built, [b'aaaa'])
+
+    def test_held_through_eviction (self):
+        # room for one layer at a time
+        cache = BuildCache(self.tree.path('cache'), max_size=6)
+        a = cache.open_layer('a', self.builder(b'aaaa'))
+        with a:
+            with cache.open_layer('b', self.builder(b'bbbb')) as b:
+                self.assertFalse(os.path.exists(cache.entry_path('a', '.layer')))
+                self.assertEqual(a.read(), b'aaaa')
+                self.assertEqual(b.read(), b'bbbb')
+        # and an evicted layer is built again
+        with cache.open_layer('a', self.builder(b'aaaa')) as a:
+            self.assertEqual(a.read(), b'aaaa')
+        self.assertEqual(self.built, [b'aaaa', b'bbbb', b'aaaa'])
+
+if __name__ == '__main__':
+    unittest.main()
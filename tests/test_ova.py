@@ -0,0 +1,111 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import hashlib
+import io
+import os
+import os.path
+import shutil
+import struct
+import tarfile
+import tempfile
+import unittest
+import zlib
+from xml.etree import ElementTree
+
+from fedora2ova import app, ova, vdi
+
+MB = 1024 * 1024
+OVF_NS = '{http://schemas.dmtf.org/ovf/envelope/1}'
+
+def decode_vmdk (data):
+    """The virtual disk of a streamOptimized VMDK, as bytes."""
+    header = data[0:512]
+    assert header[0:4] == b'KDMV'
+    capacity = struct.unpack('<Q', header[12:20])[0]
+    desc_sectors = struct.unpack('<Q', header[36:44])[0]
+    disk = bytearray(capacity * 512)
+    pos = (1 + desc_sectors) * 512
+    while True:
+        lba, size = struct.unpack('<QI', data[pos:pos + 12])
+        if size == 0:
+            # a marker: the metadata sectors it names follow it
+            kind = struct.unpack('<I', data[pos + 12:pos + 16])[0]
+            if kind == ova.MARKER_EOS:
+                assert pos + 512 == len(data)
+                return bytes(disk)
+            pos += 512 + lba * 512
+            continue
+        grain = zlib.decompress(data[pos + 12:pos + 12 + size])
+        assert len(grain) == ova.GRAIN_SIZE
+        disk[lba * 512:lba * 512 + len(grain)] = grain[:len(disk) - lba * 512]
+        pos += (12 + size + 511) // 512 * 512
+
+class WriteOvaTest (unittest.TestCase):
+    def setUp (self):
+        self.root = tempfile.mkdtemp()
+        # grains of data between runs of zeros, and a part-grain at the end
+        self.raw = (os.urandom(100000) + b'\0' * (3 * MB) + b'data' * 50000
+                    + b'\0' * 70000 + b'end')
+        base = os.path.join(self.root, 'base.vdi')
+        vdi.write_raw(base, io.BytesIO(self.raw), len(self.raw), disk_size=8 * MB)
+        self.disks = [os.path.join(self.root, 'disk.vdi'), base]
+        vdi.create_diff(self.disks[0], base)
+        self.vm = ova.VmSettings('testhost', 'testhost_0123', 'Fedora_64', 768, 32, 18222,
+                                 self.disks)
+        self.ova = ova.write_ova(os.path.join(self.root, 'testhost.ova'), self.vm,
+                                 app.get_data('resources/vm.ovf'), workers=2)
+
+    def tearDown (self):
+        shutil.rmtree(self.root)
+
+    def members (self):
+        with tarfile.open(self.ova) as t:
+            return [(m, t.extractfile(m).read()) for m in t.getmembers()]
+
+    def test_members (self):
+        names = [m.name for m, data in self.members()]
+        self.assertEqual(names, ['testhost.ovf', 'testhost-disk001.vmdk', 'testhost.mf'])
+
+    def test_vmdk_header (self):
+        with open(self.ova, 'rb') as f:
+            data = f.read()
+        ovf_size = [m.size for m, _ in self.members()][0]
+        at = 512 + (ovf_size + 511) // 512 * 512
+        # frombuf checks the checksum
+        info = tarfile.TarInfo.frombuf(data[at:at + 512], 'utf-8', 'surrogateescape')
+        self.assertEqual(info.name, 'testhost-disk001.vmdk')
+        chksum = int(data[at + 148:at + 154].decode('ascii'), 8)
+        self.assertEqual(chksum, sum(bytearray(data[at:at + 148] + b' ' * 8 + data[at + 156:at + 512])))
+        vmdk = data[at + 512:at + 512 + info.size]
+        # the member ends with the VMDK's end-of-stream marker
+        self.assertEqual(struct.unpack('<QII', vmdk[-512:-496]), (0, 0, ova.MARKER_EOS))
+        self.assertEqual(data[at + 512 + (info.size + 511) // 512 * 512:][:8], b'testhost')
+
+    def test_vmdk_grains (self):
+        vmdk = dict((m.name, data) for m, data in self.members())['testhost-disk001.vmdk']
+        disk = decode_vmdk(vmdk)
+        self.assertEqual(len(disk), 8 * MB)
+        self.assertEqual(disk[:len(self.raw)], self.raw)
+        self.assertFalse(disk[len(self.raw):].strip(b'\0'))
+
+    def test_ovf (self):
+        files = dict((m.name, data) for m, data in self.members())
+        envelope = ElementTree.fromstring(files['testhost.ovf'])
+        ref = envelope.find('{0}References/{0}File'.format(OVF_NS))
+        self.assertEqual(ref.get(OVF_NS + 'href'), 'testhost-disk001.vmdk')
+        disk = envelope.find('{0}DiskSection/{0}Disk'.format(OVF_NS))
+        self.assertEqual(int(disk.get(OVF_NS + 'capacity')), 8 * MB)
+        system = envelope.find(OVF_NS + 'VirtualSystem')
+        self.assertEqual(system.get(OVF_NS + 'id'), 'testhost')
+        self.assertNotIn(b'serial', files['testhost.ovf'].lower())
+
+    def test_manifest (self):
+        files = dict((m.name, data) for m, data in self.members())
+        lines = files['testhost.mf'].decode('utf-8').splitlines()
+        self.assertEqual(lines, [
+            'SHA256 ({}) = {}'.format(name, hashlib.sha256(files[name]).hexdigest())
+            for name in ('testhost.ovf', 'testhost-disk001.vmdk')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from fedora2ova.pipeline import STATE_FILE, BuildState, Stage, run_stages
+
+class Interrupted (Exception):
+    pass
+
+class Build (object):
+    """Stub stages, shaped like a real build's: a disk, a VM on it, and a
+    boot that changes the disk."""
+    def __init__ (self):
+        self.ran = []
+        self.discarded = []
+        self.gone = set()
+        self.fail = None
+
+    def stage (self, name, restart=None):
+        def run (results):
+            self.ran.append(name)
+            if name == self.fail:
+                raise Interrupted(name)
+            self.gone.discard(name)
+            return '{} after {}'.format(name, ','.join(sorted(results)))
+        def check (result, results):
+            return name not in self.gone
+        def discard (result):
+            self.discarded.append(name)
+        return Stage(name, run, check, discard, restart)
+
+    def stages (self):
+        return [self.stage('disk'), self.stage('vm'), self.stage('booted', restart='disk'),
+                self.stage('exported')]
+
+class RunStagesTest (unittest.TestCase):
+    def setUp (self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.build = Build()
+
+    def tearDown (self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_build (self, resume=False, inputs=None):
+        self.build.ran = []
+        self.build.discarded = []
+        state = BuildState(self.tmpdir, inputs or dict(image='a'))
+        return run_stages(self.build.stages(), state, resume)
+
+    def state (self):
+        with open(os.path.join(self.tmpdir, STATE_FILE)) as f:
+            return json.load(f)
+
+    def test_fresh_build (self):
+        results = self.run_build()
+        self.assertEqual(self.build.ran, ['disk', 'vm', 'booted', 'exported'])
+        self.assertEqual(results['vm'], 'vm after disk')
+        self.assertEqual([s['name'] for s in self.state()['stages']], self.build.ran)
+
+    def test_resume_skips_finished_stages (self):
+        self.run_build()
+        results = self.run_build(resume=True)
+        self.assertEqual(self.build.ran, [])
+        self.assertEqual(self.build.discarded, [])
+        self.assertEqual(results['exported'], 'exported after booted,disk,vm')
+        self.assertTrue(all(s['resumed'] for s in self.state()['stages']))
+
+    def test_without_resume_starts_over (self):
+        self.run_build()
+        self.run_build()
+        self.assertEqual(self.build.ran, ['disk', 'vm', 'booted', 'exported'])
+        self.assertEqual(self.build.discarded, [])
+
+    def test_failed_check_reruns_from_that_stage (self):
+        self.run_build()
+        self.build.gone.add('exported')
+        self.run_build(resume=True)
+        self.assertEqual(self.build.ran, ['exported'])
+        self.assertEqual(self.build.discarded, ['exported'])
+
+    def test_failed_check_reruns_from_restart (self):
+        self.build.fail = 'exported'
+        with self.assertRaises(Interrupted):
+            self.run_build()
+        self.build.fail = None
+        self.build.gone.add('booted')
+        self.run_build(resume=True)
+        self.assertEqual(self.build.ran, ['disk', 'vm', 'booted', 'exported'])
+        self.assertEqual(self.build.discarded, ['booted', 'vm', 'disk'])
+
+    def test_finished_build_only_checks_last_stage (self):
+        # what the earlier stages made is cleaned up by the last one
+        self.run_build()
+        self.build.gone.update(['disk', 'vm'])
+        self.run_build(resume=True)
+        self.assertEqual(self.build.ran, [])
+
+    def test_interrupted_stage_reruns_from_restart (self):
+        self.build.fail = 'booted'
+        with self.assertRaises(Interrupted):
+            self.run_build()
+        self.assertEqual(self.state()['started'], 'booted')
+        self.build.fail = None
+        self.run_build(resume=True)
+        self.assertEqual(self.build.ran, ['disk', 'vm', 'booted', 'exported'])
+        # only what was finished is discarded
+        self.assertEqual(self.build.discarded, ['vm', 'disk'])
+
+    def test_interrupted_stage_reruns (self):
+        self.build.fail = 'exported'
+        with self.assertRaises(Interrupted):
+            self.run_build()
+        self.build.fail = None
+        self.run_build(resume=True)
+        self.assertEqual(self.build.ran, ['exported'])
+        records = self.state()['stages']
+        self.assertEqual([s['name'] for s in records if s.get('resumed')],
+                         ['disk', 'vm', 'booted'])
+
+    def test_changed_inputs_start_over (self):
+        self.run_build()
+        self.run_build(resume=True, inputs=dict(image='b'))
+        self.assertEqual(self.build.ran, ['disk', 'vm', 'booted', 'exported'])
+        # what the other build made isn't discarded
+        self.assertEqual(self.build.discarded, [])
+        self.assertEqual(self.state()['inputs'], dict(image='b'))
+
+    def test_stale_state_file (self):
+        for content in ('{"format": 0, "stages": []}', 'not json'):
+            with open(os.path.join(self.tmpdir, STATE_FILE), 'w') as f:
+                f.write(content)
+            self.run_build(resume=True)
+            self.assertEqual(self.build.ran, ['disk', 'vm', 'booted', 'exported'])
+            self.assertEqual(self.build.discarded, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import os.path
+import time
+import unittest
+
+from make_provisioner import compression
+from provisioner_tree import ProvisionerTree, payload_members, split_provisioner
+
+class ReproducibleTest (unittest.TestCase):
+    def setUp (self):
+        self.environ = os.environ.pop('SOURCE_DATE_EPOCH', None)
+        self.tree = ProvisionerTree()
+        self.main = self.tree.add('main.sh', b'#!/bin/sh\necho hi\n', 0o755)
+        self.conf = self.tree.add('etc/app.conf', b'key = value\n')
+        self.tree.add('etc/sub/deeper', b'x' * 10000, 0o640)
+        os.symlink('app.conf', os.path.join(self.tree.stage2, 'etc', 'link'))
+
+    def tearDown (self):
+        self.tree.cleanup()
+        if self.environ is not None:
+            os.environ['SOURCE_DATE_EPOCH'] = self.environ
+
+    def build (self, *args):
+        return self.tree.build('--no-cache', '--reproducible', *args + ('test',))
+
+    def disturb (self):
+        # everything about the tree but its contents and executable bits
+        later = time.time() + 86400
+        for dirpath, dirnames, filenames in os.walk(self.tree.stage2):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                os.utime(path, (later, later))
+                if hasattr(os, 'geteuid') and os.geteuid() == 0:
+                    os.chown(path, 1234, 5678)
+        os.chmod(self.main, 0o700)
+        os.chmod(self.conf, 0o600)
+        os.chmod(os.path.join(self.tree.stage2, 'etc'), 0o711)
+
+    def test_byte_identical (self):
+        for spec in ('gzip:9', 'none', 'xz', 'zstd'):
+            codec, level = compression.parse_spec(spec)
+            if not codec.available():
+                continue
+            first = self.build('-z', spec)
+            self.disturb()
+            self.assertEqual(self.build('-z', spec), first, spec)
+
+    def test_normalized_members (self):
+        self.disturb()
+        fields, payload = split_provisioner(self.build())
+        members = dict((m.name, m) for m, _ in payload_members(payload))
+        self.assertEqual(sorted(members), ['etc/app.conf', 'etc/link', 'etc/sub/deeper', 'main.sh'])
+        for m in members.values():
+            self.assertEqual((m.mtime, m.uid, m.gid, m.uname, m.gname), (0, 0, 0, 'root', 'root'))
+        self.assertEqual(members['main.sh'].mode & 0o7777, 0o755)
+        self.assertEqual(members['etc/app.conf'].mode & 0o7777, 0o644)
+        self.assertEqual(members['etc/sub/deeper'].mode & 0o7777, 0o644)
+
+    def test_source_date_epoch (self):
+        first = self.build()
+        os.environ['SOURCE_DATE_EPOCH'] = '1500000000'
+        try:
+            second = self.build()
+        finally:
+            del os.environ['SOURCE_DATE_EPOCH']
+        self.assertNotEqual(second, first)
+        fields, payload = split_provisioner(second)
+        self.assertEqual(set(m.mtime for m, _ in payload_members(payload)), set([1500000000]))
+
+    def test_contents_still_matter (self):
+        first = self.build()
+        with open(self.conf, 'ab') as f:
+            f.write(b'more\n')
+        self.assertNotEqual(self.build(), first)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import os.path
+import socket
+import threading
+import time
+import unittest
+
+from make_provisioner import server
+from make_provisioner.app import Provisioner
+from provisioner_tree import ProvisionerTree, split_provisioner
+
+class Builder (object):
+    """A build function that counts its calls, and can be held or made to
+    fail."""
+    def __init__ (self, value=(b'data', 'sha'), error=None):
+        self.value = value
+        self.error = error
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__ (self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class PayloadLRUTest (unittest.TestCase):
+    def get_in_threads (self, lru, key, builder, n=4):
+        results = [None] * n
+        def get (i):
+            try:
+                results[i] = lru.get(key, builder)
+            except Exception as e:
+                results[i] = e
+        builder.release.clear()
+        threads = [threading.Thread(target=get, args=(i,)) for i in range(n)]
+        threads[0].start()
+        builder.started.wait()
+        for t in threads[1:]:
+            t.start()
+        # let the others reach the wait before the build finishes
+        time.sleep(0.1)
+        builder.release.set()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_one_build_per_key (self):
+        lru = server.PayloadLRU(1000)
+        builder = Builder()
+        results = self.get_in_threads(lru, 'k', builder)
+        self.assertEqual(results, [builder.value] * 4)
+        self.assertEqual(builder.calls, 1)
+        self.assertEqual(lru.builds, 1)
+        self.assertEqual(lru.building, {})
+        # and later requests are hits
+        self.assertEqual(lru.get('k', Builder()), builder.value)
+        self.assertEqual(lru.hits, 1)
+
+    def test_error_reaches_every_waiter (self):
+        lru = server.PayloadLRU(1000)
+        error = RuntimeError('build failed')
+        builder = Builder(error=error)
+        results = self.get_in_threads(lru, 'k', builder)
+        self.assertEqual(results, [error] * 4)
+        self.assertEqual(builder.calls, 1)
+        self.assertEqual(lru.building, {})
+        self.assertEqual(lru.entries, {})
+        # nothing is stuck: the next request builds again
+        self.assertEqual(lru.get('k', Builder()), (b'data', 'sha'))
+
+    def test_eviction (self):
+        lru = server.PayloadLRU(10)
+        for key in 'abc':
+            lru.get(key, Builder((key.encode('ascii') * 4, key)))
+        # c pushed out a, the least recently used
+        self.assertEqual(list(lru.entries), ['b', 'c'])
+        self.assertEqual(lru.total, 8)
+        lru.get('b', Builder())
+        lru.get('d', Builder((b'dddd', 'd')))
+        self.assertEqual(list(lru.entries), ['b', 'd'])
+        self.assertEqual(lru.hits, 1)
+
+    def test_too_big_to_keep (self):
+        lru = server.PayloadLRU(10)
+        lru.get('a', Builder((b'aaaa', 'a')))
+        big = Builder((b'x' * 11, 'x'))
+        self.assertEqual(lru.get('big', big), big.value)
+        self.assertEqual(list(lru.entries), ['a'])
+        lru.get('big', big)
+        self.assertEqual(big.calls, 2)
+
+class ServerTest (unittest.TestCase):
+    def setUp (self):
+        self.tree = ProvisionerTree()
+        self.tree.write_config(systems=('web', 'db'), reproducible='yes', cache='no')
+        self.tree.add('main.sh', b'#!/bin/sh\n', 0o755)
+        self.tree.add('blob', os.urandom(20000))
+
+    def tearDown (self):
+        self.tree.cleanup()
+
+    def test_build (self):
+        app = server.ProvisionerApp(Provisioner(), self.tree.ini, 1024 * 1024)
+        self.assertEqual(app.systems(), ['web', 'db'])
+        stub, payload = app.build('web')
+        self.assertEqual(stub + payload, self.tree.build('web'))
+        # both systems share the tree, so the payload is built once
+        app.build('db')
+        self.assertEqual((app.payloads.builds, app.payloads.hits), (1, 1))
+        self.assertRaises(server.UnknownSystemError, app.build, 'nope')
+
+    def test_cache_size (self):
+        # smaller than the payload: served, but never kept
+        app = server.ProvisionerApp(Provisioner(), self.tree.ini, 1000)
+        app.build('web')
+        app.build('web')
+        self.assertEqual((app.payloads.builds, len(app.payloads.entries)), (2, 0))
+
+    @unittest.skipIf(not hasattr(socket, 'AF_UNIX'), "needs Unix sockets")
+    def test_fetch (self):
+        address = server.UNIX_PREFIX + self.tree.path('sock')
+        app = server.ProvisionerApp(Provisioner(), self.tree.ini, 1024 * 1024)
+        httpd = server.make_server(app, address)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        try:
+            out = self.tree.path('fetched.sh')
+            server.fetch(address, 'db', out)
+            with open(out, 'rb') as f:
+                data = f.read()
+            fields, payload = split_provisioner(data)
+            self.assertEqual(int(fields['payload_size']), len(payload))
+            self.assertEqual(data, self.tree.build('db'))
+            with self.assertRaises(RuntimeError):
+                server.fetch(address, 'nope', out)
+        finally:
+            httpd.shutdown()
+            thread.join()
+            httpd.server_close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import hashlib
+import os
+import os.path
+import subprocess
+import threading
+import unittest
+
+from provisioner_tree import ProvisionerTree, payload_members, split_provisioner
+
+def find_program (name):
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        if os.path.isfile(os.path.join(d, name)):
+            return os.path.join(d, name)
+    return None
+
+class SfxTest (unittest.TestCase):
+    def setUp (self):
+        self.tree = ProvisionerTree(guest_stage2_dir='%(INI_DIR)s/guest')
+        self.tree.add('main.sh', b'#!/bin/sh\necho ran > "$CLOUD_DIR/ran"\n', 0o755)
+        self.tree.add('data/blob', os.urandom(50000))
+
+    def tearDown (self):
+        self.tree.cleanup()
+
+    def check_fields (self, data):
+        fields, payload = split_provisioner(data)
+        self.assertEqual(int(fields['payload_size']), len(payload))
+        self.assertEqual(fields['payload_sha256'], hashlib.sha256(payload).hexdigest())
+        # the offset is exactly the first byte after the stub
+        stub = data[:int(fields['payload_offset']) - 1]
+        self.assertTrue(stub.endswith(b"\nexec './main.sh'\n"))
+        self.assertTrue(payload.startswith(b'\x1f\x8b'))
+        names = sorted(m.name for m, _ in payload_members(payload))
+        self.assertEqual(names, ['data/blob', 'main.sh'])
+
+    def test_rewritten_stub (self):
+        self.check_fields(self.tree.build('--no-cache', 'test'))
+
+    def test_unseekable_output (self):
+        fifo = self.tree.path('fifo')
+        os.mkfifo(fifo)
+        chunks = []
+        def read ():
+            with open(fifo, 'rb') as f:
+                chunks.append(f.read())
+        reader = threading.Thread(target=read)
+        reader.start()
+        p = self.tree.provisioner('--no-cache', '--reproducible', 'test')
+        p.create_provisioner(fifo, p.config['stage2_dir'])
+        reader.join()
+        self.check_fields(chunks[0])
+        # the same bytes as the in-place rewrite
+        self.assertEqual(chunks[0], self.tree.build('--no-cache', '--reproducible', 'test'))
+
+    def run_guest (self, data):
+        # a sudo that just runs the command, for install -d
+        bindir = self.tree.path('bin')
+        self.tree.add('sudo', b'#!/bin/sh\nexec "$@"\n', 0o755, root=bindir)
+        script = self.tree.add('provisioner.sh', data, 0o755)
+        env = dict(os.environ, PATH=bindir + os.pathsep + os.environ.get('PATH', ''))
+        proc = subprocess.Popen(['sh', script], env=env, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        return proc.returncode, err.decode('utf-8', 'replace')
+
+    @unittest.skipIf(None in (find_program('sh'), find_program('tar'), find_program('gzip')),
+                     "needs sh, tar, and gzip")
+    def test_guest_unpacks (self):
+        status, err = self.run_guest(self.tree.build('--no-cache', 'test'))
+        self.assertEqual(status, 0, err)
+        self.assertTrue(os.path.exists(self.tree.path('guest', 'ran')))
+        with open(self.tree.path('guest', 'data', 'blob'), 'rb') as f, \
+                open(os.path.join(self.tree.stage2, 'data', 'blob'), 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+
+    @unittest.skipIf(find_program('sh') is None, "needs sh")
+    def test_guest_rejects_truncated (self):
+        data = self.tree.build('--no-cache', 'test')
+        for cut in (1, 1000, len(split_provisioner(data)[1])):
+            status, err = self.run_guest(data[:-cut])
+            self.assertEqual(status, 1)
+            self.assertIn('bytes, expected {}'.format(len(data)), err)
+            self.assertFalse(os.path.exists(self.tree.path('guest', 'main.sh')))
+            self.assertFalse(os.path.exists(self.tree.path('guest', 'ran')))
+
+    @unittest.skipIf(None in (find_program('sh'), find_program('sha256sum')),
+                     "needs sh and sha256sum")
+    def test_guest_rejects_damaged (self):
+        data = bytearray(self.tree.build('--no-cache', 'test'))
+        data[-100] ^= 0x55
+        status, err = self.run_guest(bytes(data))
+        self.assertEqual(status, 1)
+        self.assertIn('payload is damaged', err)
+        self.assertFalse(os.path.exists(self.tree.path('guest', 'main.sh')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import io
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from fedora2ova import app, vdi
+
+MB = 1024 * 1024
+
+def read_disk (image):
+    """The virtual disk of a VDI chain, as bytes."""
+    parts = []
+    for index in range(image.blocks):
+        size = min(image.block_size, image.disk_size - index * image.block_size)
+        where = image.locate(index)
+        if where is None:
+            parts.append(b'\0' * size)
+            continue
+        with open(where[0], 'rb') as f:
+            f.seek(where[1])
+            parts.append(f.read(size))
+    return b''.join(parts)
+
+class WriteRawTest (unittest.TestCase):
+    def setUp (self):
+        self.root = tempfile.mkdtemp()
+        # data, a run of zero blocks, data, and a short last block
+        self.raw = (b'\x01' * MB + b'\0' * (2 * MB) + os.urandom(MB) + b'\0' * 100
+                    + b'tail' + b'\0' * 1000)
+
+    def tearDown (self):
+        shutil.rmtree(self.root)
+
+    def path (self, name):
+        return os.path.join(self.root, name)
+
+    def write (self, name, data=None, **kwargs):
+        data = self.raw if data is None else data
+        vdi.write_raw(self.path(name), io.BytesIO(data), len(data), **kwargs)
+        return self.path(name)
+
+    def test_round_trip (self):
+        image = vdi.open_chain([self.write('a.vdi')])
+        self.assertEqual(image.disk_size, len(self.raw))
+        self.assertEqual(read_disk(image), self.raw)
+
+    def test_round_trip_from_chunks (self):
+        pieces = [self.raw[i:i + 1000] for i in range(0, len(self.raw), 1000)]
+        vdi.write_raw(self.path('a.vdi'), iter(pieces), len(self.raw))
+        self.assertEqual(read_disk(vdi.open_chain([self.path('a.vdi')])), self.raw)
+
+    def test_zero_blocks_are_unallocated (self):
+        image = vdi.VdiImage(self.write('a.vdi'))
+        self.assertEqual(image.block_map, (0, vdi.BLOCK_FREE, vdi.BLOCK_FREE, 1, 2))
+        self.assertEqual(image.header.allocated, 3)
+        self.assertEqual(os.path.getsize(image.path),
+                         image.header.data_offset + 3 * image.block_size)
+
+    def test_disk_size (self):
+        image = vdi.VdiImage(self.write('a.vdi', disk_size=16 * MB))
+        self.assertEqual(image.disk_size, 16 * MB)
+        self.assertEqual(image.blocks, 16)
+        self.assertEqual(read_disk(image), self.raw + b'\0' * (16 * MB - len(self.raw)))
+
+    def test_disk_too_small (self):
+        with self.assertRaises(RuntimeError):
+            self.write('a.vdi', disk_size=MB)
+        self.assertFalse(os.path.exists(self.path('a.vdi')))
+
+    def test_short_data (self):
+        with self.assertRaises(ValueError):
+            vdi.write_raw(self.path('a.vdi'), io.BytesIO(self.raw[:-1]), len(self.raw))
+        self.assertFalse(os.path.exists(self.path('a.vdi')))
+
+    def test_imagesize (self):
+        raw = self.path('cloud.raw')
+        with open(raw, 'wb') as f:
+            f.write(self.raw)
+        options = app.build_arg_parser().parse_args(['--imagesize', '1024', raw])
+        path = app.build_base_disk(raw, self.root, options)
+        image = vdi.VdiImage(path)
+        self.assertEqual(image.disk_size, 1024 * MB)
+        self.assertEqual(read_disk(image)[:len(self.raw)], self.raw)
+
+    def test_create_diff (self):
+        base = self.write('base.vdi')
+        child = self.path('child.vdi')
+        vdi.create_diff(child, base)
+        image = vdi.open_chain([child, base])
+        self.assertEqual(image.header.image_type, vdi.TYPE_DIFF)
+        self.assertEqual(image.header.uuid_parent, image.parent.header.uuid_create)
+        self.assertEqual(image.block_map, (vdi.BLOCK_FREE,) * image.blocks)
+        self.assertEqual(read_disk(image), self.raw)
+
+    def test_diff_needs_its_parent (self):
+        base = self.write('base.vdi')
+        other = self.write('other.vdi')
+        child = self.path('child.vdi')
+        vdi.create_diff(child, base)
+        with self.assertRaises(ValueError):
+            vdi.open_chain([child])
+        with self.assertRaises(ValueError):
+            vdi.open_chain([child, other])
+
+if __name__ == '__main__':
+    unittest.main()
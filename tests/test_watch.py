@@ -0,0 +1,96 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import gzip
+import io
+import os
+import os.path
+import subprocess
+import tempfile
+import unittest
+
+from make_provisioner import compression, watch
+from provisioner_tree import ProvisionerTree, split_provisioner
+
+def decompress (name, data):
+    # every member or frame, as one stream
+    if name == 'none':
+        return data
+    if name in ('gzip', 'pgzip'):
+        return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+    if name == 'xz' and compression.lzma is not None:
+        return compression.lzma.decompress(data)
+    cmd = {'xz': 'xz', 'zstd': 'zstd'}[name]
+    if compression.which(cmd) is None:
+        return None
+    proc = subprocess.Popen([cmd, '-dc'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return proc.communicate(data)[0]
+
+class ChunkedPayloadTest (unittest.TestCase):
+    def setUp (self):
+        self.tree = ProvisionerTree()
+        self.tree.add('main.sh', b'#!/bin/sh\necho hi\n', 0o755)
+        self.tree.add('etc/app.conf', b'key = value\n' * 100)
+        self.tree.add('data/blob', os.urandom(30000))
+        self.tree.add('data/empty', b'')
+        self.workdir = tempfile.mkdtemp(dir=self.tree.root)
+
+    def tearDown (self):
+        self.tree.cleanup()
+
+    def chunked (self, p, store):
+        fp = io.BytesIO()
+        watch.build_payload(p, store, fp, p.config['stage2_dir'])
+        return fp.getvalue()
+
+    def test_same_tar_as_normal_build (self):
+        for name in compression.CODECS:
+            codec = compression.CODECS[name]
+            if not codec.available():
+                continue
+            p = self.tree.provisioner('--no-cache', '--reproducible', '-z', name, 'test')
+            store = watch._store_for(p, self.workdir)
+            normal = io.BytesIO()
+            p.build_payload(normal, p.config['stage2_dir'])
+            expected = decompress(name, normal.getvalue())
+            if expected is None:
+                continue
+            self.assertEqual(decompress(name, self.chunked(p, store)), expected, name)
+
+    def test_rebuild_compresses_changes (self):
+        p = self.tree.provisioner('--no-cache', '-o', self.tree.path('out.sh'), 'test')
+        store = watch._store_for(p, self.workdir)
+        out = io.StringIO()
+        watch.rebuild(p, store, p.config['stage2_dir'], p.get_output(), out)
+        first = set(os.listdir(store.workdir))
+        self.assertEqual(store.compressed, store.chunks)
+        self.assertEqual(first, store.used)
+
+        # the same size, so the end-of-archive padding doesn't change
+        self.tree.add('etc/app.conf', b'key = other\n' * 100)
+        watch.rebuild(p, store, p.config['stage2_dir'], p.get_output(), out)
+        self.assertEqual(store.compressed, 1)
+        self.assertEqual(store.chunks, len(first))
+        self.assertIn('(1 of {} members compressed)'.format(store.chunks), out.getvalue())
+        # finish() dropped the old member
+        now = set(os.listdir(store.workdir))
+        self.assertEqual(now, store.used)
+        self.assertEqual(len(now - first), 1)
+        self.assertEqual(len(first - now), 1)
+
+        with open(self.tree.path('out.sh'), 'rb') as f:
+            fields, payload = split_provisioner(f.read())
+        self.assertEqual(int(fields['payload_size']), len(payload))
+        self.assertIn(b'key = other', decompress('gzip', payload))
+
+    def test_settings_change_starts_over (self):
+        p = self.tree.provisioner('--no-cache', 'test')
+        store = watch._store_for(p, self.workdir)
+        self.assertIs(watch._store_for(p, self.workdir, store), store)
+        xz = self.tree.provisioner('--no-cache', '-z', 'xz', 'test')
+        other = watch._store_for(xz, self.workdir, store)
+        self.assertIsNot(other, store)
+        self.assertFalse(os.path.exists(store.workdir))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+# vim: fileencoding=utf-8
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from fedora2ova import xz
+
+def find_xz ():
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        if os.path.isfile(os.path.join(d, 'xz')):
+            return os.path.join(d, 'xz')
+    return None
+
+def sample (n, seed=0):
+    # compressible, with runs of zeros
+    parts = []
+    for i in range(n):
+        parts.append(b'\0' * 70000 if (i + seed) % 3 == 0 else
+                     ('line {} of {}\n'.format(i, seed) * 500).encode('ascii'))
+    return b''.join(parts)
+
+@unittest.skipIf(xz.lzma is None, "needs the lzma module")
+class XzTest (unittest.TestCase):
+    def setUp (self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown (self):
+        shutil.rmtree(self.root)
+
+    def write (self, data, name='image.raw.xz'):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def unxz (self, path):
+        with open(path, 'rb') as f:
+            return xz.lzma.decompress(f.read())
+
+    def check (self, path, expected, blocks=None):
+        index = xz.read_index(path)
+        if blocks is not None:
+            self.assertEqual(len(index), blocks)
+        self.assertEqual(xz.uncompressed_size(path), len(expected))
+        self.assertEqual([b.out_offset for b in index],
+                         [sum(b.uncompressed for b in index[:i]) for i in range(len(index))])
+        self.assertEqual(b''.join(xz.iter_decompressed(path, workers=1)), expected)
+        self.assertEqual(b''.join(xz.iter_decompressed(path, workers=2)), expected)
+        for workers in (1, 2):
+            out = os.path.join(self.root, 'out{}.raw'.format(workers))
+            self.assertEqual(xz.decompress(path, out, workers=workers), len(expected))
+            with open(out, 'rb') as f:
+                self.assertEqual(f.read(), expected)
+
+    def test_single_stream (self):
+        data = sample(20)
+        path = self.write(xz.lzma.compress(data, format=xz.lzma.FORMAT_XZ))
+        self.check(path, self.unxz(path), blocks=1)
+        self.assertEqual(self.unxz(path), data)
+
+    def test_check_types (self):
+        data = sample(5)
+        for check in (xz.lzma.CHECK_NONE, xz.lzma.CHECK_CRC32, xz.lzma.CHECK_CRC64,
+                      xz.lzma.CHECK_SHA256):
+            path = self.write(xz.lzma.compress(data, format=xz.lzma.FORMAT_XZ, check=check),
+                              'check{}.xz'.format(check))
+            self.assertEqual(b''.join(xz.iter_decompressed(path)), data)
+
+    def test_multi_stream (self):
+        parts = [sample(10, seed) for seed in range(3)]
+        path = self.write(b''.join(xz.lzma.compress(p, format=xz.lzma.FORMAT_XZ) for p in parts))
+        self.assertEqual(self.unxz(path), b''.join(parts))
+        self.check(path, b''.join(parts), blocks=3)
+
+    def test_padded (self):
+        parts = [sample(10, seed) for seed in range(2)]
+        streams = [xz.lzma.compress(p, format=xz.lzma.FORMAT_XZ) for p in parts]
+        path = self.write(streams[0] + b'\0' * 8 + streams[1] + b'\0' * 4)
+        self.assertEqual(b''.join(xz.lzma.decompress(st) for st in streams), b''.join(parts))
+        self.check(path, b''.join(parts), blocks=2)
+
+    def test_empty_stream (self):
+        path = self.write(xz.lzma.compress(b'', format=xz.lzma.FORMAT_XZ)
+                          + xz.lzma.compress(b'data', format=xz.lzma.FORMAT_XZ))
+        self.check(path, b'data', blocks=1)
+
+    @unittest.skipIf(find_xz() is None, "needs the xz command")
+    def test_several_blocks (self):
+        data = sample(60)
+        raw = self.write(data, 'image.raw')
+        subprocess.check_call([find_xz(), '-k', '-T1', '--block-size=65536', raw])
+        path = raw + '.xz'
+        self.assertEqual(self.unxz(path), data)
+        self.check(path, data, blocks=(len(data) + 65535) // 65536)
+
+    def test_truncated (self):
+        good = xz.lzma.compress(sample(10), format=xz.lzma.FORMAT_XZ)
+        for data in (good[:-1], good[:-13], good[:20], good[12:], b''):
+            path = self.write(data)
+            if data:
+                self.assertRaises(ValueError, xz.read_index, path)
+            else:
+                self.assertEqual(xz.read_index(path), [])
+
+    def test_corrupt_index (self):
+        good = bytearray(xz.lzma.compress(sample(10), format=xz.lzma.FORMAT_XZ))
+        # the index is just before the 12-byte footer
+        for pos in (-14, -16, -9, -7):
+            data = bytearray(good)
+            data[pos] ^= 0x55
+            self.assertRaises(ValueError, xz.read_index, self.write(bytes(data)))
+
+    def test_corrupt_block (self):
+        good = bytearray(xz.lzma.compress(sample(10), format=xz.lzma.FORMAT_XZ))
+        good[40] ^= 0x55
+        path = self.write(bytes(good))
+        with self.assertRaises((ValueError, xz.lzma.LZMAError)):
+            b''.join(xz.iter_decompressed(path))
+        out = os.path.join(self.root, 'out.raw')
+        with self.assertRaises((ValueError, xz.lzma.LZMAError)):
+            xz.decompress(path, out)
+        self.assertFalse(os.path.exists(out))
+
+    def test_not_xz (self):
+        self.assertRaises(ValueError, xz.read_index, self.write(b'not an xz file at all' * 10))
+
+if __name__ == '__main__':
+    unittest.main()